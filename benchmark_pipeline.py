@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+
+"""
+
+Benchmark harness for the orchestration overhead of the bids_pythonic module.
+
+Synthetic DICOM trees are generated in a temporary directory, and fake dcm2niix, bsub,
+bjobs and fmriprep-docker executables (with a configurable latency) are put on the PATH.
+The full create_bids_root -> SetupBIDSPipeline -> FmriprepSingularityPipeline flow, supervised
+submission and the local fmriprep-docker scheduler are then timed for every requested scenario.
+
+Results are written as JSON with one record per scenario, so runs of different versions
+can be compared with the --compare option:
+
+    python benchmark_pipeline.py --subjects 1 100 1000 --output new.json --compare old.json
+
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+import bids_pythonic as bp
+
+
+# Fake dcm2niix: writes a NIFTI-1 header and a JSON sidecar. Anatomical series (-f *_T1w) are 3D,
+# functional series 4D with one volume per DICOM file
+FAKE_DCM2NIIX = r'''#!{python}
+import json, os, struct, sys, time
+args = sys.argv[1:]
+if not args or args[0] == '-h':
+    print("dcm2niiX version v1.0.benchmark")
+    sys.exit(0)
+time.sleep(float(os.environ.get('BENCHMARK_LATENCY', '0')))
+args = [arg for arg in args if arg not in ('-1', '-2', '-3', '-4', '-5', '-6', '-7', '-8', '-9')]
+opts = dict(zip(args[:-1:2], args[1:-1:2]))
+src = args[-1]
+if not os.path.isdir(src):
+    sys.exit(2)
+volumes = len(os.listdir(src))
+anat = opts['-f'].endswith('_T1w')
+header = bytearray(352)
+struct.pack_into('<i', header, 0, 348)
+struct.pack_into('<8h', header, 40, 3 if anat else 4, 64, 64, 36, 1 if anat else volumes, 1, 1, 1)
+struct.pack_into('<hh', header, 70, 4, 16)
+struct.pack_into('<8f', header, 76, 1, 3, 3, 3, 2, 1, 1, 1)
+struct.pack_into('<ff', header, 108, 352, 1)
+header[344:348] = b'n+1\0'
+with open(os.path.join(opts['-o'], opts['-f'] + '.nii'), 'wb') as f:
+    f.write(header)
+with open(os.path.join(opts['-o'], opts['-f'] + '.json'), 'w') as f:
+    json.dump({{'RepetitionTime': 2.0, 'EchoTime': 0.03}}, f)
+'''
+
+# Fake bsub: reads the job script from stdin and prints an LSF style job ID.
+# With BENCHMARK_JOBS set, the job is recorded there as finished, for the fake bjobs
+FAKE_BSUB = r'''#!{python}
+import os, sys, time
+sys.stdin.read()
+time.sleep(float(os.environ.get('BENCHMARK_LATENCY', '0')))
+job_id = os.getpid()
+if os.environ.get('BENCHMARK_JOBS'):
+    os.makedirs(os.environ['BENCHMARK_JOBS'], exist_ok=True)
+    job_id = len(os.listdir(os.environ['BENCHMARK_JOBS'])) + 1
+    open(os.path.join(os.environ['BENCHMARK_JOBS'], str(job_id)), 'w').close()
+print('Job <{{}}> is submitted to queue <private>.'.format(job_id))
+'''
+
+# Fake bjobs: reports every job recorded by the fake bsub as DONE, like bjobs -w -a
+FAKE_BJOBS = r'''#!{python}
+import os, sys, time
+time.sleep(float(os.environ.get('BENCHMARK_LATENCY', '0')))
+print('JOBID   USER    STAT  QUEUE      FROM_HOST   EXEC_HOST   JOB_NAME   SUBMIT_TIME')
+for job_id in sys.argv[1:]:
+    if job_id.startswith('-'):
+        continue
+    if os.path.isfile(os.path.join(os.environ.get('BENCHMARK_JOBS', ''), job_id)):
+        print('{{}} bench DONE private login node fmriprep Jan  1 00:00'.format(job_id))
+    else:
+        sys.stderr.write('Job <{{}}> is not found\n'.format(job_id))
+'''
+
+# Fake fmriprep-docker: only waits
+FAKE_FMRIPREP_DOCKER = r'''#!{python}
+import os, time
+time.sleep(float(os.environ.get('BENCHMARK_LATENCY', '0')))
+'''
+
+
+def install_fake_tools(bin_dir):
+    """ Writes the fake executables to bin_dir and puts it first on the PATH """
+
+    os.makedirs(bin_dir, exist_ok=True)
+    for name, source in (('dcm2niix', FAKE_DCM2NIIX), ('bsub', FAKE_BSUB), ('bjobs', FAKE_BJOBS),
+                         ('fmriprep-docker', FAKE_FMRIPREP_DOCKER)):
+        path = f'{bin_dir}/{name}'
+        with open(path, 'w') as f:
+            f.write(source.format(python=sys.executable))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    os.environ['PATH'] = f'{bin_dir}{os.pathsep}{os.environ["PATH"]}'
+
+
+def generate_dicom_tree(dicom_dir, n_subjects, runs, echoes, files_per_series):
+    """
+    Creates a synthetic DICOM directory tree.
+
+    Parameters:
+    dicom_dir (str): Directory to create the tree in
+    n_subjects (int): Number of subject folders
+    runs (int): Number of functional runs per subject
+    echoes (int): Number of echoes per run (1 for single echo data)
+    files_per_series (int): Number of (empty) DICOM files per series folder
+
+    Returns:
+    list: Subject IDs
+
+    """
+
+    subs = [f'{number:04d}' for number in range(1, n_subjects + 1)]
+    series = ['anat'] + [f'func_run{run}_echo{echo}' for run in range(1, runs + 1) for echo in range(1, echoes + 1)]
+    for sub in subs:
+        for name in series:
+            os.makedirs(f'{dicom_dir}/{sub}/{name}')
+            for number in range(files_per_series):
+                open(f'{dicom_dir}/{sub}/{name}/IM{number:05d}.dcm', 'wb').close()
+    return subs
+
+
+def run_scenario(work_dir, n_subjects, multiecho, args):
+    """ Times the full pipeline for one scenario and returns its result record """
+
+    echoes = args.echoes if multiecho else 1
+    dicom_dir = f'{work_dir}/dicoms'
+    bids_root = f'{work_dir}/bids_root'
+    progress_dir = f'{work_dir}/progress'
+    subs = generate_dicom_tree(dicom_dir, n_subjects, args.runs, echoes, args.files_per_series)
+
+    if multiecho:
+        func = [[f'*run{run}_echo{echo}' for echo in range(1, echoes + 1)] for run in range(1, args.runs + 1)]
+    else:
+        func = [f'*run{run}_echo1' for run in range(1, args.runs + 1)]
+
+    timings = {}
+    start = time.time()
+    bp.create_bids_root(bids_root)
+    timings['create_bids_root'] = time.time() - start
+
+    start = time.time()
+    summary = bp.build_dataset(dicom_dir, subs, 'anat', func, 'bench', bids_root, multiecho=multiecho,
+                               jobs=args.jobs, progress_dir=progress_dir, verify=args.verify)
+    timings['build_dataset'] = time.time() - start
+
+    # Split the conversion into dcm2niix time and everything the module does around it
+    stages = {}
+    with open(f'{progress_dir}/events.jsonl') as f:
+        for line in f:
+            event = json.loads(line)
+            stages[event['stage']] = stages.get(event['stage'], 0) + event['duration']
+
+    minerva_options = {
+        'image_location': work_dir,
+        'batch_dir': f'{work_dir}/batch_dir',
+        'project_dir': work_dir,
+    }
+    pipeline = bp.FmriprepSingularityPipeline(subs, bids_root, f'{work_dir}/output', minerva_options, multiecho=multiecho)
+    start = time.time()
+    pipeline.create_singularity_batch()
+    timings['create_singularity_batch'] = time.time() - start
+    start = time.time()
+    pipeline.run_singularity_batch(subs, delay=0)
+    timings['run_singularity_batch'] = time.time() - start
+
+    array_pipeline = bp.FmriprepSingularityPipeline(subs, bids_root, f'{work_dir}/output',
+                                                    dict(minerva_options, batch_dir=f'{work_dir}/array_dir'), multiecho=multiecho)
+    start = time.time()
+    array_pipeline.create_singularity_batch(array=True)
+    array_pipeline.run_singularity_batch(subs)
+    timings['array_batch'] = time.time() - start
+
+    # Supervised submission of a packed batch, with every job finishing before the next poll
+    packed_pipeline = bp.FmriprepSingularityPipeline(subs, bids_root, f'{work_dir}/output',
+                                                     dict(minerva_options, batch_dir=f'{work_dir}/packed_dir'), multiecho=multiecho)
+    packed_pipeline.create_singularity_batch(pack=4)
+    os.environ['BENCHMARK_JOBS'] = f'{work_dir}/jobs'
+    start = time.time()
+    final = packed_pipeline.supervise_batch(subs, target=args.target, poll=0)
+    timings['supervise_batch'] = time.time() - start
+    del os.environ['BENCHMARK_JOBS']
+
+    # Local fmriprep-docker containers packed into a CPU and memory budget
+    start = time.time()
+    docker = bp.run_fmriprep_docker_parallel(bids_root, f'{work_dir}/docker_output', f'{work_dir}/license.txt', subs,
+                                             nthreads=4, mem_mb=16000, total_cpus=args.docker_cpus,
+                                             total_mem_mb=args.docker_cpus * 4000)
+    timings['fmriprep_docker_parallel'] = time.time() - start
+
+    return {
+        'scenario': f'{"multiecho" if multiecho else "singleecho"}-{n_subjects}',
+        'subjects': n_subjects,
+        'multiecho': multiecho,
+        'series_per_subject': 1 + args.runs * echoes,
+        'failed': len(summary['failed']),
+        'supervise_failed': sum(entry['status'] != 'done' for entry in final.values()),
+        'docker_failed': sum(result['returncode'] != 0 for result in docker.values()),
+        'timings': timings,
+        'stages': stages,
+        'overhead': timings['build_dataset'] - stages.get('dcm2niix', 0) / args.jobs,
+    }
+
+
+def compare(results, baseline_path):
+    """ Prints the timing ratio of every scenario against a previous results file """
+
+    with open(baseline_path) as f:
+        baseline = {record['scenario']: record for record in json.load(f)['results']}
+    print(f'{"scenario":<22} {"timing":<26} {"baseline s":>10} {"new s":>10} {"ratio":>7}')
+    for record in results:
+        old = baseline.get(record['scenario'])
+        if old is None:
+            continue
+        for name, seconds in list(record['timings'].items()) + [('overhead', record['overhead'])]:
+            previous = old['timings'].get(name) if name != 'overhead' else old.get('overhead')
+            if previous:
+                print(f'{record["scenario"]:<22} {name:<26} {previous:>10.3f} {seconds:>10.3f} {seconds / previous:>7.2f}')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the bids_pythonic orchestration with fake external tools')
+    parser.add_argument('--subjects', type=int, nargs='+', default=[1, 100, 1000], help='Numbers of subjects to benchmark')
+    parser.add_argument('--modes', nargs='+', default=['singleecho', 'multiecho'], choices=['singleecho', 'multiecho'])
+    parser.add_argument('--runs', type=int, default=2, help='Functional runs per subject')
+    parser.add_argument('--echoes', type=int, default=4, help='Echoes per run for multiecho scenarios')
+    parser.add_argument('--files-per-series', type=int, default=10, help='DICOM files per series folder')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds each fake tool call takes')
+    parser.add_argument('--jobs', type=int, default=1, help='Workers used by build_dataset')
+    parser.add_argument('--target', type=int, default=20, help='Jobs kept queued by supervise_batch')
+    parser.add_argument('--docker-cpus', type=int, default=16, help='CPU budget of run_fmriprep_docker_parallel (4000 MB each)')
+    parser.add_argument('--verify', action='store_true', help='Verify the NIFTI headers after conversion')
+    parser.add_argument('--output', default='benchmark_results.json', help='Results file to write')
+    parser.add_argument('--compare', help='Previous results file to compare against')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary directories')
+    args = parser.parse_args()
+
+    # Keep the module's per-stage logging out of the measurements
+    logging.disable(logging.ERROR)
+
+    base_dir = tempfile.mkdtemp(prefix='fmriprep_benchmark_')
+    install_fake_tools(f'{base_dir}/bin')
+    os.environ['BENCHMARK_LATENCY'] = str(args.latency)
+
+    try:
+        commit = subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+
+    results = []
+    for mode in args.modes:
+        for n_subjects in args.subjects:
+            work_dir = f'{base_dir}/{mode}-{n_subjects}'
+            record = run_scenario(work_dir, n_subjects, mode == 'multiecho', args)
+            results.append(record)
+            print(f'{record["scenario"]:<22} build {record["timings"]["build_dataset"]:8.3f} s  '
+                  f'overhead {record["overhead"]:8.3f} s  failed {record["failed"]}')
+            if not args.keep:
+                shutil.rmtree(work_dir)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'timestamp': datetime.datetime.now().isoformat(),
+            'commit': commit,
+            'python': platform.python_version(),
+            'parameters': vars(args),
+            'results': results,
+        }, f, indent=2)
+
+    if args.compare:
+        compare(results, args.compare)
+    if not args.keep:
+        shutil.rmtree(base_dir)
@@ -3,8 +3,25 @@
 # Date: Feb 20, 2020
 
 import json
+import io
 import os, glob, shutil
+import hashlib
+import functools
+import re
+import struct
+import gzip
+import math
+import copy
+import sqlite3
+import argparse
+import asyncio
+import signal
 import subprocess
+import heapq
+import concurrent.futures
+import tempfile
+import threading
+import fnmatch
 import logging
 import datetime
 import time
@@ -14,6 +31,12 @@ import sys
 if sys.version_info[0] < 3:
     raise Exception("Must be using Python 3")
 
+# NumPy is only needed by the stages that process fmriprep outputs
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 def create_bids_root(bids_root, description="This is a default description"):
     """ 
@@ -55,317 +78,3347 @@ def create_bids_root(bids_root, description="This is a default description"):
         print('Root exists! Not overwriting.')
 
 
-class SetupBIDSPipeline(object):
+# DICOM data elements read by read_dicom_header(), with their value representations
+# The VR is needed to decode files written with implicit VR transfer syntax
+DICOM_TAGS = {
+    'ImageType': ((0x0008, 0x0008), 'CS'),
+    'EchoTime': ((0x0018, 0x0081), 'DS'),
+    'SeriesInstanceUID': ((0x0020, 0x000E), 'UI'),
+    'SeriesNumber': ((0x0020, 0x0011), 'IS'),
+    'InstanceNumber': ((0x0020, 0x0013), 'IS'),
+    'NumberOfTemporalPositions': ((0x0020, 0x0105), 'IS'),
+    'ImagesInAcquisition': ((0x0020, 0x1002), 'IS'),
+    'NumberOfFrames': ((0x0028, 0x0008), 'IS'),
+    'Rows': ((0x0028, 0x0010), 'US'),
+    'Columns': ((0x0028, 0x0011), 'US'),
+}
+
+# Explicit VRs that are followed by two reserved bytes and a 4 byte length
+_LONG_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+
+
+def _read_element_header(f, explicit):
+    # Returns (tag, vr, length) of the next data element, or None at the end of the file
+    head = f.read(8)
+    if len(head) < 8:
+        return None
+    group, element = struct.unpack('<HH', head[:4])
+    # Items and delimiters never carry a VR
+    if group == 0xFFFE or not explicit:
+        return (group, element), None, struct.unpack('<I', head[4:])[0]
+    vr = head[4:6]
+    if vr in _LONG_VRS:
+        return (group, element), vr.decode('latin-1'), struct.unpack('<I', f.read(4))[0]
+    return (group, element), vr.decode('latin-1'), struct.unpack('<H', head[6:])[0]
+
+
+def _skip_undefined_length(f, explicit):
+    # Skips a sequence (or item) of undefined length, including nested sequences
+    while True:
+        header = _read_element_header(f, explicit)
+        if header is None or header[0] in ((0xFFFE, 0xE0DD), (0xFFFE, 0xE00D)):
+            return
+        if header[2] == 0xFFFFFFFF:
+            _skip_undefined_length(f, explicit)
+        elif header[0] != (0xFFFE, 0xE000):
+            f.seek(header[2], 1)
+
+
+def _decode_dicom_value(raw, vr):
+    numeric = {'US': 'H', 'SS': 'h', 'UL': 'I', 'SL': 'i', 'FL': 'f', 'FD': 'd'}
+    if vr in numeric:
+        values = struct.unpack(f'<{len(raw) // struct.calcsize(numeric[vr])}{numeric[vr]}', raw)
+        return values[0] if len(values) == 1 else list(values)
+    if vr in ('OB', 'OW', 'UN', None):
+        return raw
+    text = raw.decode('ascii', errors='replace').strip('\x00 ')
+    if vr in ('IS', 'DS'):
+        cast = int if vr == 'IS' else float
+        values = [cast(float(v)) if vr == 'IS' else cast(v) for v in text.split('\\') if v.strip()]
+        return values[0] if len(values) == 1 else values
+    return text
+
+
+def read_dicom_header(path, names):
     """ 
-    Setup instance with class methods to create BIDS formatted directory structure.
+    Reads selected data elements from a DICOM file without touching the pixel data.
+    Parsing stops at the last requested element, so usually only the first few KB of the file are read.
   
-    This class generates the BIDS formatted directory structure.
-    Note that the following methods must be run sequentially for successful BIDS directory creation:
-    1. validate()
-    2. create_bids_hierarchy()
-    3. convert()
-    4. update_json()
+    Parameters: 
+    path (str): Path to a DICOM file
+    names (list): Keys of DICOM_TAGS to read (e.g. ['SeriesInstanceUID'])
+  
+    Returns: 
+    dict: Decoded values of the requested elements that are present in the file
+  
+    """
 
-    The bids_pythonic.create_bids_root() method MUST be run before using this class.
+    wanted = {DICOM_TAGS[name][0]: (name, DICOM_TAGS[name][1]) for name in names}
+    last = max(wanted)
+    values = {}
+    with open(path, 'rb') as f:
+        # Part 10 files have a 128 byte preamble and the 'DICM' prefix followed by explicit VR file meta
+        # Files without it are assumed to be implicit VR little endian
+        explicit = f.read(132)[128:] == b'DICM'
+        dataset_explicit = explicit
+        if not explicit:
+            f.seek(0)
+        while True:
+            header = _read_element_header(f, explicit)
+            if header is None:
+                break
+            tag, vr, length = header
+            # Switch to the dataset transfer syntax once the file meta group ends
+            if tag[0] != 0x0002 and explicit != dataset_explicit:
+                f.seek(-8 if vr is None or vr.encode('latin-1') not in _LONG_VRS else -12, 1)
+                explicit = dataset_explicit
+                continue
+            if tag[0] != 0x0002 and (tag > last or tag >= (0x7FE0, 0x0010)):
+                break
+            if length == 0xFFFFFFFF:
+                _skip_undefined_length(f, explicit)
+            elif tag == (0x0002, 0x0010):
+                dataset_explicit = f.read(length).strip(b'\x00 ') != b'1.2.840.10008.1.2'
+            elif tag in wanted:
+                name, known_vr = wanted[tag]
+                values[name] = _decode_dicom_value(f.read(length), vr or known_vr)
+            else:
+                f.seek(length, 1)
+    return values
+
+
+def preflight_series(series_dir):
+    """ 
+    Checks a DICOM series folder for missing or inconsistent files by reading only the DICOM headers.
+  
+    Parameters: 
+    series_dir (str): Path to a DICOM series folder
+  
+    Returns: 
+    dict: Summary with 'files', 'dimensions' (distinct [rows, columns]), 'echo_times' (distinct EchoTimes),
+        'slices', 'volumes' (None if unknown), 'expected_files' (None if unknown) and 'issues' (list of messages)
   
     """
-    
-    def __init__(self, dicom_dir, name, anat, func, task, root, 
-        multiecho=False, ignore=False, overwrite=False, progress_dir=f'{os.getcwd()}/fpprogress/'):
+
+    names = ['ImageType', 'EchoTime', 'InstanceNumber', 'NumberOfTemporalPositions', 'ImagesInAcquisition',
+             'NumberOfFrames', 'Rows', 'Columns']
+    headers, unreadable = [], 0
+    with os.scandir(series_dir) as entries:
+        for entry in entries:
+            if not entry.is_file() or entry.name.startswith('.'):
+                continue
+            try:
+                header = read_dicom_header(entry.path, names)
+            except (OSError, struct.error, ValueError):
+                header = {}
+            if 'Rows' in header:
+                headers.append(header)
+            else:
+                unreadable += 1
+
+    issues = []
+    if unreadable:
+        issues.append(f'{unreadable} files are not readable DICOM images')
+    dimensions = sorted(set((header['Rows'], header.get('Columns')) for header in headers))
+    if len(dimensions) > 1:
+        issues.append(f'inconsistent image dimensions {dimensions}')
+    echo_times = sorted(set(header['EchoTime'] for header in headers if isinstance(header.get('EchoTime'), float)))
+
+    # Missing slices show up as gaps in the instance numbers
+    instances = [header['InstanceNumber'] for header in headers if isinstance(header.get('InstanceNumber'), int)]
+    if len(instances) == len(headers) and instances:
+        if len(set(instances)) != len(instances):
+            issues.append(f'{len(instances) - len(set(instances))} duplicate instance numbers')
+        missing = max(instances) - min(instances) + 1 - len(set(instances))
+        if missing:
+            issues.append(f'{missing} instance numbers missing between {min(instances)} and {max(instances)}')
+
+    # Mosaic and multi-frame files hold a whole volume (or series) each, other files hold one slice
+    first = headers[0] if headers else {}
+    image_type = first.get('ImageType') or ''
+    slices = first.get('ImagesInAcquisition') if isinstance(first.get('ImagesInAcquisition'), int) else None
+    temporal = first.get('NumberOfTemporalPositions') if isinstance(first.get('NumberOfTemporalPositions'), int) else None
+    frames = first.get('NumberOfFrames') if isinstance(first.get('NumberOfFrames'), int) else 1
+    expected = volumes = None
+    if 'MOSAIC' in image_type:
+        volumes = len(headers)
+    elif frames > 1:
+        volumes = temporal or (frames // slices if slices else None)
+    elif slices:
+        if temporal:
+            expected = slices * temporal
+        elif len(headers) % slices:
+            issues.append(f'{len(headers)} images are not a multiple of {slices} slices')
+        volumes = temporal or len(headers) // slices
+    if expected is not None and expected != len(headers):
+        issues.append(f'expected {expected} images ({slices} slices x {temporal} volumes), found {len(headers)}')
+
+    return {
+        'files': len(headers) + unreadable,
+        'dimensions': [list(dimension) for dimension in dimensions],
+        'echo_times': echo_times,
+        'slices': slices,
+        'volumes': volumes,
+        'expected_files': expected,
+        'issues': issues,
+    }
+
+
+def preflight_echoes(summaries):
+    """ 
+    Checks that the echo series of one multi-echo run belong together.
+  
+    Parameters: 
+    summaries (list): preflight_series() results of all echoes of a run, in echo order
+  
+    Returns: 
+    list: Messages for mismatched volume counts or echo times (empty if the echoes are consistent)
+  
+    """
+
+    issues = []
+    volumes = [summary['volumes'] for summary in summaries]
+    if None not in volumes and len(set(volumes)) > 1:
+        issues.append(f'echoes have different volume counts {volumes}')
+    echo_times = [summary['echo_times'] for summary in summaries]
+    if any(len(times) != 1 for times in echo_times):
+        issues.append(f'every echo series must have exactly one EchoTime, found {echo_times}')
+    elif len(set(times[0] for times in echo_times)) != len(echo_times):
+        issues.append(f'echoes share an EchoTime {[times[0] for times in echo_times]}')
+    return issues
+
+
+@functools.lru_cache(maxsize=None)
+def dcm2niix_version():
+    """ Returns the version string reported by the installed dcm2niix, or 'unknown' """
+
+    try:
+        process = subprocess.run(['dcm2niix', '-h'], capture_output=True, text=True)
+    except OSError:
+        return 'unknown'
+    match = re.search(r'version\s+(\S+)', process.stdout)
+    return match.group(1) if match else 'unknown'
+
+
+def series_fingerprint(series_dir, uid=False):
+    """ 
+    Fingerprints a DICOM series folder from the names, sizes and modification times of its files.
+  
+    Parameters: 
+    series_dir (str): Path to a DICOM series folder
+    uid (bool): Also include the SeriesInstanceUID read from the first DICOM file
+  
+    Returns: 
+    str: Hex digest that changes whenever a file of the series is added, removed or rewritten
+  
+    """
+
+    listing = sorted((entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+                     for entry in os.scandir(series_dir) if entry.is_file())
+    digest = hashlib.sha256(json.dumps(listing).encode())
+    if uid and listing:
+        try:
+            series_uid = read_dicom_header(f'{series_dir}/{listing[0][0]}', ['SeriesInstanceUID']).get('SeriesInstanceUID', '')
+        except (OSError, struct.error):
+            series_uid = ''
+        digest.update(series_uid.encode())
+    return digest.hexdigest()
+
+
+class ConversionCache(object):
+    """ 
+    Persistent cache of dcm2niix outputs, keyed on a fingerprint of the input DICOM series.
+
+    Each entry holds the NIFTI and JSON produced for one series. Unchanged series are restored
+    into the BIDS directory with a hardlink (or a copy across filesystems) instead of running dcm2niix again.
+    The cached files should never be edited in place: JSON sidecars are always copied out of the cache,
+    because update_json() rewrites them.
+  
+    """
+
+    def __init__(self, cache_dir, uid=False):
         """ 
-        Constructs the necessary attributes for the SetupBIDSPipeline instance. 
+        Constructs the necessary attributes for the ConversionCache instance. 
       
         Parameters: 
-        dicom_dir (str): Root path of all DICOMs
-        name (str): subject ID
-        anat (str): Regex expression of path to anatomical DICOMs within the root DICOM directory
-        func (str): List of regex expressions of paths to function DICOMs within the root DICOM directory
-        task (str): Name of functional MRI task
-        root (str): Path to BIDS root that will be created
-        multiecho (bool): Flag to specify if functional data is multi-echo
-        ignore (bool): Flag to ignore warning if subject already exists
-        overwrite (bool): Flag to remove subject folder if it exists
-        progress_dir (str): Path to progress directory to store logging file (TBD)
+        cache_dir (str): Path to the cache directory (created if it doesn't exist)
+        uid (bool): Include the SeriesInstanceUID of each series in its fingerprint
       
         Returns: 
-        obj: SetupBIDSPipeline instance 
+        obj: ConversionCache instance 
       
         """
 
-        ### Create the fmriprepPipeline progress directory if it doesn't exist 
-        ### This folder holds the current progress 
-        # if not os.path.exists(progress_dir):
-        #     os.makedirs(progress_dir)
-        # self.progress_dir = progress_dir
+        self.cache_dir = cache_dir
+        self.uid = uid
+        os.makedirs(cache_dir, exist_ok=True)
 
-        # Configure logging options
-        x = datetime.datetime.now()
-        timestamp = x.strftime("%m-%d_%H%M")
-        #self.logfile = f'{self.progress_dir}/log_{timestamp}.txt'
-        logging.basicConfig(format='%(module)s - %(asctime)s - %(levelname)s - %(message)s', level=logging.DEBUG)
+    def key(self, series_dir, flags):
+        """ Returns the cache key of a DICOM series converted with the given dcm2niix flags """
 
+        fingerprint = series_fingerprint(series_dir, uid=self.uid)
+        return hashlib.sha256(json.dumps([fingerprint, dcm2niix_version(), flags]).encode()).hexdigest()
 
-        # Pdict variable contains all the major variables for BIDS folder setup
-        # Field         |           value                                               |
-        #-------------------------------------------------------------------------------|
-        # name          |   ID of participant                                           |
-        # anat          |   Name of anatomical DICOM folder in parent DICOM folder      |
-        # func          |   List of functional DICOM folder names in parent DICOM folder|
-        # task          |   Name of task                                                |
-        # multiecho     |   Flag for multi-echo data                                    |
-        # overwrite     |   Delete and overwrite subject folder if it exists            | 
-        # ignore        |   Ignore warning if subject folder exists during validation   |
+    def _entry(self, key):
+        return f'{self.cache_dir}/{key[:2]}/{key}'
 
-        # Note that for func, if the data is single echo, there is a array of runs
-        # and for multiecho data it is an array of arrays of echoes for each run
+    def _outputs(self, key):
+        # Maps output suffix (e.g. '.nii', '.json') to the cached file
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            return {}
+        return {filename[len('series'):]: f'{entry}/{filename}' for filename in os.listdir(entry)}
 
-        # Uses glob to match wildcards, but throws error if there are multiple matches
-        self.pdict = {}
-        self.pdict['root'] = root
-        self.pdict['task'] = task
-        self.pdict['multiecho'] = multiecho
+    def is_current(self, key, out_dir, name):
+        """ Checks whether the BIDS NIFTI for name already is the cached output for key """
 
-        # Use strip 'sub-' from name if it exists
-        # The 'sub-' will be added later for BIDS formatting
-        if name.startswith('sub-'):
-            self.pdict['name'] = name[4:]
-        else:
-            self.pdict['name'] = name
-        
-        # Wildcard matching for anatomical dicom directory name
-        match = glob.glob(f"{dicom_dir}/{name}/{anat}/")
-        if len(match) ==1:
-            logging.info(f'{anat} has a match: {match[0]}')
-            self.pdict['anat'] = match[0]
-        else:
-            logging.error(f'{anat} has zero/multiple matches!\nOutput of glob: {match}\nPlease fix your wildcards.')
-            raise OSError(f'{anat} has zero/multiple matches!\nOutput of glob: {match}\nPlease fix your wildcards.')
-        
-        # Wildcard matching for function dicom directory name
-        self.pdict['func'] = []
-        if not multiecho:
-            for one_func in func:
-                match = glob.glob(f"{dicom_dir}/{name}/{one_func}/")
-                if len(match) ==1:
-                    logging.info(f'{one_func} has a match: {match[0]}')
-                    self.pdict['func'].append(match[0])
-                else:
-                    logging.error(f'{one_func} has zero/multiple matches!\nOutput of glob: {match}\nPlease fix your wildcards.')
-                    raise OSError(f'{one_func} has zero/multiple matches!\nOutput of glob: {match}\nPlease fix your wildcards.')
-        elif multiecho:
-            for run in func:
-                run_arr = []
-                for one_func in run:
-                    match = glob.glob(f"{dicom_dir}/{name}/{one_func}/")
-                    if len(match) ==1:
-                        logging.info(f'{one_func} has a match: {match[0]}')
-                        run_arr.append(match[0])
+        cached = self._outputs(key)
+        for suffix, path in cached.items():
+            if suffix == '.json':
+                continue
+            target = f'{out_dir}/{name}{suffix}'
+            if not os.path.exists(target):
+                return False
+            target_stat, cached_stat = os.stat(target), os.stat(path)
+            if (target_stat.st_size, target_stat.st_mtime_ns) != (cached_stat.st_size, cached_stat.st_mtime_ns):
+                return False
+        return bool(cached)
+
+    def restore(self, key, out_dir, name):
+        """ 
+        Restores the cached outputs for key into out_dir under the BIDS name.
+      
+        Returns: 
+        bool: True if the series was found in the cache
+      
+        """
+
+        cached = self._outputs(key)
+        # The NIFTI is restored last, so its presence marks a finished conversion
+        for suffix in sorted(cached, key=lambda suffix: suffix != '.json'):
+            target = f'{out_dir}/{name}{suffix}'
+            temp = f'{out_dir}/.{name}{suffix}.restore'
+            if suffix == '.json':
+                shutil.copy2(cached[suffix], temp)
+            else:
+                try:
+                    os.link(cached[suffix], temp)
+                except OSError:
+                    shutil.copy2(cached[suffix], temp)
+            os.replace(temp, target)
+        return bool(cached)
+
+    def store(self, key, out_dir, name):
+        """ Adds the freshly converted outputs for name in out_dir to the cache under key """
+
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=f'.{key}.', dir=os.path.dirname(entry))
+        for path in glob.glob(f'{out_dir}/{glob.escape(name)}.*'):
+            suffix = os.path.basename(path)[len(name):]
+            if suffix == '.json':
+                shutil.copy2(path, f'{staging}/series{suffix}')
+            else:
+                try:
+                    os.link(path, f'{staging}/series{suffix}')
+                except OSError:
+                    shutil.copy2(path, f'{staging}/series{suffix}')
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            # Another worker stored the same series first
+            shutil.rmtree(staging, ignore_errors=True)
+
+
+class DicomIndex(object):
+    """ 
+    Index of a DICOM directory: subject folder -> series folders, with their file counts (and sizes, read on request).
+
+    Each subject folder is listed with os.scandir once and then answered from memory, which avoids one
+    glob walk per wildcard on network storage. The index can be saved to disk and reused across runs;
+    a subject is rescanned only if the modification time of its folder or one of its series folders changed.
+  
+    """
+
+    def __init__(self, dicom_dir, index_file=None):
+        """ 
+        Constructs the necessary attributes for the DicomIndex instance. 
+      
+        Parameters: 
+        dicom_dir (str): Root path of all DICOMs
+        index_file (str): Path to a JSON file to load the index from and save it to (optional)
+      
+        Returns: 
+        obj: DicomIndex instance 
+      
+        """
+
+        self.dicom_dir = dicom_dir
+        self.index_file = index_file
+        self.subjects = {}
+        self._checked = set()
+        self._lock = threading.Lock()
+
+        if index_file and os.path.isfile(index_file):
+            # A truncated or corrupt index is rebuilt by scanning the subject folders again
+            try:
+                with open(index_file) as f:
+                    saved = json.load(f)
+                if saved.get('dicom_dir') == dicom_dir:
+                    self.subjects = saved['subjects']
+            except (OSError, ValueError, KeyError, AttributeError) as e:
+                logging.warning(f'Ignoring unreadable DICOM index {index_file}: {e}')
+                self.subjects = {}
+
+    def _scan_subject(self, name):
+        # One listing of the subject folder, plus one listing per series folder for file counts
+        # (sizes need a stat of every file and are only read on request, see size())
+        subject_dir = f'{self.dicom_dir}/{name}'
+        entry = {'mtime_ns': os.stat(subject_dir).st_mtime_ns, 'series': {}}
+        with os.scandir(subject_dir) as series_entries:
+            for series in series_entries:
+                if not series.is_dir():
+                    continue
+                with os.scandir(series.path) as files:
+                    count = sum(1 for f in files if f.is_file())
+                entry['series'][series.name] = {
+                    'mtime_ns': series.stat().st_mtime_ns,
+                    'files': count,
+                }
+        return entry
+
+    def _is_fresh(self, name):
+        # Compares saved modification times with the subject and series folders on disk
+        entry = self.subjects.get(name)
+        if entry is None:
+            return False
+        try:
+            if os.stat(f'{self.dicom_dir}/{name}').st_mtime_ns != entry['mtime_ns']:
+                return False
+            for series, info in entry['series'].items():
+                if os.stat(f'{self.dicom_dir}/{name}/{series}').st_mtime_ns != info['mtime_ns']:
+                    return False
+        except OSError:
+            return False
+        return True
+
+    def series(self, name):
+        """ 
+        Returns the indexed series folders of a subject, scanning the subject folder if needed.
+      
+        Parameters: 
+        name (str): Name of the subject folder within the DICOM directory
+      
+        Returns: 
+        dict: Series folder name -> {'files': file count, 'mtime_ns': modification time}, plus 'bytes' once size() was called
+      
+        """
+
+        with self._lock:
+            if name not in self._checked:
+                if not self._is_fresh(name):
+                    if os.path.isdir(f'{self.dicom_dir}/{name}'):
+                        self.subjects[name] = self._scan_subject(name)
                     else:
-                        logging.error(f'{one_func} has zero/multiple matches!\nOutput of glob: {match}\nPlease fix your wildcards.')
-                        raise OSError(f'{one_func} has zero/multiple matches!\nOutput of glob: {match}\nPlease fix your wildcards.')
-                self.pdict['func'].append(run_arr)
+                        self.subjects.pop(name, None)
+                self._checked.add(name)
+            return self.subjects.get(name, {'series': {}})['series']
 
-        self.pdict['overwrite'] = overwrite
-        self.pdict['ignore'] = ignore
+    def build(self, subs=None, jobs=1):
+        """ 
+        Indexes all (or the given) subject folders in one pass and saves the index if an index_file was given.
+      
+        Parameters: 
+        subs (list): Subject folder names to index. Defaults to every folder in the DICOM directory
+        jobs (int): Number of subject folders scanned at the same time
+      
+        """
 
-        # Initialize paths for BIDS-formatted folders and files
-        # anat_path     ->  path to BIDS anat folder
-        # func_path     ->  path to BIDS func folder
-        # anat_name     ->  filename for BIDS anatomical NIFTI
-        # func_name     ->  list of all filenames for BIDS functional NIFTIS
-        self.anat_path = ""
-        self.func_path = ""
-        self.anat_name = ""
-        self.func_name = []
+        if subs is None:
+            with os.scandir(self.dicom_dir) as entries:
+                subs = [entry.name for entry in entries if entry.is_dir()]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            list(pool.map(self.series, subs))
+        self.save()
 
+    def save(self):
+        """ Writes the index to index_file, if one was given """
 
-    def validate(self, multiecho=False):
+        if not self.index_file:
+            return
+        with self._lock:
+            # A unique temporary file in the same folder, so concurrent runs never write into each other's file
+            fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.index_file)),
+                                        prefix=f'.{os.path.basename(self.index_file)}.', suffix='.tmp')
+            try:
+                os.chmod(temp, 0o666 & ~_UMASK)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'dicom_dir': self.dicom_dir, 'subjects': self.subjects}, f)
+                os.replace(temp, self.index_file)
+            except BaseException:
+                if os.path.exists(temp):
+                    os.remove(temp)
+                raise
+
+    def match(self, name, pattern):
         """ 
-        Validates the presence of BIDS root directory and DICOM folders, 
-        and ensures that subject directory doesn't already exist.
+        Matches a wildcard against the series folders of a subject, like glob.glob(f"{dicom_dir}/{name}/{pattern}/")
       
         Parameters: 
-        multiecho (bool): Flag to specify if functional data is multi-echo    
+        name (str): Name of the subject folder within the DICOM directory
+        pattern (str): Wildcard expression for a series folder name
+      
+        Returns: 
+        list: Matching series folder paths, ending with '/'
+      
+        """
+
+        # Nested patterns and wildcard subject names are not indexed
+        if '/' in pattern.strip('/') or glob.has_magic(name):
+            return glob.glob(f"{self.dicom_dir}/{name}/{pattern}/")
+        pattern = pattern.strip('/')
+        return [f"{self.dicom_dir}/{name}/{series}/" for series in sorted(self.series(name))
+                if fnmatch.fnmatchcase(series, pattern) and (pattern.startswith('.') or not series.startswith('.'))]
 
+    def info(self, path):
+        """ Returns the indexed file count and size of a series folder path returned by match(), or None """
+
+        parts = os.path.relpath(path, self.dicom_dir).split(os.sep)
+        if len(parts) != 2:
+            return None
+        return self.series(parts[0]).get(parts[1])
+
+    def size(self, path):
+        """ 
+        Returns the total size of the files in a series folder path returned by match().
+        The size is read once and kept with the indexed series, so it is reused until the series folder changes.
+      
+        Parameters: 
+        path (str): Series folder path
+      
+        Returns: 
+        int: Size in bytes, 0 if the folder does not exist
+      
         """
 
-        logging.info('Validating parameters.....')
+        info = self.info(path)
+        if info is not None and 'bytes' in info:
+            return info['bytes']
+        total = 0
+        try:
+            with os.scandir(path) as files:
+                total = sum(f.stat().st_size for f in files if f.is_file())
+        except OSError:
+            pass
+        if info is not None:
+            with self._lock:
+                info['bytes'] = total
+        return total
 
-        # Validate that BIDS root directory exists!
-        # This directory is created by the 'create_bids_root' function below!
-        if os.path.isdir(self.pdict['root']):
-            logging.info('Root Exists.')
-            self.root_exists = True
-        else:
-            logging.error('Root does not exist!')
-            raise OSError('Root does not exist!')
-        
-        # Check if the subject folder already exists, and will throw an error if it does
-        # If overwrite is on, the subject folder will be deleted
-        # If ignore is on, the analysis will proceed even if the subject folder exists
-        if os.path.isdir(f'{self.pdict["root"]}/sub-{self.pdict["name"]}'):
-            if self.pdict['overwrite']:
-                logging.warning(f'Overwrite option selected! Removing subject {self.pdict["name"]}')
-                shutil.rmtree(f'{self.pdict["root"]}/sub-{self.pdict["name"]}')
-            elif self.pdict['ignore']:
-                logging.error(f"{self.pdict['name']}' exists! Continuing forward (risky).")
-            else:
-                logging.error(f"{self.pdict['name']}' exists! Try a different subject name, or ignore/delete existing folder.")
-                raise OSError(f"'{self.pdict['name']}' exists! Try a different subject name, or ignore/delete existing folder.")
+    def preflight(self, path):
+        """ 
+        Returns preflight_series() of a series folder path returned by match().
+        The result is kept with the indexed series, so it is reused until the series folder changes.
+      
+        """
+
+        info = self.info(path)
+        if info is None:
+            return preflight_series(path)
+        if 'preflight' not in info:
+            summary = preflight_series(path)
+            with self._lock:
+                info['preflight'] = summary
+        return info['preflight']
+
+    def isdir(self, path):
+        """ Checks whether a series folder path returned by match() exists, using the index when possible """
+
+        relative = os.path.relpath(path, self.dicom_dir)
+        parts = relative.split(os.sep)
+        if len(parts) == 2 and parts[0] in self._checked:
+            return parts[1] in self.series(parts[0])
+        return os.path.isdir(path)
+
+
+def find_nifti(directory, name):
+    """ Returns the path of the .nii or .nii.gz file for a BIDS name in directory, or None if neither exists """
+
+    for extension in ('.nii', '.nii.gz'):
+        if os.path.exists(f'{directory}/{name}{extension}'):
+            return f'{directory}/{name}{extension}'
+    return None
+
+
+def compress_nifti(path, level=6):
+    """ 
+    Gzips a .nii file into path + '.gz' and removes the uncompressed file.
+    The compressed file is written under a temporary name first, so it never exists half-written.
+  
+    Parameters: 
+    path (str): Path to a .nii file
+    level (int): gzip compression level (1 = fastest, 9 = smallest)
+  
+    Returns: 
+    str: Path to the .nii.gz file
+  
+    """
+
+    temp = f'{os.path.dirname(path)}/.{os.path.basename(path)}.gz.tmp'
+    with open(path, 'rb') as source, gzip.open(temp, 'wb', compresslevel=level) as target:
+        shutil.copyfileobj(source, target, 2**22)
+    os.replace(temp, f'{path}.gz')
+    os.remove(path)
+    return f'{path}.gz'
+
+
+# Thread pools shared by all SetupBIDSPipeline instances for compression='post', keyed by size
+# zlib releases the GIL while compressing, so threads compress in parallel
+_COMPRESSION_POOLS = {}
+_COMPRESSION_POOLS_LOCK = threading.Lock()
+
+
+def compression_pool(threads):
+    """ Returns the shared compression thread pool with the given number of threads """
+
+    with _COMPRESSION_POOLS_LOCK:
+        if threads not in _COMPRESSION_POOLS:
+            _COMPRESSION_POOLS[threads] = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        return _COMPRESSION_POOLS[threads]
+
+
+# Process IDs of all running external tools (with their cleanup function or None), so they can be killed on Ctrl-C
+_PROCESSES = {}
+_PROCESSES_LOCK = threading.Lock()
+
+
+async def _run_process(command, log=None, label=None, timeout=None, retries=0, retry_delay=5, stdin=None, env=None,
+                       capture=None, cleanup=None):
+    # Runs one command, streaming its output line by line into the log file (or the logging module)
+    # Every process leads its own process group, so killing it also kills the tools it started
+    capture = log is None if capture is None else capture
+    attempt = 0
+    while True:
+        attempt += 1
+        start = time.time()
+        stdin_file = open(stdin, 'rb') if stdin else asyncio.subprocess.DEVNULL
+        try:
+            process = await asyncio.create_subprocess_exec(*command, stdin=stdin_file, stdout=asyncio.subprocess.PIPE,
+                                                           stderr=asyncio.subprocess.PIPE, env=env, limit=2**20,
+                                                           start_new_session=True)
+        finally:
+            if stdin:
+                stdin_file.close()
+        with _PROCESSES_LOCK:
+            _PROCESSES[process.pid] = cleanup
+
+        output = []
+        log_file = open(log, 'a') if log else None
+        prefix = f'[{label}] ' if label else ''
+
+        async def stream(reader, keep):
+            async for line in reader:
+                text = line.decode(errors='replace')
+                if keep:
+                    output.append(text)
+                if log_file is not None:
+                    log_file.write(prefix + text)
+                    log_file.flush()
+                else:
+                    logging.debug(prefix + text.rstrip())
+
+        timed_out = False
+        try:
+            await asyncio.wait_for(asyncio.gather(stream(process.stdout, capture), stream(process.stderr, False),
+                                                  process.wait()), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            logging.error(f'{label or command[0]} timed out after {timeout} s, killing it')
+            _kill(process.pid, cleanup)
+            await process.wait()
+        except asyncio.CancelledError:
+            # Cancelled (e.g. by Ctrl-C): never leave the child running
+            _kill(process.pid, cleanup)
+            raise
+        finally:
+            with _PROCESSES_LOCK:
+                _PROCESSES.pop(process.pid, None)
+            if log_file is not None:
+                log_file.close()
+
+        result = {
+            'returncode': process.returncode,
+            'stdout': ''.join(output),
+            'timed_out': timed_out,
+            'attempts': attempt,
+            'duration': time.time() - start,
+        }
+        if (timed_out or process.returncode != 0) and attempt <= retries:
+            logging.warning(f'{label or command[0]} failed with code {process.returncode}, retrying ({attempt} of {retries})')
+            await asyncio.sleep(retry_delay * 2 ** (attempt - 1))
+            continue
+        return result
+
+
+def _kill(pid, cleanup=None):
+    # Kills the process group of a tool, then releases what lives outside of it (e.g. a docker container)
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    if cleanup is not None:
+        cleanup()
+
+
+def kill_processes():
+    """ Kills every external tool still started by run_process() or run_processes(), e.g. after Ctrl-C """
+
+    with _PROCESSES_LOCK:
+        processes = list(_PROCESSES.items())
+    for pid, cleanup in processes:
+        _kill(pid, cleanup)
+
+
+# Environment variable that marks the containers started through fmriprep-docker by this module
+_CONTAINER_TAG = 'BIDS_PYTHONIC_RUN'
+
+
+def _docker_tag(command, tag):
+    # Passes the tag into the container, so it can be found again (fmriprep-docker -e/--env)
+    return command + ['--env', _CONTAINER_TAG, tag]
+
+
+def _kill_containers(tag):
+    # The docker daemon, not fmriprep-docker, owns the container, so it outlives the killed wrapper
+    try:
+        ids = subprocess.run(['docker', 'ps', '-q'], capture_output=True, text=True, timeout=60).stdout.split()
+        if not ids:
+            return
+        inspect = subprocess.run(['docker', 'inspect', '--format', '{{.Id}} {{join .Config.Env " "}}'] + ids,
+                                 capture_output=True, text=True, timeout=60).stdout
+        matches = [line.split()[0] for line in inspect.splitlines() if f'{_CONTAINER_TAG}={tag}' in line.split()[1:]]
+        if matches:
+            logging.warning(f'Killing docker containers {matches} of {tag}')
+            subprocess.run(['docker', 'kill'] + matches, capture_output=True, timeout=60)
+    except (OSError, subprocess.TimeoutExpired) as err:
+        logging.error(f'Could not kill the docker containers of {tag}: {err}')
+
+
+def _run_sync(coroutine):
+    # asyncio.run() cannot be nested in an event loop that is already running (e.g. in Jupyter)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coroutine).result()
+
+
+def run_process(command, log=None, label=None, timeout=None, retries=0, retry_delay=5, stdin=None, env=None,
+                capture=None, cleanup=None):
+    """ 
+    Runs an external tool, streaming its stdout and stderr line by line into a log file.
+  
+    Parameters: 
+    command (list): Command and arguments
+    log (str): Log file the output is appended to (defaults to debug messages of the logging module)
+    label (str): Prefix of every log line, e.g. the series or subject name
+    timeout (float): Seconds after which the process is killed (no limit by default)
+    retries (int): Number of reruns after a failure or timeout, waiting retry_delay, 2 * retry_delay, ... seconds
+    retry_delay (float): Seconds to wait before the first rerun
+    stdin (str): Optional file passed as standard input
+    env (dict): Optional environment of the process
+    capture (bool): Keep stdout in the result (by default only when there is no log file)
+    cleanup (callable): Called after the process was killed, e.g. to stop a container it started
+  
+    Returns: 
+    dict: Result with 'returncode', 'stdout' (text, empty unless captured), 'timed_out', 'attempts' and 'duration' (seconds)
+  
+    """
+
+    return _run_sync(_run_process(command, log, label, timeout, retries, retry_delay, stdin, env, capture, cleanup))
+
+
+def run_processes(jobs, concurrency=4):
+    """ 
+    Runs many external tools at the same time. Ctrl-C kills all of them.
+  
+    Parameters: 
+    jobs (list): Keyword arguments of run_process() for every process, e.g. [{'command': [...], 'log': ...}]
+    concurrency (int): Maximum number of processes running at the same time
+  
+    Returns: 
+    list: Results of run_process(), in the order of jobs
+  
+    """
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def run_one(job):
+            async with semaphore:
+                return await _run_process(**job)
+
+        return await asyncio.gather(*(run_one(job) for job in jobs))
+
+    return _run_sync(run_all())
+
+
+class PipelineState(object):
+    """ 
+    Persistent record of completed pipeline stages, stored as SQLite in the progress directory.
+
+    Every subject/stage/series completion is saved with a fingerprint of its inputs, so a rerun can skip
+    finished work without re-checking the filesystem, and dataset progress can be queried without
+    walking the BIDS tree.
+  
+    """
+
+    def __init__(self, progress_dir, wal=False):
+        """ 
+        Constructs the necessary attributes for the PipelineState instance. 
+      
+        Parameters: 
+        progress_dir (str): Path to progress directory (created if it doesn't exist)
+        wal (bool): Use SQLite write-ahead logging, which is faster but only safe when progress_dir is on a local disk
+      
+        Returns: 
+        obj: PipelineState instance 
+      
+        """
+
+        os.makedirs(progress_dir, exist_ok=True)
+        self.path = f'{progress_dir}/state.db'
+        with self._connect() as connection:
+            # Write-ahead logging needs memory shared between processes, which NFS and GPFS don't provide,
+            # so the rollback journal is the default. The mode is stored in the database file.
+            connection.execute(f"PRAGMA journal_mode={'WAL' if wal else 'DELETE'}")
+            connection.execute('''CREATE TABLE IF NOT EXISTS stages (
+                subject TEXT, stage TEXT, series TEXT, fingerprint TEXT, updated REAL,
+                PRIMARY KEY (subject, stage, series))''')
+        connection.close()
+
+    def _connect(self):
+        # A new connection per call keeps the store usable from worker threads and processes
+        return sqlite3.connect(self.path, timeout=60)
+
+    def record(self, subject, stage, series='', fingerprint=None):
+        """ Records that a stage (optionally for one series) of a subject has completed """
+
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO stages VALUES (?,?,?,?,?)',
+                               (subject, stage, series, fingerprint, time.time()))
+        connection.close()
+
+    def is_done(self, subject, stage, series='', fingerprint=None):
+        """ Checks whether a stage has completed, with the same input fingerprint if one is given """
+
+        connection = self._connect()
+        row = connection.execute('SELECT fingerprint FROM stages WHERE subject=? AND stage=? AND series=?',
+                                 (subject, stage, series)).fetchone()
+        connection.close()
+        return row is not None and (fingerprint is None or row[0] == fingerprint)
+
+    def clear(self, subject):
+        """ Forgets all completed stages of a subject """
+
+        with self._connect() as connection:
+            connection.execute('DELETE FROM stages WHERE subject=?', (subject,))
+        connection.close()
+
+    def progress(self):
+        """ 
+        Summarizes the recorded progress of the dataset.
+      
+        Returns: 
+        dict: Subject -> {'stages': completed stage names, 'series': number of converted series, 'updated': last update time}
+      
+        """
+
+        connection = self._connect()
+        rows = connection.execute('SELECT subject, stage, series, updated FROM stages').fetchall()
+        connection.close()
+        summary = {}
+        for subject, stage, series, updated in rows:
+            entry = summary.setdefault(subject, {'stages': [], 'series': 0, 'updated': 0})
+            if series:
+                entry['series'] += 1
+            elif stage not in entry['stages']:
+                entry['stages'].append(stage)
+            entry['updated'] = max(entry['updated'], updated)
+        return summary
+
+
+# Serializes writes to the timing event files of all SetupBIDSPipeline instances
+_EVENTS_LOCK = threading.Lock()
+
+# Permission mask of the process, applied to files created through tempfile.mkstemp
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+class SetupBIDSPipeline(object):
+    """ 
+    Setup instance with class methods to create BIDS formatted directory structure.
+  
+    This class generates the BIDS formatted directory structure.
+    Note that the following methods must be run sequentially for successful BIDS directory creation:
+    1. validate()
+    2. create_bids_hierarchy()
+    3. convert()
+    4. update_json()
+    5. commit() (only needed with a scratch_dir)
+
+    The bids_pythonic.create_bids_root() method MUST be run before using this class.
+  
+    """
+    
+    def __init__(self, dicom_dir, name, anat, func, task, root, 
+        multiecho=False, ignore=False, overwrite=False, progress_dir=None,
+        cache_dir=None, cache_uid=False, index=None, hook=None,
+        compression=None, compress_level=6, compress_threads=4, scratch_dir=None, prefetch=False,
+        timeout=None, retries=0):
+        """ 
+        Constructs the necessary attributes for the SetupBIDSPipeline instance. 
+      
+        Parameters: 
+        dicom_dir (str): Root path of all DICOMs
+        name (str): subject ID
+        anat (str): Regex expression of path to anatomical DICOMs within the root DICOM directory
+        func (str): List of regex expressions of paths to function DICOMs within the root DICOM directory
+        task (str): Name of functional MRI task
+        root (str): Path to BIDS root that will be created
+        multiecho (bool): Flag to specify if functional data is multi-echo
+        ignore (bool): Flag to ignore warning if subject already exists
+        overwrite (bool): Flag to remove subject folder if it exists
+        progress_dir (str): Path to progress directory. If given, timing events of every stage are
+            appended to {progress_dir}/events.jsonl, and completed stages are recorded in a PipelineState
+            so a rerun resumes where it stopped
+        cache_dir (str): Path to a ConversionCache directory shared between subjects and runs (optional)
+        cache_uid (bool): Include the SeriesInstanceUID in the cache fingerprint of each series
+        index (DicomIndex): Index of dicom_dir shared between subjects (optional, built on demand otherwise)
+        hook (callable): Function called with every timing event dictionary, e.g. to forward it to a metrics system
+        compression (str): None for uncompressed .nii output, 'dcm2niix' to let dcm2niix write .nii.gz
+            (multi-threaded if pigz is installed), or 'post' to gzip finished NIFTIs in a thread pool
+            while later series are still converting
+        compress_level (int): gzip compression level (1 = fastest, 9 = smallest)
+        compress_threads (int): Number of threads compressing NIFTIs with compression='post'
+        scratch_dir (str): Local directory to stage the subject in before commit() moves it into the BIDS root
+            (True for $TMPDIR). Nothing is written to the BIDS root unless the whole subject succeeds
+        prefetch (bool): Copy each DICOM series into the scratch directory before converting it
+        timeout (float): Seconds after which a hung dcm2niix process is killed and the series fails
+        retries (int): Number of reruns of a failed or timed out dcm2niix process
+      
+        Returns: 
+        obj: SetupBIDSPipeline instance 
+      
+        """
+
+        start = time.time()
+
+        ### Create the fmriprepPipeline progress directory if it doesn't exist 
+        ### This folder holds the current progress 
+        if progress_dir and not os.path.exists(progress_dir):
+            os.makedirs(progress_dir, exist_ok=True)
+        self.progress_dir = progress_dir
+        self.hook = hook
+        self.state = PipelineState(progress_dir) if progress_dir else None
+
+        # Configure logging options
+        x = datetime.datetime.now()
+        timestamp = x.strftime("%m-%d_%H%M")
+        #self.logfile = f'{self.progress_dir}/log_{timestamp}.txt'
+        logging.basicConfig(format='%(module)s - %(asctime)s - %(levelname)s - %(message)s', level=logging.DEBUG)
+
+
+        # Pdict variable contains all the major variables for BIDS folder setup
+        # Field         |           value                                               |
+        #-------------------------------------------------------------------------------|
+        # name          |   ID of participant                                           |
+        # anat          |   Name of anatomical DICOM folder in parent DICOM folder      |
+        # func          |   List of functional DICOM folder names in parent DICOM folder|
+        # task          |   Name of task                                                |
+        # multiecho     |   Flag for multi-echo data                                    |
+        # overwrite     |   Delete and overwrite subject folder if it exists            | 
+        # ignore        |   Ignore warning if subject folder exists during validation   |
+
+        # Note that for func, if the data is single echo, there is a array of runs
+        # and for multiecho data it is an array of arrays of echoes for each run
+
+        # Uses the DICOM index to match wildcards, but throws error if there are multiple matches
+        self.index = index if index is not None else DicomIndex(dicom_dir)
+        self.pdict = {}
+        self.pdict['root'] = root
+        self.pdict['task'] = task
+        self.pdict['multiecho'] = multiecho
+
+        # Use strip 'sub-' from name if it exists
+        # The 'sub-' will be added later for BIDS formatting
+        if name.startswith('sub-'):
+            self.pdict['name'] = name[4:]
+        else:
+            self.pdict['name'] = name
+        
+        # Wildcard matching for anatomical dicom directory name
+        match = self.index.match(name, anat)
+        if len(match) ==1:
+            logging.info(f'{anat} has a match: {match[0]}')
+            self.pdict['anat'] = match[0]
+        else:
+            logging.error(f'{anat} has zero/multiple matches!\nOutput of glob: {match}\nPlease fix your wildcards.')
+            raise OSError(f'{anat} has zero/multiple matches!\nOutput of glob: {match}\nPlease fix your wildcards.')
+        
+        # Wildcard matching for function dicom directory name
+        self.pdict['func'] = []
+        if not multiecho:
+            for one_func in func:
+                match = self.index.match(name, one_func)
+                if len(match) ==1:
+                    logging.info(f'{one_func} has a match: {match[0]}')
+                    self.pdict['func'].append(match[0])
+                else:
+                    logging.error(f'{one_func} has zero/multiple matches!\nOutput of glob: {match}\nPlease fix your wildcards.')
+                    raise OSError(f'{one_func} has zero/multiple matches!\nOutput of glob: {match}\nPlease fix your wildcards.')
+        elif multiecho:
+            for run in func:
+                run_arr = []
+                for one_func in run:
+                    match = self.index.match(name, one_func)
+                    if len(match) ==1:
+                        logging.info(f'{one_func} has a match: {match[0]}')
+                        run_arr.append(match[0])
+                    else:
+                        logging.error(f'{one_func} has zero/multiple matches!\nOutput of glob: {match}\nPlease fix your wildcards.')
+                        raise OSError(f'{one_func} has zero/multiple matches!\nOutput of glob: {match}\nPlease fix your wildcards.')
+                self.pdict['func'].append(run_arr)
+
+        self.pdict['overwrite'] = overwrite
+        self.pdict['ignore'] = ignore
+
+        # Initialize paths for BIDS-formatted folders and files
+        # anat_path     ->  path to BIDS anat folder
+        # func_path     ->  path to BIDS func folder
+        # anat_name     ->  filename for BIDS anatomical NIFTI
+        # func_name     ->  list of all filenames for BIDS functional NIFTIS
+        self.anat_path = ""
+        self.func_path = ""
+        self.final_anat_path = ""
+        self.final_func_path = ""
+        self.anat_name = ""
+        self.func_name = []
+
+        # Optional cache of dcm2niix outputs keyed on the DICOM series contents
+        self.cache = ConversionCache(cache_dir, uid=cache_uid) if cache_dir else None
+
+        # Optional compression of the NIFTI outputs
+        if compression not in (None, 'dcm2niix', 'post'):
+            raise ValueError(f"Unknown compression '{compression}'! Use None, 'dcm2niix' or 'post'.")
+        self.compression = compression
+        self.compress_level = compress_level
+        self.compress_threads = compress_threads
+        self._compressing = []
+
+        # Optional local staging of the whole subject
+        self.scratch_dir = tempfile.gettempdir() if scratch_dir is True else scratch_dir
+        self.prefetch = prefetch
+        self.stage_dir = None
+
+        # dcm2niix output goes to a log file per subject in the progress directory
+        self.timeout = timeout
+        self.retries = retries
+        self.log = None
+        if progress_dir:
+            os.makedirs(f'{progress_dir}/logs', exist_ok=True)
+            self.log = f"{progress_dir}/logs/sub-{self.pdict['name']}.log"
+
+        # Completed stages are only trusted for the same inputs and settings
+        self.config = hashlib.sha256(json.dumps([dicom_dir, self.pdict['anat'], self.pdict['func'], task, root,
+                                                 multiecho, compression]).encode()).hexdigest()
+
+        self._emit('match', start)
+
+
+    def _emit(self, stage, start, series=None, input_bytes=None, output_bytes=None, returncode=None):
+        # Records a timing event in the progress directory and passes it to the hook
+        if not self.progress_dir and self.hook is None:
+            return
+        event = {
+            'time': datetime.datetime.now().isoformat(),
+            'subject': self.pdict['name'],
+            'stage': stage,
+            'series': series,
+            'duration': time.time() - start,
+            'input_bytes': input_bytes,
+            'output_bytes': output_bytes,
+            'returncode': returncode,
+        }
+        if self.progress_dir:
+            with _EVENTS_LOCK, open(f'{self.progress_dir}/events.jsonl', 'a') as f:
+                f.write(json.dumps(event) + '\n')
+        if self.hook is not None:
+            self.hook(event)
+
+
+    def _record(self, stage, series='', fingerprint=None):
+        # Records a completed stage in the progress directory
+        if self.state is not None:
+            self.state.record(self.pdict['name'], stage, series, fingerprint or self.config)
+
+
+    def _series_fingerprint(self, task):
+        # Identifies a conversion by its settings and the indexed file count and mtime of its DICOMs
+        # (not by fields the index fills in later, such as preflight results)
+        info = self.index.info(task['input']) or {}
+        return hashlib.sha256(json.dumps([self.config, task['input'], task['name'],
+                                          info.get('files'), info.get('mtime_ns')]).encode()).hexdigest()
+
+
+    def _subject_fingerprint(self, multiecho=False):
+        # Settings and DICOM series of the whole subject
+        series = [self._series_fingerprint(task) for task in self.conversion_tasks(multiecho=multiecho)]
+        return hashlib.sha256(json.dumps([self.config] + series).encode()).hexdigest()
+
+
+    def is_complete(self, multiecho=False):
+        """ 
+        Checks whether an earlier run with the same progress directory completed this subject with the same
+        DICOM series and settings, and the subject folder is still in the BIDS root.
+      
+        Parameters: 
+        multiecho (bool): Flag to specify if functional data is multi-echo
+      
+        Returns: 
+        bool: True if the subject does not need to be built again
+      
+        """
+
+        if self.state is None or self.pdict['overwrite']:
+            return False
+        if not os.path.isdir(f'{self.pdict["root"]}/sub-{self.pdict["name"]}'):
+            return False
+        return self.state.is_done(self.pdict['name'], 'complete', fingerprint=self._subject_fingerprint(multiecho))
+
+
+    def validate(self, multiecho=False):
+        """ 
+        Validates the presence of BIDS root directory and DICOM folders, 
+        and ensures that subject directory doesn't already exist.
+      
+        Parameters: 
+        multiecho (bool): Flag to specify if functional data is multi-echo    
+
+        """
+
+        logging.info('Validating parameters.....')
+        start = time.time()
+
+        # A subject folder left by an interrupted run with the same settings is resumed, not rejected
+        # Overwrite always starts the subject over
+        resuming = False
+        if self.state is not None:
+            if self.pdict['overwrite']:
+                self.state.clear(self.pdict['name'])
+            else:
+                resuming = self.state.is_done(self.pdict['name'], 'validate', fingerprint=self.config)
+
+        # Validate that BIDS root directory exists!
+        # This directory is created by the 'create_bids_root' function below!
+        if os.path.isdir(self.pdict['root']):
+            logging.info('Root Exists.')
+            self.root_exists = True
+        else:
+            logging.error('Root does not exist!')
+            raise OSError('Root does not exist!')
+        
+        # Check if the subject folder already exists, and will throw an error if it does
+        # If overwrite is on, the subject folder will be deleted
+        # If ignore is on, the analysis will proceed even if the subject folder exists
+        if os.path.isdir(f'{self.pdict["root"]}/sub-{self.pdict["name"]}') and resuming:
+            logging.info(f"Resuming {self.pdict['name']} from the progress directory.")
+        elif os.path.isdir(f'{self.pdict["root"]}/sub-{self.pdict["name"]}'):
+            if self.pdict['overwrite']:
+                logging.warning(f'Overwrite option selected! Removing subject {self.pdict["name"]}')
+                remove_start = time.time()
+                shutil.rmtree(f'{self.pdict["root"]}/sub-{self.pdict["name"]}')
+                self._emit('overwrite', remove_start)
+            elif self.pdict['ignore']:
+                logging.error(f"{self.pdict['name']}' exists! Continuing forward (risky).")
+            else:
+                logging.error(f"{self.pdict['name']}' exists! Try a different subject name, or ignore/delete existing folder.")
+                raise OSError(f"'{self.pdict['name']}' exists! Try a different subject name, or ignore/delete existing folder.")
+
+        # Check that the anatomical DICOM folder exists
+        if not self.index.isdir(self.pdict['anat']):
+            logging.error(f"'{self.pdict['anat']}' does not exist! Input a valid anatomical DICOM directory.")
+            raise OSError(f"'{self.pdict['anat']}' does not exist! Input a valid anatomical DICOM directory.")
+
+        # Check that the functional DICOM folders exist
+        if not multiecho:
+            for func in self.pdict['func']:
+                if not self.index.isdir(func):
+                    logging.error(f"'{func}' does not exist! Input a valid functional DICOM directory.")
+                    raise OSError(f"'{func}' does not exist! Input a valid functional DICOM directory.")
+        elif multiecho:
+            for run in self.pdict['func']:
+                for echo in run:
+                    if not self.index.isdir(echo):
+                        logging.error(f"'{echo}' does not exist! Input a valid functional DICOM directory.")
+                        raise OSError(f"'{echo}' does not exist! Input a valid functional DICOM directory.")
+
+        # TODO: Validate fmriprep-docker requirements
+        # TODO: Validate motion regression requirements
+
+        logging.info('Validated!')
+        self._emit('validate', start)
+        self._record('validate')
+
+
+    def preflight(self, multiecho=False, jobs=4):
+        """ 
+        Checks every DICOM series of the subject before conversion, reading only the DICOM headers.
+        Finds missing slices and volumes, inconsistent image dimensions, and multi-echo runs whose echoes
+        have different volume counts or do not have distinct EchoTimes.
+        Results are kept in the DICOM index (saved with index.save()), so repeated checks of unchanged series are instant.
+      
+        Parameters: 
+        multiecho (bool): Flag to specify if functional data is multi-echo
+        jobs (int): Number of series checked at the same time
+      
+        Returns: 
+        dict: Series path -> preflight_series() summary
+      
+        """
+
+        logging.info('Checking DICOM headers.....')
+        start = time.time()
+        runs = self.pdict['func'] if multiecho else [[func] for func in self.pdict['func']]
+        paths = [self.pdict['anat']] + [echo for run in runs for echo in run]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            summaries = dict(zip(paths, pool.map(self.index.preflight, paths)))
+
+        issues = [f'{path}: {issue}' for path in paths for issue in summaries[path]['issues']]
+        if multiecho:
+            for number, run in enumerate(runs, start=1):
+                issues += [f'run {number}: {issue}' for issue in preflight_echoes([summaries[echo] for echo in run])]
+        self._emit('preflight', start)
+        if issues:
+            logging.error('Preflight check failed!\n' + '\n'.join(issues))
+            raise OSError('Preflight check failed!\n' + '\n'.join(issues))
+        logging.info('Preflight check passed!')
+        return summaries
+
+
+    def plan(self, multiecho=False, rates=None):
+        """ 
+        Dry run of convert(): lists the dcm2niix commands of the subject and predicts their run time and
+        output size from the file counts and sizes in the DICOM index, without writing anything.
+        Series whose NIFTI already exists in the BIDS root would not be converted again, and are sized from its header.
+      
+        Parameters: 
+        multiecho (bool): Flag to specify if functional data is multi-echo
+        rates (dict): Conversion rates (see conversion_rates), DEFAULT_CONVERSION_RATES if not given
+      
+        Returns: 
+        dict: 'series' (one dict per series with its 'name', 'input', 'command' (None if already converted),
+            'files', 'input_bytes', 'output_bytes', 'seconds', 'voxels' and 'volumes'; the last two are None
+            for functional series whose volume count preflight() did not find), plus the total 'seconds' and
+            'output_bytes' of the subject
+      
+        """
+
+        rates = dict(DEFAULT_CONVERSION_RATES, **(rates or {}))
+        sub_path = f'{self.pdict["root"]}/sub-{self.pdict["name"]}'
+        series = []
+        for task in self.conversion_tasks(multiecho=multiecho):
+            # Before create_bids_hierarchy() the output folders are not set yet
+            anat = task['name'] == self.anat_name
+            final_dir = task['final_dir'] or f"{sub_path}/{'anat' if anat else 'func'}/"
+            info = self.index.info(task['input']) or {}
+            entry = {'name': task['name'], 'input': task['input'], 'files': info.get('files', 0),
+                     'input_bytes': self.index.size(task['input'])}
+
+            existing = find_nifti(final_dir, task['name'])
+            if existing:
+                header = nifti_summary(read_nifti_header(existing))
+                entry.update(command=None, seconds=0.0, volumes=header['volumes'],
+                             voxels=int(math.prod(header['dim'][:3])) if len(header['dim']) >= 3 else 0,
+                             output_bytes=self._output_bytes(final_dir, task['name']))
+                series.append(entry)
+                continue
+
+            # Without NIFTI headers, the image size follows from the 16 bit pixel data of the DICOMs
+            # The volume count is only known from preflight(): non-mosaic EPI has one file per slice and volume
+            megabytes = entry['input_bytes'] / 2**20
+            found = info.get('preflight') or {}
+            volumes = found.get('volumes')
+            if not volumes and found.get('slices') and entry['files']:
+                volumes = max(entry['files'] // found['slices'], 1)
+            volumes = 1 if anat else volumes or None
+            seconds = rates['seconds_per_series'] + rates['seconds_per_mb'] * megabytes
+            output_bytes = entry['input_bytes'] * rates['output_ratio']
+            if self.compression:
+                seconds += rates['gzip_seconds_per_mb'] * output_bytes / 2**20 if self.compression == 'post' else 0
+                output_bytes *= rates['gzip_ratio']
+            entry.update(command=['dcm2niix'] + self._dcm2niix_flags() + ['-f', task['name'], '-o', task['out_dir'] or final_dir, task['input']],
+                         seconds=seconds, volumes=volumes, voxels=int(entry['input_bytes'] / 2 / volumes) if volumes else None,
+                         output_bytes=int(output_bytes))
+            series.append(entry)
+
+        return {'series': series, 'seconds': sum(entry['seconds'] for entry in series),
+                'output_bytes': sum(entry['output_bytes'] for entry in series)}
+
+
+    def create_bids_hierarchy(self):
+        """ Creates the subject directory and nested anat and func directories."""
+
+        logging.info('Creating BIDS hierarchy.....')
+        start = time.time()
+
+        # Create subject directory
+        # If they do, log an error but continue
+        # With a scratch directory, the subject is created there and moved into the BIDS root by commit()
+        sub_path = f'{self.pdict["root"]}/sub-{self.pdict["name"]}'
+        self.final_anat_path = f'{sub_path}/anat/'
+        self.final_func_path = f'{sub_path}/func/'
+        if self.scratch_dir:
+            os.makedirs(self.scratch_dir, exist_ok=True)
+            self.stage_dir = tempfile.mkdtemp(prefix=f'sub-{self.pdict["name"]}.', dir=self.scratch_dir)
+            sub_path = f'{self.stage_dir}/sub-{self.pdict["name"]}'
+        try:
+            os.makedirs(sub_path)
+        except FileExistsError:
+            logging.warning('Subject directory exists!')
+
+        # Create anat and func directories
+        # If they do, log an error but continue
+        self.anat_path = f'{sub_path}/anat/'
+        try:
+            os.makedirs(self.anat_path)
+        except FileExistsError:
+            logging.warning('anat directory exists')
+
+        self.func_path = f'{sub_path}/func/'
+        try:
+            os.makedirs(self.func_path)
+        except FileExistsError:
+            logging.warning('func directory exists')
+
+        logging.info("Completed!")
+        self._emit('create_bids_hierarchy', start)
+        self._record('create_bids_hierarchy')
+
+
+    def conversion_tasks(self, multiecho=False):
+        """ 
+        Lists every dcm2niix conversion needed for this subject and sets the BIDS file names.
+      
+        Parameters: 
+        multiecho (bool): Flag to specify if functional data is multi-echo  
+
+        Returns: 
+        list: One dictionary per DICOM series with its input folder, output folder and BIDS name
+
+        """
+
+        tasks = []
+
+        # The anatomical DICOM is always converted first
+        self.anat_name = f'sub-{self.pdict["name"]}_T1w'
+        tasks.append({'input': self.pdict['anat'], 'out_dir': self.anat_path, 'final_dir': self.final_anat_path,
+                      'name': self.anat_name, 'echo': False})
+
+        # For single echo data, there is one series per run
+        # For multi echo data, there is a list of runs, and each run is a list of echos
+        self.func_name = []
+        if not multiecho:
+            for run_counter, func_input in enumerate(self.pdict['func'], start=1):
+                func_name = f'sub-{self.pdict["name"]}_task-{self.pdict["task"]}_run-{str(run_counter)}_bold'
+                self.func_name.append(func_name)
+                tasks.append({'input': func_input, 'out_dir': self.func_path, 'final_dir': self.final_func_path,
+                              'name': func_name, 'echo': False})
+        elif multiecho:
+            for run_counter, run in enumerate(self.pdict['func'], start=1):
+                for echo_counter, echo in enumerate(run, start=1):
+                    echo_name = f'sub-{self.pdict["name"]}_task-{self.pdict["task"]}_run-{str(run_counter)}_echo-{str(echo_counter)}_bold'
+                    self.func_name.append(echo_name)
+                    tasks.append({'input': echo, 'out_dir': self.func_path, 'final_dir': self.final_func_path,
+                                  'name': echo_name, 'echo': True})
+
+        return tasks
+
+
+    def convert_series(self, task):
+        """ 
+        Runs dcm2niix for a single DICOM series returned by conversion_tasks()
+        With compression='post', the NIFTI is handed to the compression pool and compressed in the background.
+      
+        Parameters: 
+        task (dict): Conversion task with 'input', 'out_dir', 'final_dir', 'name' and 'echo' fields
+
+        """
+
+        out_dir = task['out_dir']
+        name = task['name']
+        start = time.time()
+        # DICOM sizes are only read when timing events are recorded
+        input_bytes = self.index.size(task['input']) if self.progress_dir or self.hook is not None else None
+
+        # Series recorded as converted from the same DICOMs are skipped without further checks
+        fingerprint = None
+        if self.state is not None:
+            fingerprint = self._series_fingerprint(task)
+            if self.state.is_done(self.pdict['name'], 'convert', name, fingerprint) and find_nifti(task['final_dir'], name):
+                logging.info(f'{name} was already converted.')
+                return
+
+        # Without a cache, an existing NIFTI (compressed or not) is never converted again
+        # With a cache, the NIFTI is kept only if it matches the current DICOM series
+        # Existing outputs are looked up in the BIDS root, even when the subject is staged in scratch
+        key = None
+        if self.cache is None:
+            if find_nifti(task['final_dir'], name):
+                logging.warning(f'{name} exists! Not overwriting.')
+                return
+        else:
+            key = self.cache.key(task['input'], self._dcm2niix_flags() + [f'compression={self.compression}'])
+            if self.cache.is_current(key, task['final_dir'], name):
+                logging.info(f'{name} is up to date with its DICOMs.')
+                return
+            # Stale outputs go first: dcm2niix would add a suffix instead of replacing them, and a restored
+            # .nii.gz next to an old .nii (or the reverse) would leave find_nifti() with the stale file
+            for path in glob.glob(f'{out_dir}/{glob.escape(name)}.*'):
+                logging.warning(f'Removing stale output {path}')
+                os.remove(path)
+            if self.cache.restore(key, out_dir, name):
+                logging.info(f'{name} restored from conversion cache.')
+                self._emit('cache_restore', start, name, input_bytes, self._output_bytes(out_dir, name))
+                self._record('convert', name, fingerprint)
+                return
+
+        # Optionally copy the DICOMs to local scratch first, in one bulk copy
+        source = task['input']
+        if self.prefetch and self.stage_dir:
+            fetch_start = time.time()
+            source = f'{self.stage_dir}/dicoms/{name}'
+            shutil.copytree(task['input'], source)
+            self._emit('prefetch', fetch_start, name, input_bytes)
+
+        try:
+            # Note: dcm2niix outputs multiecho weirdly, so they are first named temp, and converted to the right name
+            # Each echo gets its own staging folder, so all echoes of all runs can be converted at the same time
+            if task['echo']:
+                staging = tempfile.mkdtemp(prefix=f'.{name}.', dir=out_dir)
+                try:
+                    command = ['dcm2niix'] + self._dcm2niix_flags() + ['-f', 'temp', '-o', staging, source]
+                    process = self._run_dcm2niix(command, name, staging, 'temp')
+                    nii = glob.glob(f"{staging}/*temp*.nii") + glob.glob(f"{staging}/*temp*.nii.gz")
+                    sidecar = glob.glob(f"{staging}/*temp*.json")
+                    if len(nii) != 1 or len(sidecar) != 1:
+                        logging.error(f'dcm2niix output for {name} is ambiguous or missing: {nii + sidecar}')
+                        raise OSError(f'dcm2niix output for {name} is ambiguous or missing: {nii + sidecar}')
+                    # The NIFTI is moved last, so its presence marks a finished conversion
+                    extension = '.nii.gz' if nii[0].endswith('.gz') else '.nii'
+                    os.replace(sidecar[0], f'{out_dir}/{name}.json')
+                    os.replace(nii[0], f'{out_dir}/{name}{extension}')
+                finally:
+                    shutil.rmtree(staging, ignore_errors=True)
+            else:
+                command = ['dcm2niix'] + self._dcm2niix_flags() + ['-f', name, '-o', out_dir, source]
+                print('Running dcm2niix')
+                process = self._run_dcm2niix(command, name, out_dir, name)
+                if not find_nifti(out_dir, name):
+                    logging.error(f"dcm2niix wrote no NIFTI for {name} (exit code {process['returncode']})")
+                    raise OSError(f"dcm2niix wrote no NIFTI for {name} (exit code {process['returncode']})")
+        finally:
+            if source != task['input']:
+                shutil.rmtree(source, ignore_errors=True)
+
+        self._emit('dcm2niix', start, name, input_bytes, self._output_bytes(out_dir, name), process['returncode'])
+
+        # Compress while the next series are converting; the result is cached once it is compressed
+        if self.compression == 'post' and os.path.exists(f'{out_dir}/{name}.nii'):
+            self._compressing.append(compression_pool(self.compress_threads).submit(self._compress, key, out_dir, name, fingerprint,
+                                                                                    process['returncode']))
+            return
+        # Outputs of a failed run (e.g. truncated NIFTIs of incomplete volumes) are never cached
+        if process['returncode'] == 0 and find_nifti(out_dir, name):
+            if self.cache is not None:
+                self.cache.store(key, out_dir, name)
+            self._record('convert', name, fingerprint)
+
+
+    def _run_dcm2niix(self, command, name, out_dir, prefix):
+        # A killed or failed dcm2niix may leave partial outputs behind (e.g. a truncated NIFTI for exit code 10,
+        # incomplete volumes), which must not look like a finished conversion
+        process = run_process(command, log=self.log, label=name, timeout=self.timeout, retries=self.retries)
+        if process['timed_out'] or process['returncode'] != 0:
+            for path in glob.glob(f'{out_dir}/{glob.escape(prefix)}.*'):
+                os.remove(path)
+        if process['timed_out']:
+            logging.error(f'dcm2niix timed out on {name} after {self.timeout} s')
+            raise OSError(f'dcm2niix timed out on {name} after {self.timeout} s')
+        if process['returncode'] != 0:
+            logging.error(f"dcm2niix exited with code {process['returncode']} for {name}")
+            raise OSError(f"dcm2niix exited with code {process['returncode']} for {name}")
+        return process
+
+
+    def _compress(self, key, out_dir, name, fingerprint=None, returncode=0):
+        start = time.time()
+        input_bytes = os.path.getsize(f'{out_dir}/{name}.nii')
+        compress_nifti(f'{out_dir}/{name}.nii', self.compress_level)
+        self._emit('gzip', start, name, input_bytes, os.path.getsize(f'{out_dir}/{name}.nii.gz'))
+        # A failed conversion is neither cached nor recorded, so the next run converts it again
+        if returncode != 0:
+            return
+        if self.cache is not None:
+            self.cache.store(key, out_dir, name)
+        self._record('convert', name, fingerprint)
+
+
+    def wait_for_compression(self):
+        """ Waits for all background compressions started by convert_series() and re-raises their errors """
+
+        pending, self._compressing = self._compressing, []
+        for future in pending:
+            future.result()
+
+
+    def _dcm2niix_flags(self):
+        # dcm2niix compresses with pigz (multi-threaded) if it is installed, at the given level
+        if self.compression == 'dcm2niix':
+            return ['-z', 'y', f'-{self.compress_level}', '-b', 'y']
+        return ['-z', 'n', '-b', 'y']
+
+
+    def _output_bytes(self, out_dir, name):
+        # Total size of the files produced for one BIDS name
+        return sum(os.path.getsize(path) for path in glob.glob(f'{out_dir}/{glob.escape(name)}.*'))
+
+
+    def convert(self, multiecho=False, jobs=1):
+        """ 
+        Converts the specified DICOMs into NIFTIs using dcm2niix
+      
+        Parameters: 
+        multiecho (bool): Flag to specify if functional data is multi-echo  
+            Note that multiecho DICOMS must be specified as a list of lists (see multiecho example)  
+        jobs (int): Number of dcm2niix processes to run at the same time
+
+        """
+
+        # Run dcm2niix for the anatomical and every functional DICOM and rename
+        # All functional outputs are in the BIDS func directory, but the run-# and echo-# are different
+        logging.info('Converting DICOMs to NIFTI and renaming.....')
+        tasks = self.conversion_tasks(multiecho=multiecho)
+        if jobs > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+                # Calling result() re-raises the first conversion error
+                for future in [pool.submit(self.convert_series, task) for task in tasks]:
+                    future.result()
+        else:
+            for task in tasks:
+                self.convert_series(task)
+        self.wait_for_compression()
+        logging.info('Completed!')
+    
+
+    def verify(self, multiecho=False, min_volumes=None, jobs=4):
+        """ 
+        Checks the converted NIFTIs of the subject, reading only their 348 byte headers.
+        Every series must have a NIFTI and a JSON sidecar, the anatomical image must be 3D and the functional
+        images 4D, with the number of volumes found by preflight() (if it ran) and at least min_volumes.
+        All echoes of a multi-echo run must have the same dimensions and number of volumes.
+      
+        Parameters: 
+        multiecho (bool): Flag to specify if functional data is multi-echo
+        min_volumes (int): Smallest acceptable number of volumes of a functional run (optional)
+        jobs (int): Number of headers read at the same time
+      
+        Returns: 
+        dict: BIDS name -> header summary (see nifti_summary)
+      
+        """
+
+        logging.info('Verifying NIFTI headers.....')
+        start = time.time()
+        tasks = self.conversion_tasks(multiecho=multiecho)
+        issues = []
+        paths = {}
+        for task in tasks:
+            # Series that were not converted again are only in the BIDS root
+            path = find_nifti(task['out_dir'], task['name']) or find_nifti(task['final_dir'], task['name'])
+            if path is None:
+                found = glob.glob(f"{task['out_dir']}/{glob.escape(task['name'])}*")
+                issues.append(f"{task['name']}: no NIFTI (dcm2niix wrote {found})")
+                continue
+            if not os.path.exists(f"{os.path.dirname(path)}/{task['name']}.json"):
+                issues.append(f"{task['name']}: no JSON sidecar")
+            paths[task['name']] = path
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            futures = {name: pool.submit(read_nifti_header, path) for name, path in paths.items()}
+        summaries = {}
+        for name, future in futures.items():
+            try:
+                summaries[name] = nifti_summary(future.result())
+            except (OSError, EOFError) as err:
+                issues.append(f'{name}: {err}')
+
+        for task in tasks:
+            summary = summaries.get(task['name'])
+            if summary is None:
+                continue
+            if task['name'] == self.anat_name:
+                if len(summary['dim']) < 3 or summary['volumes'] != 1:
+                    issues.append(f"{task['name']}: expected a 3D image, found dimensions {summary['dim']}")
+                continue
+            if len(summary['dim']) != 4:
+                issues.append(f"{task['name']}: expected a 4D image, found dimensions {summary['dim']}")
+            # Volume counts found in the DICOM headers by preflight() are kept in the index
+            info = self.index.info(task['input'])
+            expected = info.get('preflight', {}).get('volumes') if info else None
+            if expected and summary['volumes'] != expected:
+                issues.append(f"{task['name']}: {summary['volumes']} volumes, but the DICOMs have {expected}")
+            if min_volumes and summary['volumes'] < min_volumes:
+                issues.append(f"{task['name']}: {summary['volumes']} volumes, fewer than {min_volumes}")
+
+        if multiecho:
+            for number in range(1, len(self.pdict['func']) + 1):
+                echoes = {name: summary for name, summary in summaries.items() if f'_run-{number}_echo-' in name}
+                if len({(tuple(summary['dim']), summary['volumes']) for summary in echoes.values()}) > 1:
+                    shapes = ', '.join(f"{name}: {summary['dim']}" for name, summary in sorted(echoes.items()))
+                    issues.append(f'run {number}: echoes differ ({shapes})')
+
+        self._emit('verify', start)
+        if issues:
+            logging.error('Verification failed!\n' + '\n'.join(issues))
+            raise OSError('Verification failed!\n' + '\n'.join(issues))
+        self._record('verify')
+        logging.info('Verification passed!')
+        return summaries
+
+
+    def update_json(self):
+        """ Updates the JSON sidecars generated with dcm2niix to include a field for TaskName """
+
+        # Add TaskName field to BIDS functional NIFTI sidecars
+        logging.info('Updating functional NIFTI sidecars.....')
+        start = time.time()
+        input_bytes = output_bytes = 0
+        for func in self.func_name:
+            # Sidecars that were not converted again are only in the BIDS root
+            sidecar = f'{self.func_path}/{func}.json'
+            if not os.path.exists(sidecar):
+                sidecar = f'{self.final_func_path}/{func}.json'
+            if not os.path.exists(sidecar):
+                found = glob.glob(f'{self.func_path}/{glob.escape(func)}*') + glob.glob(f'{self.final_func_path}/{glob.escape(func)}*')
+                logging.error(f'No JSON sidecar for {func}, dcm2niix wrote {found}')
+                raise OSError(f'No JSON sidecar for {func}, dcm2niix wrote {found}')
+            input_bytes += os.path.getsize(sidecar)
+            with open(sidecar) as json_file:
+                data = json.load(json_file)
+
+            # Sidecars that already have the right TaskName are not rewritten
+            # A sidecar from the BIDS root is patched in the staging folder, and moved in by commit()
+            if data.get('TaskName') != self.pdict["task"]:
+                data['TaskName'] = self.pdict["task"]
+                write_json_atomic(f'{self.func_path}/{func}.json', data)
+                output_bytes += os.path.getsize(f'{self.func_path}/{func}.json')
+        logging.info('Completed!')
+        self._emit('update_json', start, input_bytes=input_bytes, output_bytes=output_bytes)
+        self._record('update_json')
+
+
+    def commit(self):
+        """ 
+        Moves a subject staged in scratch_dir into the BIDS root. Does nothing without scratch_dir.
+
+        A new subject folder is moved in as a whole and appears with a single rename.
+        If the subject folder already exists, each staged file replaces its counterpart (NIFTIs last).
+      
+        """
+
+        if not self.stage_dir:
+            return
+
+        logging.info('Committing staged subject to BIDS root.....')
+        start = time.time()
+        staged = f'{self.stage_dir}/sub-{self.pdict["name"]}'
+        final = f'{self.pdict["root"]}/sub-{self.pdict["name"]}'
+        output_bytes = sum(os.path.getsize(os.path.join(path, filename))
+                           for path, dirs, filenames in os.walk(staged) for filename in filenames)
+
+        moved = False
+        if not os.path.exists(final):
+            # Copy (or rename, on the same filesystem) next to the final folder, then rename into place
+            temp = f'{self.pdict["root"]}/.sub-{self.pdict["name"]}.{os.getpid()}.commit'
+            shutil.move(staged, temp)
+            try:
+                os.rename(temp, final)
+                moved = True
+            except OSError:
+                staged = temp
+
+        if not moved:
+            for path, dirs, filenames in os.walk(staged):
+                target_dir = os.path.join(final, os.path.relpath(path, staged))
+                os.makedirs(target_dir, exist_ok=True)
+                for filename in sorted(filenames, key=lambda filename: '.nii' in filename):
+                    # A NIFTI replaces its counterpart with the other extension (e.g. .nii replaced by .nii.gz)
+                    # Other files (e.g. a patched sidecar) leave the files next to them alone
+                    base = filename.split('.')[0]
+                    if '.nii' in filename:
+                        for old in glob.glob(f'{target_dir}/{glob.escape(base)}.nii*'):
+                            if os.path.basename(old) not in filenames:
+                                os.remove(old)
+                    temp = f'{target_dir}/.{filename}.commit'
+                    shutil.move(os.path.join(path, filename), temp)
+                    os.replace(temp, os.path.join(target_dir, filename))
+            shutil.rmtree(staged, ignore_errors=True)
+
+        self.discard()
+        self.anat_path = self.final_anat_path
+        self.func_path = self.final_func_path
+        logging.info('Completed!')
+        self._emit('commit', start, output_bytes=output_bytes)
+
+
+    def discard(self):
+        """ Removes the scratch staging directory of the subject, if any """
+
+        if self.stage_dir:
+            shutil.rmtree(self.stage_dir, ignore_errors=True)
+            self.stage_dir = None
+
+
+def build_dataset(dicom_dir, subs, anat, func, task, root, multiecho=False, jobs=1, preflight=False, verify=False, **options):
+    """ 
+    Runs SetupBIDSPipeline for many subjects at once on a bounded pool of workers.
+
+    Subject setup (matching, validation, hierarchy creation) is spread over the pool first,
+    then every anatomical and functional series of all subjects is converted on the same pool.
+    A subject that fails at any stage is recorded in the summary and the rest of the batch continues.
+  
+    Parameters: 
+    dicom_dir (str): Root path of all DICOMs
+    subs (list): List of subject ID strings
+    anat (str): Regex expression of path to anatomical DICOMs within each subject DICOM directory
+    func (list): List of regex expressions of paths to functional DICOMs (list of lists for multiecho)
+    task (str): Name of functional MRI task
+    root (str): Path to BIDS root created with create_bids_root()
+    multiecho (bool): Flag to specify if functional data is multi-echo
+    jobs (int): Maximum number of subjects or dcm2niix processes handled at the same time
+    preflight (bool): Check the DICOM headers of every series before converting (see SetupBIDSPipeline.preflight)
+    verify (bool): Check the NIFTI headers and sidecars of every subject after converting (see SetupBIDSPipeline.verify).
+        With a scratch_dir, subjects that fail are not committed to the BIDS root; without one, dcm2niix writes
+        into the BIDS root directly and their outputs stay there, reported as failed and not recorded as complete
+    options: Additional keyword arguments passed to SetupBIDSPipeline (e.g. ignore, overwrite)
+        index_file (str) may be given to persist the DICOM index between runs
+  
+    Returns: 
+    dict: Summary with 'succeeded' (list), 'failed' (dict of subject -> error message),
+        'skipped' (subjects completed in an earlier run with the same progress_dir, DICOM series and settings,
+        whose folder is still in the BIDS root) and 'elapsed' (seconds)
+  
+    """
+
+    logging.info(f'Building BIDS dataset for {len(subs)} subjects with {jobs} workers')
+    start = time.time()
+
+    # Index the DICOM folders of all subjects in one pass and share it between subjects
+    if options.get('index') is None:
+        options['index'] = DicomIndex(dicom_dir, options.pop('index_file', None))
+    options['index'].build(subs, jobs=jobs)
+    setups = {}
+    failed = {}
+    skipped = []
+
+    def setup_subject(name):
+        setup = SetupBIDSPipeline(dicom_dir, name, anat, func, task, root, multiecho=multiecho, **options)
+        # Subjects completed in an earlier run are skipped if neither their DICOMs nor the settings changed
+        if setup.is_complete(multiecho=multiecho):
+            return None
+        setup.validate(multiecho=multiecho)
+        if preflight:
+            setup.preflight(multiecho=multiecho, jobs=1)
+        setup.create_bids_hierarchy()
+        return setup
+
+    def collect(futures, stage):
+        # Record the first error of each subject instead of aborting the batch
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    result = future.result()
+                except Exception as err:
+                    logging.error(f'{name} failed during {stage}: {err}')
+                    failed.setdefault(name, f'{stage}: {err}')
+                else:
+                    if stage == 'setup' and result is None:
+                        skipped.append(name)
+                    elif stage == 'setup':
+                        setups[name] = result
+        except KeyboardInterrupt:
+            # Drop queued work and kill running tools, so Ctrl-C stops the whole batch promptly
+            logging.error(f'Interrupted during {stage}, stopping all workers')
+            for future in futures:
+                future.cancel()
+            kill_processes()
+            raise
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        collect({pool.submit(setup_subject, name): name for name in subs}, 'setup')
+        if skipped:
+            logging.info(f'Skipping {len(skipped)} subjects completed in an earlier run')
+        if preflight:
+            options['index'].save()
+
+        futures = {}
+        for name, setup in setups.items():
+            for series in setup.conversion_tasks(multiecho=multiecho):
+                futures[pool.submit(setup.convert_series, series)] = name
+        collect(futures, 'convert')
+        futures = {pool.submit(setup.wait_for_compression): name for name, setup in setups.items() if name not in failed}
+        collect(futures, 'compress')
+        if verify:
+            futures = {pool.submit(setup.verify, multiecho, None, 1): name for name, setup in setups.items() if name not in failed}
+            collect(futures, 'verify')
+
+        futures = {pool.submit(setup.update_json): name for name, setup in setups.items() if name not in failed}
+        collect(futures, 'update_json')
+
+        # Subjects staged in scratch are moved into the BIDS root only if every stage succeeded
+        futures = {pool.submit(setup.commit): name for name, setup in setups.items() if name not in failed}
+        collect(futures, 'commit')
+        for name, setup in setups.items():
+            setup.discard()
+            if name not in failed:
+                setup._record('complete', fingerprint=setup._subject_fingerprint(multiecho))
+
+    summary = {
+        'succeeded': [name for name in subs if name not in failed and name not in skipped],
+        'failed': failed,
+        'skipped': [name for name in subs if name in skipped],
+        'elapsed': time.time() - start,
+    }
+    logging.info(f"Built {len(summary['succeeded'])} of {len(subs)} subjects in {summary['elapsed']:.1f} s")
+    return summary
+
+
+# Conversion speed and output size assumed when no timing history is available
+DEFAULT_CONVERSION_RATES = {'seconds_per_series': 2.0, 'seconds_per_mb': 0.02, 'output_ratio': 1.0,
+                            'gzip_seconds_per_mb': 0.03, 'gzip_ratio': 0.5}
+
+
+def conversion_rates(events_file=None):
+    """ 
+    Conversion rates calibrated from the timing events of earlier runs, for SetupBIDSPipeline.plan().
+    The medians of successful dcm2niix and gzip events replace the defaults; the fixed cost per series is then
+    part of the measured seconds per MB. Events should come from runs with the same compression setting.
+  
+    Parameters: 
+    events_file (str): Path to an events.jsonl file of a progress directory (optional)
+  
+    Returns: 
+    dict: 'seconds_per_series', 'seconds_per_mb', 'output_ratio', 'gzip_seconds_per_mb', 'gzip_ratio',
+        and the number of events they are based on in 'samples'
+  
+    """
+
+    rates = dict(DEFAULT_CONVERSION_RATES, samples=0)
+    if not events_file or not os.path.isfile(events_file):
+        return rates
+    samples = {'dcm2niix': [], 'gzip': []}
+    with open(events_file) as f:
+        for line in f:
+            event = json.loads(line)
+            if event['stage'] in samples and event.get('input_bytes') and event.get('output_bytes') \
+                    and event.get('returncode') in (None, 0):
+                samples[event['stage']].append(event)
+
+    if samples['dcm2niix']:
+        rates['seconds_per_series'] = 0.0
+        rates['seconds_per_mb'] = _percentile([event['duration'] * 2**20 / event['input_bytes'] for event in samples['dcm2niix']], 50)
+        rates['output_ratio'] = _percentile([event['output_bytes'] / event['input_bytes'] for event in samples['dcm2niix']], 50)
+    if samples['gzip']:
+        rates['gzip_seconds_per_mb'] = _percentile([event['duration'] * 2**20 / event['input_bytes'] for event in samples['gzip']], 50)
+        rates['gzip_ratio'] = _percentile([event['output_bytes'] / event['input_bytes'] for event in samples['gzip']], 50)
+    rates['samples'] = len(samples['dcm2niix']) + len(samples['gzip'])
+    return rates
+
+
+def _makespan(durations, workers):
+    # Wall-clock time of running durations in the given order on a number of workers, each taking the next one when free
+    finish = [0.0] * max(1, min(workers, len(durations)))
+    for duration in durations:
+        heapq.heapreplace(finish, finish[0] + duration)
+    return max(finish)
+
+
+def plan_dataset(dicom_dir, subs, anat, func, task, root, multiecho=False, jobs=1, progress_dir=None, **options):
+    """ 
+    Dry run of build_dataset(): matches the DICOM series of every subject and predicts the conversion time and
+    the size of the BIDS root, without writing to the BIDS root, the progress directory or the DICOM index file.
+  
+    Parameters: 
+    dicom_dir, subs, anat, func, task, root, multiecho, jobs: Same as for build_dataset
+    progress_dir (str): Progress directory of earlier runs, whose events.jsonl calibrates the conversion rates (only read)
+    options: Additional keyword arguments for SetupBIDSPipeline that change the plan (index, index_file, compression)
+  
+    Returns: 
+    dict: 'subjects' (subject ID -> SetupBIDSPipeline.plan()), 'failed' (subject -> error of wildcard matching),
+        'rates' (see conversion_rates) and 'totals' with the 'series' to convert, their 'convert_seconds',
+        the 'wall_seconds' with jobs dcm2niix processes, and the 'input_bytes' and 'output_bytes' (BIDS root size)
+  
+    """
+
+    rates = conversion_rates(f'{progress_dir}/events.jsonl' if progress_dir else None)
+    index = options.get('index') or DicomIndex(dicom_dir, options.get('index_file'))
+    plans = {}
+    failed = {}
+    for name in subs:
+        try:
+            setup = SetupBIDSPipeline(dicom_dir, name, anat, func, task, root, multiecho=multiecho, index=index,
+                                      compression=options.get('compression'))
+        except OSError as err:
+            failed[name] = str(err)
+            continue
+        plans[setup.pdict['name']] = setup.plan(multiecho=multiecho, rates=rates)
+
+    series = [entry for plan in plans.values() for entry in plan['series'] if entry['command']]
+    totals = {
+        'series': len(series),
+        'convert_seconds': sum(entry['seconds'] for entry in series),
+        'wall_seconds': _makespan([entry['seconds'] for entry in series], jobs),
+        'input_bytes': sum(entry['input_bytes'] for entry in series),
+        'output_bytes': sum(plan['output_bytes'] for plan in plans.values()),
+    }
+    logging.info(f"Planned {totals['series']} conversions of {len(plans)} subjects: {totals['wall_seconds'] / 3600:.1f} h "
+                 f"with {jobs} workers, {totals['output_bytes'] / 2**30:.1f} GB BIDS root")
+    return {'subjects': plans, 'failed': failed, 'rates': rates, 'totals': totals}
+
+
+def write_json_atomic(path, data):
+    """ 
+    Writes JSON through a temporary file in the same folder and renames it into place,
+    so a crash never leaves a truncated file behind.
+  
+    Parameters: 
+    path (str): Path to the JSON file
+    data (dict): Content to write
+  
+    """
+
+    # A unique name, so threads and separate processes writing the same file never share a temporary file
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=f'.{os.path.basename(path)}.', suffix='.tmp')
+    try:
+        # mkstemp creates the file readable by its owner only; give it the permissions open() would
+        os.chmod(temp, 0o666 & ~_UMASK)
+        with os.fdopen(fd, 'w') as outfile:
+            json.dump(data, outfile)
+        os.replace(temp, path)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def task_name_rule(task=None):
+    """ 
+    Sidecar rule that sets TaskName, either to the given task or to the task-<label> entity of the file name.
+  
+    Parameters: 
+    task (str): Task name to set (optional)
+  
+    Returns: 
+    function: Rule for patch_sidecars()
+  
+    """
+
+    def rule(path, data, run):
+        match = re.search(r'_task-([a-zA-Z0-9]+)', os.path.basename(path))
+        name = task or (match.group(1) if match else None)
+        if name is None:
+            return ['no task entity to derive TaskName from']
+        data['TaskName'] = name
+        return []
+    return rule
+
+
+def echo_time_rule():
+    """ 
+    Sidecar rule that checks multi-echo runs: every echo needs an EchoTime, the EchoTimes of a run must be
+    distinct, and they must increase with the echo-<index> entity. Issues of the whole run are reported
+    once, under the sidecar of its first echo.
+  
+    Returns: 
+    function: Rule for patch_sidecars()
+  
+    """
+
+    def rule(path, data, run):
+        def echo_index(other):
+            match = re.search(r'_echo-([0-9]+)', os.path.basename(other))
+            return int(match.group(1)) if match else None
+
+        if echo_index(path) is None:
+            return []
+        issues = [] if 'EchoTime' in data else ['EchoTime is missing']
+        # Issues of the whole run are reported once, under its first echo
+        if path != min((other for other in run if echo_index(other) is not None), key=echo_index):
+            return issues
+        # Sidecars of the run without an echo-<index> entity are reported and left out of the comparison
+        echoes = []
+        for other, other_data in run.items():
+            if echo_index(other) is None:
+                issues.append(f'{os.path.basename(other)} of the same run has no echo-<index> entity')
+            else:
+                echoes.append((echo_index(other), other_data.get('EchoTime')))
+        echoes.sort()
+        times = [echo_time for index, echo_time in echoes if echo_time is not None]
+        if len(set(times)) != len(times):
+            issues.append(f'EchoTimes of the run are not distinct: {times}')
+        elif times != sorted(times):
+            issues.append(f'EchoTimes do not increase with the echo index: {echoes}')
+        return issues
+    return rule
+
+
+def slice_timing_rule():
+    """ 
+    Sidecar rule that checks that SliceTiming is present (fmriprep needs it for slice timing correction).
+  
+    Returns: 
+    function: Rule for patch_sidecars()
+  
+    """
+
+    def rule(path, data, run):
+        return [] if data.get('SliceTiming') else ['SliceTiming is missing']
+    return rule
+
+
+def patch_sidecars(bids_root, rules=None, jobs=8, dry_run=False):
+    """ 
+    Applies metadata rules to every functional JSON sidecar of a BIDS dataset in one pass.
+
+    Sidecars are grouped by run (all echoes of a run together), and runs are patched in a thread pool.
+    A rule is called as rule(path, data, run), where run maps the paths of all sidecars of the same run to
+    their data. It may change data in place and returns a list of issues. Only sidecars whose content changed
+    are rewritten, through a temporary file and an atomic rename.
+  
+    Parameters: 
+    bids_root (str): Path to the BIDS directory
+    rules (list): Rules to apply (defaults to [task_name_rule()])
+    jobs (int): Number of runs patched at the same time
+    dry_run (bool): Flag to report changes without writing them
+  
+    Returns: 
+    dict: 'changed' (list of paths), 'unchanged' (count) and 'issues' (path -> list of issues)
+  
+    """
+
+    rules = rules if rules is not None else [task_name_rule()]
+
+    # Group the sidecars of all echoes of a run
+    runs = {}
+    for path in glob.glob(f'{bids_root}/sub-*/**/func/*_bold.json', recursive=True):
+        runs.setdefault(re.sub(r'_echo-[0-9]+', '', path), []).append(path)
+
+    def patch_run(paths):
+        original = {}
+        for path in paths:
+            with open(path) as json_file:
+                original[path] = json.load(json_file)
+        patched = copy.deepcopy(original)
+        changed, issues = [], {}
+        for path in paths:
+            for rule in rules:
+                found = rule(path, patched[path], patched)
+                if found:
+                    issues.setdefault(path, []).extend(found)
+            if patched[path] != original[path]:
+                changed.append(path)
+                if not dry_run:
+                    write_json_atomic(path, patched[path])
+        return changed, issues, len(paths) - len(changed)
+
+    report = {'changed': [], 'unchanged': 0, 'issues': {}}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for changed, issues, unchanged in pool.map(patch_run, runs.values()):
+            report['changed'].extend(changed)
+            report['issues'].update(issues)
+            report['unchanged'] += unchanged
+
+    logging.info(f"{len(report['changed'])} sidecars changed, {report['unchanged']} unchanged, "
+                 f"{len(report['issues'])} with issues")
+    return report
+
+
+def run_fmriprep_docker(bids_root, output, fs_license, freesurfer=False, log=None, timeout=None):
+    """ 
+    Runs the fmriprep-docker command on the BIDS directory generated by SetupBIDSPipeline.
+    This command can also be run on an independently generated BIDS directory. 
+  
+    Parameters: 
+    bids_root (str): Path to generated BIDS directory
+    output (str): Path to store fmriprep output
+    fs_license (str): Path to a valid Freesurfer license
+    freesurfer (bool): Flag to specify Freesurfer surface estimation
+    log (str): Log file for the fmriprep-docker output (defaults to {output}/docker_logs/fmriprep.log)
+    timeout (float): Seconds after which fmriprep-docker is killed (no limit by default)
+  
+    """
+
+    # This method simply runs the fmriprep-docker command
+    logging.info('Executing fmriprep-docker command')
+    command = ['fmriprep-docker', bids_root, output, 'participant', '--fs-license-file', fs_license]
+    if not freesurfer:
+        command.append('--fs-no-reconall')
+    if log is None:
+        os.makedirs(f'{output}/docker_logs', exist_ok=True)
+        log = f'{output}/docker_logs/fmriprep.log'
+    #logging.info(command)
+    tag = f'{os.getpid()}-{time.time_ns()}'
+    process = run_process(_docker_tag(command, tag), log=log, timeout=timeout,
+                          cleanup=functools.partial(_kill_containers, tag))
+    if process['timed_out'] or process['returncode'] != 0:
+        logging.error(f"fmriprep-docker failed with code {process['returncode']}, see {log}")
+        raise OSError(f"fmriprep-docker failed with code {process['returncode']}, see {log}")
+
+
+def run_fmriprep_docker_parallel(bids_root, output, fs_license, subs=None, freesurfer=False,
+    nthreads=8, omp_nthreads=None, mem_mb=16000, total_cpus=None, total_mem_mb=None,
+    resources=None, log_dir=None, timeout=None, retries=0):
+    """ 
+    Runs one fmriprep-docker container per participant, packing containers into a total CPU/memory budget.
+    As soon as a participant finishes, the next waiting participant that fits into the free budget is started.
+  
+    Parameters: 
+    bids_root (str): Path to generated BIDS directory
+    output (str): Path to store fmriprep output
+    fs_license (str): Path to a valid Freesurfer license
+    subs (list): List of subject ID strings (defaults to every sub-* folder in bids_root)
+    freesurfer (bool): Flag to specify Freesurfer surface estimation
+    nthreads (int): Value of --nthreads for each participant
+    omp_nthreads (int): Value of --omp-nthreads for each participant (defaults to nthreads)
+    mem_mb (int): Value of --mem-mb for each participant
+    total_cpus (int): CPU budget shared by all containers (defaults to all CPUs)
+    total_mem_mb (int): Memory budget in MB shared by all containers (defaults to all physical memory)
+    resources (dict): Optional per-subject overrides, e.g. {'01': {'nthreads': 4, 'mem_mb': 8000}}
+    log_dir (str): Directory for per-participant log files (defaults to {output}/docker_logs)
+    timeout (float): Seconds after which a participant's container is killed (no limit by default)
+    retries (int): Number of reruns of a failed or timed out participant
+  
+    Returns: 
+    dict: Subject -> {'returncode', 'timed_out', 'attempts', 'wall_time' (seconds), 'log', 'nthreads', 'mem_mb'}
+  
+    """
+
+    if subs is None:
+        subs = sorted(os.path.basename(path) for path in glob.glob(f'{bids_root}/sub-*') if os.path.isdir(path))
+    subs = [sub[4:] if sub.startswith('sub-') else sub for sub in subs]
+    if total_cpus is None:
+        total_cpus = os.cpu_count()
+    if total_mem_mb is None:
+        total_mem_mb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2**20
+    if log_dir is None:
+        log_dir = f'{output}/docker_logs'
+    os.makedirs(log_dir, exist_ok=True)
+
+    # Size every participant job, never asking for more than the whole budget
+    jobs = []
+    for sub in subs:
+        job = {'nthreads': nthreads, 'mem_mb': mem_mb}
+        job.update((resources or {}).get(sub, {}))
+        # Without an explicit value, --omp-nthreads follows the participant's own --nthreads
+        job.setdefault('omp_nthreads', omp_nthreads or job['nthreads'])
+        job['nthreads'] = min(job['nthreads'], total_cpus)
+        job['omp_nthreads'] = min(job['omp_nthreads'], job['nthreads'])
+        job['mem_mb'] = min(job['mem_mb'], total_mem_mb)
+        jobs.append((sub, job))
+
+    logging.info(f'Running fmriprep-docker for {len(subs)} participants within {total_cpus} CPUs and {total_mem_mb} MB')
+    results = {}
+
+    async def schedule():
+        running = {}
+        free_cpus, free_mem = total_cpus, total_mem_mb
+        try:
+            while jobs or running:
+                # Start every waiting participant that fits into the free budget, in order
+                for sub, job in list(jobs):
+                    if job['nthreads'] > free_cpus or job['mem_mb'] > free_mem:
+                        continue
+                    command = ['fmriprep-docker', bids_root, output, 'participant', '--participant-label', sub,
+                               '--fs-license-file', fs_license, '--nthreads', str(job['nthreads']),
+                               '--omp-nthreads', str(job['omp_nthreads']), '--mem-mb', str(job['mem_mb'])]
+                    if not freesurfer:
+                        command.append('--fs-no-reconall')
+                    log = f'{log_dir}/sub-{sub}.log'
+                    open(log, 'w').close()
+                    tag = f'{os.getpid()}-{time.time_ns()}-{sub}'
+                    task = asyncio.ensure_future(_run_process(_docker_tag(command, tag), log=log, timeout=timeout, retries=retries,
+                                                              cleanup=functools.partial(_kill_containers, tag)))
+                    logging.info(f'Started sub-{sub} with {job["nthreads"]} threads and {job["mem_mb"]} MB')
+                    running[task] = (sub, job, time.time(), log)
+                    free_cpus -= job['nthreads']
+                    free_mem -= job['mem_mb']
+                    jobs.remove((sub, job))
+
+                # Collect finished participants and return their resources to the budget
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    sub, job, start, log = running.pop(task)
+                    process = task.result()
+                    results[sub] = dict(job, returncode=process['returncode'], timed_out=process['timed_out'],
+                                        attempts=process['attempts'], wall_time=time.time() - start, log=log)
+                    logging.info(f'sub-{sub} finished with code {process["returncode"]} in {results[sub]["wall_time"]:.0f} s')
+                    free_cpus += job['nthreads']
+                    free_mem += job['mem_mb']
+        finally:
+            # On Ctrl-C every running container is killed
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+
+    _run_sync(schedule())
+    failed = [sub for sub, result in results.items() if result['returncode'] != 0]
+    if failed:
+        logging.error(f'fmriprep-docker failed for {len(failed)} participants: {failed}')
+    return results
+
+
+def read_nifti_header(path):
+    """ 
+    Reads the 348 byte NIFTI-1 header of a .nii or .nii.gz file without loading the image data.
+  
+    Parameters: 
+    path (str): Path to a NIFTI-1 file
+  
+    Returns: 
+    dict: Header fields 'dim' (list of 8), 'datatype', 'bitpix', 'pixdim' (list of 8),
+        'vox_offset', 'scl_slope', 'scl_inter' and 'magic'
+  
+    """
+
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        raw = f.read(348)
+    if len(raw) < 348:
+        raise OSError(f'{path} is too short to be a NIFTI file')
+    # The header size field tells the byte order
+    endian = '<' if struct.unpack('<i', raw[:4])[0] == 348 else '>'
+    if struct.unpack(f'{endian}i', raw[:4])[0] != 348:
+        raise OSError(f'{path} does not have a NIFTI-1 header')
+    return {
+        'dim': list(struct.unpack(f'{endian}8h', raw[40:56])),
+        'datatype': struct.unpack(f'{endian}h', raw[70:72])[0],
+        'bitpix': struct.unpack(f'{endian}h', raw[72:74])[0],
+        'pixdim': list(struct.unpack(f'{endian}8f', raw[76:108])),
+        'vox_offset': struct.unpack(f'{endian}f', raw[108:112])[0],
+        'scl_slope': struct.unpack(f'{endian}f', raw[112:116])[0],
+        'scl_inter': struct.unpack(f'{endian}f', raw[116:120])[0],
+        'magic': raw[344:348].rstrip(b'\x00').decode('latin-1'),
+        'endian': endian,
+    }
+
+
+def nifti_summary(header):
+    """ 
+    Condenses a read_nifti_header() result to the fields that describe the image.
+  
+    Parameters: 
+    header (dict): NIFTI-1 header fields
+  
+    Returns: 
+    dict: 'dim' (size of each used dimension), 'volumes', 'datatype' and 'pixdim' (voxel size and TR)
+  
+    """
+
+    ndim = min(max(header['dim'][0], 1), 7)
+    return {
+        'dim': header['dim'][1:ndim + 1],
+        'volumes': header['dim'][4] if ndim >= 4 else 1,
+        'datatype': header['datatype'],
+        'pixdim': [round(value, 6) for value in header['pixdim'][1:ndim + 1]],
+    }
+
+
+def file_checksum(path, block_size=1 << 20):
+    """ Returns the SHA-256 hex digest of a file, read in blocks of block_size bytes """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def build_manifest(root, manifest_file=None, jobs=8, rehash=False):
+    """ 
+    Lists every file of a BIDS root with its size, checksum and, for NIFTIs, a header summary.
+    With a previous manifest_file, checksums of files whose size and modification time did not change are
+    reused, so only new and rewritten files are read. Hidden files (e.g. staging leftovers) are left out.
+  
+    Parameters: 
+    root (str): Path to the BIDS root
+    manifest_file (str): JSON file to reuse checksums from and write the manifest to (optional)
+    jobs (int): Number of files checksummed at the same time
+    rehash (bool): Checksum every file again, e.g. to detect silent corruption
+  
+    Returns: 
+    dict: Path relative to root -> {'size', 'mtime_ns', 'sha256', 'header' (NIFTI summary or None)}
+  
+    """
+
+    previous = {}
+    if manifest_file and os.path.isfile(manifest_file) and not rehash:
+        with open(manifest_file) as f:
+            previous = json.load(f)['files']
+
+    # A manifest file kept inside the root would otherwise list (and checksum) its previous version
+    skip = os.path.abspath(manifest_file) if manifest_file else None
+    files = {}
+    for path, dirs, filenames in os.walk(root):
+        dirs[:] = [name for name in dirs if not name.startswith('.')]
+        for filename in filenames:
+            full = os.path.join(path, filename)
+            if not filename.startswith('.') and os.path.abspath(full) != skip:
+                files[os.path.relpath(full, root)] = os.stat(full)
+
+    def describe(item):
+        relative, stat = item
+        entry = previous.get(relative)
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return relative, entry
+        path = os.path.join(root, relative)
+        header = None
+        if relative.endswith(('.nii', '.nii.gz')):
+            try:
+                header = nifti_summary(read_nifti_header(path))
+            except (OSError, EOFError) as err:
+                logging.warning(f'Cannot read the NIFTI header of {path}: {err}')
+        return relative, {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_checksum(path), 'header': header}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        manifest = dict(pool.map(describe, sorted(files.items())))
+    reused = sum(manifest[relative] is previous.get(relative) for relative in manifest)
+    logging.info(f'Manifest of {len(manifest)} files ({len(manifest) - reused} checksummed)')
+    if manifest_file:
+        write_json_atomic(manifest_file, {'root': os.path.abspath(root), 'created': time.time(), 'files': manifest})
+    return manifest
+
+
+def compare_manifests(old, new):
+    """ 
+    Compares two manifests written by build_manifest.
+  
+    Parameters: 
+    old (str or dict): Earlier manifest file or manifest
+    new (str or dict): Later manifest file or manifest
+  
+    Returns: 
+    dict: Sorted lists of 'added', 'removed' and 'changed' (different size, checksum or header) paths
+  
+    """
+
+    manifests = []
+    for manifest in (old, new):
+        if isinstance(manifest, str):
+            with open(manifest) as f:
+                manifest = json.load(f)['files']
+        manifests.append(manifest)
+    old, new = manifests
+    return {
+        'added': sorted(set(new) - set(old)),
+        'removed': sorted(set(old) - set(new)),
+        'changed': sorted(path for path in set(old) & set(new)
+                          if any(old[path][field] != new[path][field] for field in ('size', 'sha256', 'header'))),
+    }
+
+
+# NIFTI datatype codes -> NumPy type codes (byte order is added from the header)
+_NIFTI_DTYPES = {2: 'u1', 4: 'i2', 8: 'i4', 16: 'f4', 64: 'f8', 256: 'i1', 512: 'u2', 768: 'u4'}
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError('NumPy is required for this stage. Install it with "pip install numpy".')
+
+
+def _volume_chunks(path, header, chunk_volumes):
+    # Yields float32 blocks of at most chunk_volumes volumes, shaped (x, y, z, volumes)
+    # Uncompressed files are memory-mapped, compressed files are decompressed as a stream
+    if header['datatype'] not in _NIFTI_DTYPES:
+        raise OSError(f"{path} has unsupported NIFTI datatype {header['datatype']}")
+    dtype = np.dtype(header['endian'] + _NIFTI_DTYPES[header['datatype']])
+    shape = tuple(header['dim'][1:4])
+    volumes = header['dim'][4] if header['dim'][0] >= 4 else 1
+    slope, inter = header['scl_slope'], header['scl_inter']
+    scaled = slope not in (0, 1) or inter != 0
+
+    def scale(block):
+        block = block.astype(np.float32)
+        return block * slope + inter if scaled else block
+
+    if not path.endswith('.gz'):
+        data = np.memmap(path, dtype=dtype, mode='r', offset=int(header['vox_offset']),
+                         shape=shape + (volumes,), order='F')
+        for start in range(0, volumes, chunk_volumes):
+            yield scale(data[..., start:start + chunk_volumes])
+        return
+    volume_bytes = int(np.prod(shape)) * dtype.itemsize
+    with gzip.open(path, 'rb') as f:
+        f.read(int(header['vox_offset']))
+        for start in range(0, volumes, chunk_volumes):
+            count = min(chunk_volumes, volumes - start)
+            raw = f.read(volume_bytes * count)
+            if len(raw) < volume_bytes * count:
+                raise OSError(f'{path} is truncated')
+            yield scale(np.frombuffer(raw, dtype=dtype).reshape(shape + (count,), order='F'))
+
+
+def _gaussian_axis(data, sigma, axis):
+    # Separable Gaussian filter along one axis with zero padding, as shifted and weighted copies
+    if sigma <= 0:
+        return data
+    radius = max(1, int(math.ceil(3 * sigma)))
+    weights = np.exp(-0.5 * (np.arange(-radius, radius + 1) / sigma) ** 2)
+    weights /= weights.sum()
+    out = data * weights[radius]
+    size = data.shape[axis]
+    for shift in range(1, min(radius, size - 1) + 1):
+        low = [slice(None)] * data.ndim
+        high = [slice(None)] * data.ndim
+        low[axis] = slice(0, size - shift)
+        high[axis] = slice(shift, size)
+        out[tuple(low)] += weights[radius + shift] * data[tuple(high)]
+        out[tuple(high)] += weights[radius - shift] * data[tuple(low)]
+    return out
+
+
+def _gaussian(data, sigmas):
+    for axis, sigma in enumerate(sigmas):
+        data = _gaussian_axis(data, sigma, axis)
+    return data
+
+
+def _smoothing_inputs(path, mask, fwhm):
+    # Identifies a smoothing result by its kernel and the size and mtime of its inputs
+    inputs = {}
+    for source in (path, mask):
+        if source:
+            stat = os.stat(source)
+            inputs[source] = [stat.st_size, stat.st_mtime_ns]
+    return {'SmoothingFWHM': fwhm, 'Sources': inputs}
+
+
+def _sidecar_path(nifti):
+    return re.sub(r'\.nii(\.gz)?$', '.json', nifti)
+
+
+def smooth_bold(path, fwhm=6.0, mask=None, output=None, chunk_volumes=16):
+    """ 
+    Smooths a 4D BOLD image with an isotropic Gaussian kernel restricted to a brain mask.
+
+    Only voxels inside the mask contribute, and each smoothed value is normalized by the smoothed mask,
+    so signal does not leak across the brain edge (like AFNI's 3dBlurInMask). The image is processed in blocks
+    of volumes, so memory use does not depend on the number of volumes.
+  
+    Parameters: 
+    path (str): Path to a .nii or .nii.gz BOLD image
+    fwhm (float): Full width at half maximum of the kernel in mm
+    mask (str): Path to a brain mask in the same space (optional, the whole image is used without it)
+    output (str): Path of the smoothed image (defaults to the input with desc-smooth<fwhm>mm)
+    chunk_volumes (int): Number of volumes held in memory at the same time
+  
+    Returns: 
+    str: Path of the smoothed image, which is written as float32 with the JSON sidecar of the input plus
+        the kernel and inputs of the smoothing
+  
+    """
+
+    _require_numpy()
+    if output is None:
+        output = smoothed_path(path, fwhm)
+    # The input is read while the output is written, so they must differ
+    if os.path.abspath(output) == os.path.abspath(path):
+        logging.error(f'Smoothing {path} would overwrite its input')
+        raise ValueError(f'Smoothing {path} would overwrite its input')
+    header = read_nifti_header(path)
+    sigmas = [fwhm / math.sqrt(8 * math.log(2)) / size if size > 0 else 0 for size in header['pixdim'][1:4]]
+
+    # The mask and its smoothed version are needed for every block
+    if mask:
+        inside = next(_volume_chunks(mask, read_nifti_header(mask), 1))[..., 0] > 0
+        if inside.shape != tuple(header['dim'][1:4]):
+            raise OSError(f'{mask} does not match the dimensions of {path}')
+    else:
+        inside = np.ones(tuple(header['dim'][1:4]), dtype=bool)
+    weight = _gaussian(inside.astype(np.float32), sigmas)
+    weight[~inside] = 1
+    inside = inside[..., np.newaxis]
+    weight = weight[..., np.newaxis]
+
+    # The output keeps the header (and extensions) of the input, with float32 data
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        prefix = bytearray(f.read(int(header['vox_offset'])))
+    endian = header['endian']
+    struct.pack_into(f'{endian}hh', prefix, 70, 16, 32)
+    struct.pack_into(f'{endian}ff', prefix, 112, 1, 0)
+
+    temp = os.path.join(os.path.dirname(output) or '.', f'.{os.path.basename(output)}.tmp')
+    writer = gzip.open if output.endswith('.gz') else open
+    try:
+        with writer(temp, 'wb') as f:
+            f.write(prefix)
+            for block in _volume_chunks(path, header, chunk_volumes):
+                block = _gaussian(block * inside, sigmas) / weight * inside
+                f.write(block.astype(f'{endian}f4').tobytes(order='F'))
+        os.replace(temp, output)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    # The sidecar keeps the metadata of the input (RepetitionTime, ...) and is written last, so it marks a finished result
+    sidecar = {}
+    if os.path.isfile(_sidecar_path(path)):
+        with open(_sidecar_path(path)) as f:
+            sidecar = json.load(f)
+    sidecar.update(_smoothing_inputs(path, mask, fwhm))
+    write_json_atomic(_sidecar_path(output), sidecar)
+    return output
+
+
+def smoothed_path(path, fwhm):
+    """ 
+    Returns the path of the smoothed version of a BOLD image, e.g. desc-preproc -> desc-smooth6mm.
+    Images without a desc entity get one before their _bold suffix.
+  
+    Parameters: 
+    path (str): Path to a *_bold.nii or *_bold.nii.gz image
+    fwhm (float): Full width at half maximum of the kernel in mm
+  
+    Returns: 
+    str: Path of the smoothed image
+  
+    """
+
+    label = f'smooth{fwhm:g}mm'.replace('.', 'p')
+    if re.search(r'_desc-[a-zA-Z0-9]+_bold', path):
+        return re.sub(r'_desc-[a-zA-Z0-9]+_bold', f'_desc-{label}_bold', path)
+    if re.search(r'_bold\.nii(\.gz)?$', path):
+        return re.sub(r'_bold(\.nii(\.gz)?)$', f'_desc-{label}_bold\\1', path)
+    logging.error(f'{path} is not a *_bold.nii or *_bold.nii.gz image')
+    raise ValueError(f'{path} is not a *_bold.nii or *_bold.nii.gz image')
+
+
+def smooth_outputs(output, fwhm=6.0, jobs=4, chunk_volumes=16, pattern='*_desc-preproc_bold.nii*'):
+    """ 
+    Smooths every preprocessed BOLD image in an fmriprep output directory in a process pool (see smooth_bold).
+    Each image is masked with the brain mask fmriprep wrote next to it. Images whose smoothed version
+    was made from the same inputs with the same kernel are skipped.
+  
+    Parameters: 
+    output (str): Path to the fmriprep output directory
+    fwhm (float): Full width at half maximum of the kernel in mm
+    jobs (int): Number of images smoothed at the same time
+    chunk_volumes (int): Number of volumes each process holds in memory
+    pattern (str): Wildcard for the images to smooth
+  
+    Returns: 
+    dict: 'smoothed' and 'skipped' (lists of smoothed image paths) and 'failed' (input path -> error message)
+  
+    """
+
+    _require_numpy()
+    report = {'smoothed': [], 'skipped': [], 'failed': {}}
+    pending = {}
+    for path in sorted(glob.glob(f'{output}/**/sub-*/func/{pattern}', recursive=True)):
+        mask = re.sub(r'_desc-[a-zA-Z0-9]+_bold\.nii(\.gz)?$', r'_desc-brain_mask.nii\1', path)
+        if not os.path.isfile(mask):
+            logging.warning(f'No brain mask for {path}, smoothing the whole image')
+            mask = None
+        target = smoothed_path(path, fwhm)
+        try:
+            with open(_sidecar_path(target)) as f:
+                sidecar = json.load(f)
+            inputs = _smoothing_inputs(path, mask, fwhm)
+            current = all(sidecar.get(field) == value for field, value in inputs.items()) and os.path.isfile(target)
+        except (OSError, ValueError):
+            current = False
+        if current:
+            report['skipped'].append(target)
+        else:
+            pending[path] = mask
+
+    logging.info(f"Smoothing {len(pending)} images with {fwhm} mm FWHM ({len(report['skipped'])} up to date)")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = {pool.submit(smooth_bold, path, fwhm, mask, None, chunk_volumes): path for path, mask in pending.items()}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                report['smoothed'].append(future.result())
+            except Exception as err:
+                logging.error(f'Smoothing {futures[future]} failed: {err}')
+                report['failed'][futures[future]] = str(err)
+    return report
+
+
+# Confound columns used for motion QC: translations (mm), rotations (radians) and the global signal
+_MOTION_COLUMNS = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z', 'global_signal']
+
+
+def _read_confounds(path, columns):
+    # Reads selected columns of an fmriprep confounds TSV into a float array, n/a becomes NaN
+    with open(path) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        text = f.read().replace('n/a', 'nan')
+    data = np.full((text.count('\n') + (0 if text.endswith('\n') or not text else 1), len(columns)), np.nan)
+    present = [(i, header.index(column)) for i, column in enumerate(columns) if column in header]
+    if present and len(data):
+        values = np.loadtxt(io.StringIO(text), delimiter='\t', usecols=[index for _, index in present], ndmin=2)
+        data[:, [i for i, _ in present]] = values
+    return data
+
+
+def _bids_entities(path):
+    # sub, ses, task, run and echo labels of a BIDS file name
+    return dict(re.findall(r'(sub|ses|task|run|echo)-([a-zA-Z0-9]+)', os.path.basename(path)))
+
+
+def motion_qc(output, qc_dir=None, fd_threshold=0.9, z_threshold=5.0, jobs=8):
+    """ 
+    ART-style motion outlier detection for every run in an fmriprep output directory.
+
+    For every *_desc-confounds_*.tsv, framewise displacement (Power et al., 50 mm head radius) and z-scores of the
+    global signal are computed for all runs of all subjects at once. A volume is an outlier if its FD exceeds
+    fd_threshold (the volume before it is flagged as well) or its global signal z-score exceeds z_threshold.
+    Only runs whose confounds changed since the last call are recomputed.
+  
+    Parameters: 
+    output (str): Path to the fmriprep output directory
+    qc_dir (str): Directory for the results (defaults to {output}/motion_qc)
+    fd_threshold (float): Framewise displacement threshold in mm
+    z_threshold (float): Absolute global signal z-score threshold
+    jobs (int): Number of confounds files read at the same time
+  
+    Returns: 
+    list: Summary row per run with 'path', 'sub', 'ses', 'task', 'run', 'volumes', 'mean_fd', 'max_fd',
+        'outliers' and 'percent_outliers'. Per-run regressors (FD, global signal z-score, outlier flag and one
+        spike regressor per outlier) are written to {qc_dir}/sub-<ID>/*_desc-art_regressors.tsv, and the
+        summary of the cohort to {qc_dir}/motion_summary.tsv
+  
+    """
+
+    _require_numpy()
+    qc_dir = qc_dir or f'{output}/motion_qc'
+    os.makedirs(qc_dir, exist_ok=True)
+    settings = {'fd_threshold': fd_threshold, 'z_threshold': z_threshold}
+    cache_file = f'{qc_dir}/motion_qc.json'
+    cache = {}
+    if os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            saved = json.load(f)
+        if saved.get('settings') == settings:
+            cache = saved['runs']
+
+    def regressors_path(path):
+        name = re.sub(r'_desc-confounds_[a-z]+\.tsv$', '_desc-art_regressors.tsv', os.path.basename(path))
+        return f"{qc_dir}/sub-{_bids_entities(path).get('sub', 'unknown')}/{name}"
+
+    # Runs with unchanged confounds keep their cached summary
+    paths = sorted(glob.glob(f'{output}/**/sub-*/func/*_desc-confounds_*.tsv', recursive=True))
+    stale = []
+    for path in paths:
+        stat = os.stat(path)
+        entry = cache.get(path)
+        if not entry or entry['stat'] != [stat.st_size, stat.st_mtime_ns] or not os.path.isfile(regressors_path(path)):
+            stale.append((path, [stat.st_size, stat.st_mtime_ns]))
+    logging.info(f'Motion QC of {len(stale)} changed runs ({len(paths) - len(stale)} up to date)')
+
+    if stale:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            runs = list(pool.map(lambda item: _read_confounds(item[0], _MOTION_COLUMNS), stale))
+
+        # All runs are concatenated and processed with one set of array operations
+        data = np.concatenate(runs) if runs else np.empty((0, len(_MOTION_COLUMNS)))
+        lengths = np.array([len(run) for run in runs])
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(int)
+        valid = lengths > 0
+
+        motion = np.nan_to_num(data[:, :6])
+        change = np.abs(np.diff(motion, axis=0, prepend=motion[:1]))
+        change[starts[valid]] = 0
+        change[:, 3:] *= 50
+        fd = change.sum(axis=1)
+
+        signal = data[:, 6]
+        has_signal = ~np.isnan(signal)
+        signal = np.where(has_signal, signal, 0)
+        counts = np.add.reduceat(has_signal.astype(float), starts[valid]) if valid.any() else np.empty(0)
+        means = np.add.reduceat(signal, starts[valid]) / np.maximum(counts, 1) if valid.any() else np.empty(0)
+        squares = np.add.reduceat(signal ** 2, starts[valid]) / np.maximum(counts, 1) if valid.any() else np.empty(0)
+        stds = np.sqrt(np.maximum(squares - means ** 2, 0))
+        mean_rows = np.repeat(means, lengths[valid])
+        std_rows = np.repeat(stds, lengths[valid])
+        z = np.where(has_signal & (std_rows > 0), (signal - mean_rows) / np.where(std_rows > 0, std_rows, 1), 0)
+
+        # A movement between two volumes makes both of them outliers; FD is 0 at every run start
+        moved = fd > fd_threshold
+        outlier = moved | (np.abs(z) > z_threshold)
+        outlier[:-1] |= moved[1:]
+
+        for (path, stat), start, length in zip(stale, starts, lengths):
+            run_fd = fd[start:start + length]
+            run_outlier = outlier[start:start + length]
+            spikes = np.eye(length)[:, np.flatnonzero(run_outlier)]
+            columns = ['framewise_displacement', 'global_signal_z', 'art_outlier']
+            columns += [f'art_spike_{number:02d}' for number in range(spikes.shape[1])]
+            target = regressors_path(path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            np.savetxt(target, np.column_stack([run_fd, z[start:start + length], run_outlier, spikes]),
+                       fmt='%.6g', delimiter='\t', header='\t'.join(columns), comments='')
+            entities = _bids_entities(path)
+            cache[path] = {'stat': stat, 'summary': {
+                'path': os.path.relpath(path, output),
+                'sub': entities.get('sub'), 'ses': entities.get('ses'),
+                'task': entities.get('task'), 'run': entities.get('run'),
+                'volumes': int(length),
+                'mean_fd': float(run_fd.mean()) if length else 0.0,
+                'max_fd': float(run_fd.max()) if length else 0.0,
+                'outliers': int(run_outlier.sum()),
+                'percent_outliers': float(100 * run_outlier.mean()) if length else 0.0,
+            }}
+
+    # Runs whose confounds were removed are dropped from the summary
+    cache = dict((path, cache[path]) for path in paths)
+    write_json_atomic(cache_file, {'settings': settings, 'runs': cache})
+    summary = [cache[path]['summary'] for path in paths]
+    fields = ['path', 'sub', 'ses', 'task', 'run', 'volumes', 'mean_fd', 'max_fd', 'outliers', 'percent_outliers']
+    with open(f'{qc_dir}/motion_summary.tsv', 'w') as f:
+        f.write('\t'.join(fields) + '\n')
+        for row in summary:
+            f.write('\t'.join('n/a' if row[field] is None else
+                              f'{row[field]:.4f}' if isinstance(row[field], float) else str(row[field])
+                              for field in fields) + '\n')
+    return summary
+
+
+def _confounds_columns(path):
+    # Column names in the header line of a confounds TSV
+    with open(path) as f:
+        return f.readline().rstrip('\n').split('\t')
+
+
+class ConfoundsStore(object):
+    """ 
+    Columnar store of the confounds tables of every run in an fmriprep output directory.
+
+    Each confound column is kept in its own file of float64 values ({store_dir}/columns/<name>.f8) holding the
+    rows of all runs one after the other, and index.json maps every run (with its sub, ses, task, run and echo
+    labels) to its row range. Columns are memory-mapped when queried, so selecting a few columns of a few runs
+    neither parses text nor copies data. A column that is missing in a run is NaN for its rows.
+  
+    """
+
+    def __init__(self, store_dir):
+        """ 
+        Constructs the necessary attributes for the ConfoundsStore instance. 
+      
+        Parameters: 
+        store_dir (str): Directory of the store, created if it does not exist
+      
+        Returns: 
+        obj: ConfoundsStore instance 
+      
+        """
+
+        _require_numpy()
+        self.store_dir = store_dir
+        self.index_file = f'{store_dir}/index.json'
+        self.rows = 0
+        self.columns = []
+        self.runs = {}
+        self._maps = {}
+        os.makedirs(f'{store_dir}/columns', exist_ok=True)
+        if os.path.isfile(self.index_file):
+            with open(self.index_file) as f:
+                saved = json.load(f)
+            self.rows, self.columns, self.runs = saved['rows'], saved['columns'], saved['runs']
+
+    def _column_file(self, column):
+        return f'{self.store_dir}/columns/{column}.f8'
+
+    def _save(self):
+        self._maps = {}
+        write_json_atomic(self.index_file, {'rows': self.rows, 'columns': self.columns, 'runs': self.runs})
+
+    def _append(self, tables):
+        # Appends (key, entry, columns, data) tables; new columns are filled with NaN for the existing rows
+        for _, _, columns, _ in tables:
+            for column in columns:
+                if column not in self.columns:
+                    np.full(self.rows, np.nan).tofile(self._column_file(column))
+                    self.columns.append(column)
+        positions = {column: number for number, column in enumerate(self.columns)}
+        block = np.full((sum(len(data) for *_, data in tables), len(self.columns)), np.nan)
+        start = 0
+        for key, entry, columns, data in tables:
+            block[start:start + len(data), [positions[column] for column in columns]] = data
+            self.runs[key] = dict(entry, start=self.rows + start, stop=self.rows + start + len(data))
+            start += len(data)
+        for number, column in enumerate(self.columns):
+            with open(self._column_file(column), 'ab') as f:
+                f.write(np.ascontiguousarray(block[:, number]).tobytes())
+        self.rows += len(block)
+
+    def update(self, output, jobs=8, block_rows=1000000):
+        """ 
+        Adds the confounds of new or changed runs of an fmriprep output directory and drops removed runs.
+
+        Changed runs are appended at the end of the columns; the rows they leave behind are reclaimed
+        once they make up more than half of the store.
+      
+        Parameters: 
+        output (str): Path to the fmriprep output directory
+        jobs (int): Number of confounds files read at the same time
+        block_rows (int): Approximate number of rows collected in memory before they are appended
+      
+        Returns: 
+        dict: Number of 'added', 'updated', 'removed' and 'unchanged' runs
+      
+        """
+
+        # Rows appended by an interrupted update are not in the index and are cut off
+        for column in self.columns:
+            with open(self._column_file(column), 'r+b') as f:
+                f.truncate(self.rows * 8)
+
+        paths = sorted(glob.glob(f'{output}/**/sub-*/func/*_desc-confounds_*.tsv', recursive=True))
+        keys = {os.path.relpath(path, output): path for path in paths}
+        report = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+        stale = []
+        for key, path in keys.items():
+            stat = os.stat(path)
+            entry = self.runs.get(key)
+            if entry and entry['stat'] == [stat.st_size, stat.st_mtime_ns]:
+                report['unchanged'] += 1
+                continue
+            report['updated' if entry else 'added'] += 1
+            entities = _bids_entities(path)
+            stale.append((key, dict({name: entities.get(name) for name in ('sub', 'ses', 'task', 'run', 'echo')},
+                                    stat=[stat.st_size, stat.st_mtime_ns])))
+        for key in set(self.runs) - set(keys):
+            del self.runs[key]
+            report['removed'] += 1
+        logging.info(f"Confounds store: {report['added']} new, {report['updated']} changed, "
+                     f"{report['removed']} removed and {report['unchanged']} unchanged runs")
+
+        def read(item):
+            columns = _confounds_columns(keys[item[0]])
+            return item[0], item[1], columns, _read_confounds(keys[item[0]], columns)
+
+        # Tables are appended in blocks, so memory use does not grow with the size of the cohort
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            tables = []
+            for table in pool.map(read, stale):
+                tables.append(table)
+                if sum(len(data) for *_, data in tables) >= block_rows:
+                    self._append(tables)
+                    tables = []
+            if tables:
+                self._append(tables)
+
+        if sum(entry['stop'] - entry['start'] for entry in self.runs.values()) * 2 < self.rows:
+            self.compact()
+        else:
+            self._save()
+        return report
+
+    def compact(self):
+        """ 
+        Rewrites the columns with only the rows of the runs in the index, in index order.
+      
+        """
+
+        entries = sorted(self.runs.values(), key=lambda entry: entry['start'])
+        ranges = [(entry['start'], entry['stop']) for entry in entries]
+        for column in self.columns:
+            source = self.column(column)
+            target = self._column_file(column) + '.tmp'
+            with open(target, 'wb') as f:
+                for start, stop in ranges:
+                    f.write(np.ascontiguousarray(source[start:stop]).tobytes())
+            del source
+            self._maps.pop(column, None)
+            os.replace(target, self._column_file(column))
+        position = 0
+        for entry in entries:
+            entry['start'], entry['stop'] = position, position + entry['stop'] - entry['start']
+            position = entry['stop']
+        self.rows = position
+        self._save()
+
+    def column(self, column):
+        """ 
+        Returns one column of all runs as a read-only memory map.
+      
+        Parameters: 
+        column (str): Confound name, e.g. 'framewise_displacement'
+      
+        Returns: 
+        numpy.ndarray: Values of all rows in the store
+      
+        """
+
+        if column not in self.columns:
+            raise KeyError(f'{column} is not in the confounds store {self.store_dir}')
+        if column not in self._maps:
+            if self.rows == 0:
+                return np.empty(0)
+            self._maps[column] = np.memmap(self._column_file(column), dtype='<f8', mode='r', shape=(self.rows,))
+        return self._maps[column]
+
+    def select(self, **entities):
+        """ 
+        Returns the runs whose labels match, e.g. select(task='rest', run=['1', '2']).
+      
+        Parameters: 
+        entities (str or list): Labels of sub, ses, task, run and echo to match (one or several values each)
+      
+        Returns: 
+        list: Index keys (relative confounds paths) of the matching runs, sorted
+      
+        """
+
+        wanted = {name: [value] if isinstance(value, str) else list(value)
+                  for name, value in entities.items() if value is not None}
+        return sorted(key for key, entry in self.runs.items()
+                      if all(entry.get(name) in values for name, values in wanted.items()))
+
+    def query(self, columns, **entities):
+        """ 
+        Returns selected columns of the runs that match the given labels, as views of the memory-mapped columns.
+      
+        Parameters: 
+        columns (list): Confound names
+        entities (str or list): Labels of sub, ses, task, run and echo to match (see select)
+      
+        Returns: 
+        dict: Index key -> {confound name -> numpy.ndarray with one value per volume}
+      
+        """
+
+        maps = {column: self.column(column) for column in columns}
+        return {key: {column: values[self.runs[key]['start']:self.runs[key]['stop']] for column, values in maps.items()}
+                for key in self.select(**entities)}
+
+
+# Resources used for every subject unless estimates are requested
+DEFAULT_RESOURCES = {'nthreads': 4, 'walltime_hours': 20, 'mem_mb': 16000}
+
+# Cluster resources of a BIDS conversion job of one subject
+CONVERSION_RESOURCES = {'nthreads': 2, 'walltime_hours': 2, 'mem_mb': 4000}
+
+
+def estimate_subject_resources(bids_root, sub, freesurfer=False, multiecho=False, history=None):
+    """ 
+    Estimates the cluster resources fmriprep needs for one subject from its converted BOLD data.
+
+    Memory scales with the largest run in float32 (times the number of echoes for multiecho data,
+    which fmriprep combines in memory). Wall time scales with the total number of voxels over all volumes,
+    plus a fixed cost for anatomical processing and for FreeSurfer recon-all.
+  
+    Parameters: 
+    bids_root (str): Path to generated BIDS directory
+    sub (str): Subject ID (with or without 'sub-' prefix)
+    freesurfer (bool): Flag to specify Freesurfer surface estimation
+    multiecho (bool): Flag to specify if functional data is multi-echo
+    history (dict): Optional past usage per subject ID, e.g. {'01': {'run_time': 36000, 'max_mem_mb': 12000}}.
+        Estimates are never lower than the observed usage plus a safety margin
+  
+    Returns: 
+    dict: 'nthreads', 'mem_mb', 'walltime_hours', plus the 'runs', 'echoes' and 'volumes' they are based on.
+        A subject without BOLD data (e.g. not converted yet) gets DEFAULT_RESOURCES with 'runs' = 0
+  
+    """
+
+    if sub.startswith('sub-'):
+        sub = sub[4:]
+
+    # Group BOLD files into runs; each echo of a multiecho run is a separate file
+    runs = {}
+    for path in glob.glob(f'{bids_root}/sub-{sub}/func/*_bold.nii*'):
+        header = read_nifti_header(path)
+        voxels = header['dim'][1] * header['dim'][2] * header['dim'][3]
+        volumes = header['dim'][4] if header['dim'][0] >= 4 else 1
+        run = re.sub(r'_echo-[0-9]+', '', os.path.basename(path))
+        runs.setdefault(run, []).append((voxels, volumes))
+
+    # The model only holds for converted data; without it, the baseline request is the safe choice
+    if not runs:
+        logging.warning(f'No BOLD data for sub-{sub} in {bids_root}, using the default resources')
+        return dict(DEFAULT_RESOURCES, runs=0, echoes=0, volumes=0)
+
+    estimate = _resource_model(runs, freesurfer, (history or {}).get(sub))
+    return dict((field, estimate[field]) for field in ('nthreads', 'mem_mb', 'walltime_hours', 'runs', 'echoes', 'volumes'))
+
+
+def _resource_model(runs, freesurfer=False, past=None):
+    # Estimate from {run: [(voxels, volumes) of each echo]}, with the unrounded predictions in 'run_hours' and 'peak_mem_mb'
+    echoes = max((len(files) for files in runs.values()), default=1)
+    largest_run_mb = max((sum(v * t for v, t in files) * 4 / 2**20 for files in runs.values()), default=0)
+    total_voxel_volumes = sum(v * t for files in runs.values() for v, t in files)
+
+    # fmriprep holds several float32 copies of a run while resampling
+    mem_mb = 8000 + 6 * largest_run_mb
+    # Roughly 20 minutes per 5e7 voxel-volumes (a 300 volume 64x64x36 run), plus anatomical processing
+    walltime_hours = 2 + total_voxel_volumes / 5e7 / 3
+    if freesurfer:
+        walltime_hours += 8
+    nthreads = 8 if freesurfer or len(runs) > 4 else 4
+    run_hours, peak_mem_mb = walltime_hours, mem_mb
+
+    if past:
+        walltime_hours = max(walltime_hours, 1.25 * past.get('run_time', 0) / 3600)
+        mem_mb = max(mem_mb, 1.2 * past.get('max_mem_mb', 0))
+
+    return {
+        'nthreads': nthreads,
+        'mem_mb': int(math.ceil(mem_mb / 1000) * 1000),
+        'walltime_hours': int(math.ceil(walltime_hours)),
+        'runs': len(runs),
+        'echoes': echoes,
+        'volumes': sum(t for files in runs.values() for v, t in files),
+        'run_hours': run_hours,
+        'peak_mem_mb': peak_mem_mb,
+    }
+
+
+# Approximate fmriprep output sizes: anatomical derivatives and FreeSurfer subject folder (MB), and the bytes
+# written per BOLD voxel and volume (compressed float32 images in the default output space, one per multiecho run)
+FMRIPREP_OUTPUT_SIZES = {'anat_mb': 400, 'freesurfer_mb': 350, 'bytes_per_voxel_volume': 2.4}
+
+
+# Largest job that packed participants are combined into
+PACK_LIMITS = {'nthreads': 24, 'walltime_hours': 4, 'mem_mb': 128000}
+
+
+def pack_subjects(resources, pack='auto', limits=None):
+    """ 
+    Groups participants into cluster jobs.
+  
+    Parameters: 
+    resources (dict): Subject ID -> resource estimate (see estimate_subject_resources)
+    pack (int or str): Fixed number of participants per job, or 'auto' to pack participants
+        that are expected to finish within limits['walltime_hours'] into jobs of at most
+        limits['nthreads'] cores and limits['mem_mb'] memory. Longer participants get a job of their own.
+        Participants without BOLD data to size them from ('runs' = 0) always get a job of their own
+    limits (dict): Overrides of PACK_LIMITS
+  
+    Returns: 
+    list: Groups of subject IDs, one per job
+  
+    """
+
+    unsized = [[sub] for sub in resources if resources[sub].get('runs') == 0]
+    subs = [sub for sub in resources if resources[sub].get('runs') != 0]
+    if pack != 'auto':
+        return unsized + [subs[i:i + int(pack)] for i in range(0, len(subs), int(pack))]
+
+    limits = dict(PACK_LIMITS, **(limits or {}))
+    groups, group = unsized, []
+    # Participants of similar length share a job, so few cores idle while the longest one finishes
+    for sub in sorted(subs, key=lambda sub: resources[sub]['walltime_hours']):
+        if resources[sub]['walltime_hours'] > limits['walltime_hours']:
+            groups.append([sub])
+            continue
+        total = group_resources(group + [sub], resources)
+        if group and (total['nthreads'] > limits['nthreads'] or total['mem_mb'] > limits['mem_mb']):
+            groups.append(group)
+            group = []
+        group.append(sub)
+    if group:
+        groups.append(group)
+    return groups
+
+
+def group_name(group):
+    """ 
+    Name of the batch script, output file and work directory of a packed job, e.g. group-01-3f2a9c1e.
+    It is derived from all participants, so a job packed differently never reuses the files of another one.
+  
+    Parameters: 
+    group (list): Subject IDs of the job
+  
+    Returns: 
+    str: Job name
+  
+    """
+
+    return f"group-{group[0]}-{hashlib.sha1(' '.join(group).encode()).hexdigest()[:8]}"
+
+
+def group_resources(group, resources):
+    """ Resources of one job running all participants of a group at the same time """
+
+    return {
+        'nthreads': sum(resources[sub]['nthreads'] for sub in group),
+        'omp_nthreads': max(resources[sub]['nthreads'] for sub in group),
+        'mem_mb': sum(resources[sub]['mem_mb'] for sub in group),
+        'walltime_hours': max(resources[sub]['walltime_hours'] for sub in group),
+    }
+
+
+def parse_lsf_output(path):
+    """ 
+    Parses the resource usage summary that LSF appends to a job output file.
+    If a job was run more than once with the same output file, the last summary is used (see parse_lsf_reports).
+  
+    Parameters: 
+    path (str): Path to an LSF job output file (e.g. batchoutput/nodejob-fmriprep-sub-01.out)
+  
+    Returns: 
+    dict: 'subjects', 'job_id', 'status' ('done', 'exit' or 'unknown'), 'exit_code', 'term_reason',
+        'cpu_time' and 'run_time' (seconds), 'max_mem_mb', and the 'freesurfer' and 'multiecho' settings
+        the job ran with. Missing values are None
+  
+    """
+
+    return parse_lsf_reports(path)[-1]
+
+
+def parse_lsf_reports(path):
+    """ 
+    Parses every resource usage summary of a job output file. LSF appends one report per run, so a
+    resubmitted subject script collects the reports of all its attempts in the same file.
+  
+    Parameters: 
+    path (str): Path to an LSF job output file
+  
+    Returns: 
+    list: One dict per report, oldest first (see parse_lsf_output). A file without report gives one
+        entry with status 'unknown'
+  
+    """
 
-        # Check that the anatomical DICOM folder exists
-        if not os.path.isdir(self.pdict['anat']):
-            logging.error(f"'{self.pdict['anat']}' does not exist! Input a valid anatomical DICOM directory.")
-            raise OSError(f"'{self.pdict['anat']}' does not exist! Input a valid anatomical DICOM directory.")
+    with open(path, errors='replace') as f:
+        text = f.read()
+    # Every report starts with the mail header of LSF, followed by the output of that run
+    starts = [match.start() for match in re.finditer(r'Sender: LSF System', text)]
+    reports = [text[start:end] for start, end in zip(starts, starts[1:] + [len(text)])] or [text]
+    named = re.search(r'sub-([^./]+)\.out$', os.path.basename(path))
+    return [_parse_lsf_report(report, named.group(1) if named else None) for report in reports]
 
-        # Check that the functional DICOM folders exist
-        if not multiecho:
-            for func in self.pdict['func']:
-                if not os.path.isdir(func):
-                    logging.error(f"'{func}' does not exist! Input a valid functional DICOM directory.")
-                    raise OSError(f"'{func}' does not exist! Input a valid functional DICOM directory.")
-        elif multiecho:
-            for run in self.pdict['func']:
-                for echo in run:
-                    if not os.path.isdir(echo):
-                        logging.error(f"'{echo}' does not exist! Input a valid functional DICOM directory.")
-                        raise OSError(f"'{echo}' does not exist! Input a valid functional DICOM directory.")
 
-        # TODO: Validate fmriprep-docker requirements
-        # TODO: Validate motion regression requirements
+def _parse_lsf_report(report, named=None):
+    # One report of parse_lsf_reports()
+    def last(pattern, cast=float):
+        matches = re.findall(pattern, report)
+        return cast(matches[-1]) if matches else None
 
-        logging.info('Validated!')
+    # Per-subject scripts are named after the subject; array and packed jobs echo their participants
+    subjects = re.findall(r'fmriprep participant: sub-(\S+)', report)
+    if not subjects and named:
+        subjects = [named]
 
+    if 'Successfully completed.' in report:
+        status = 'done'
+    elif 'Exited with exit code' in report or 'TERM_' in report:
+        status = 'exit'
+    else:
+        status = 'unknown'
 
-    def create_bids_hierarchy(self):
-        """ Creates the subject directory and nested anat and func directories."""
+    # Settings echoed by the batch script (see FmriprepSingularityPipeline._fmriprep_script)
+    settings = re.search(r'fmriprep settings: freesurfer=(\d) multiecho=(\d)', report)
 
-        logging.info('Creating BIDS hierarchy.....')
+    return {
+        'subjects': sorted(set(subjects)),
+        'job_id': last(r'Subject: Job (\d+)', int),
+        'status': status,
+        'exit_code': last(r'Exited with exit code (\d+)', int) if status == 'exit' else (0 if status == 'done' else None),
+        'term_reason': last(r'(TERM_[A-Z_]+)', str),
+        'cpu_time': last(r'CPU time\s*:\s*([\d.]+) sec'),
+        'max_mem_mb': last(r'Max Memory\s*:\s*([\d.]+) MB'),
+        'run_time': last(r'Run time\s*:\s*([\d.]+) sec'),
+        'freesurfer': bool(int(settings.group(1))) if settings else None,
+        'multiecho': bool(int(settings.group(2))) if settings else None,
+    }
 
-        # Create subject directory
-        # If they do, log an error but continue
-        sub_path = f'{self.pdict["root"]}/sub-{self.pdict["name"]}'
-        try:
-            os.makedirs(sub_path)
-        except FileExistsError:
-            logging.warning('Subject directory exists!')
 
-        # Create anat and func directories
-        # If they do, log an error but continue
-        self.anat_path = f'{sub_path}/anat/'
-        try:
-            os.makedirs(self.anat_path)
-        except FileExistsError:
-            logging.warning('anat directory exists')
+def _performance_store(store):
+    connection = sqlite3.connect(store)
+    # Stores of earlier versions kept one row per output file; their rows are harvested again
+    keys = [row[1] for row in sorted(connection.execute('PRAGMA table_info(jobs)').fetchall(), key=lambda row: row[5]) if row[5]]
+    if keys == ['output_file']:
+        logging.warning(f'Rebuilding the job table of {store} with one row per job')
+        with connection:
+            connection.execute('DROP TABLE jobs')
+    connection.execute('''CREATE TABLE IF NOT EXISTS jobs (
+        output_file TEXT, size INTEGER, mtime_ns INTEGER, batch_dir TEXT, subjects TEXT,
+        job_id INTEGER, status TEXT, exit_code INTEGER, term_reason TEXT,
+        cpu_time REAL, max_mem_mb REAL, run_time REAL, freesurfer INTEGER, multiecho INTEGER,
+        PRIMARY KEY (output_file, job_id))''')
+    return connection
 
-        self.func_path = f'{sub_path}/func/'
-        try:
-            os.makedirs(self.func_path)
-        except FileExistsError:
-            logging.warning('func directory exists')
 
-        logging.info("Completed!")
+def harvest_batch_output(batch_dir, store=None):
+    """ 
+    Reads the LSF resource usage of every job in the output files of {batch_dir}/batchoutput into a SQLite store,
+    one row per job, so failed attempts of a resubmitted subject stay in the history.
+    Only files that are new or changed since the last harvest are parsed.
+  
+    Parameters: 
+    batch_dir (str): Batch directory used by FmriprepSingularityPipeline
+    store (str): Path to the SQLite store (defaults to {batch_dir}/performance.db)
+  
+    Returns: 
+    int: Number of job output files that were (re)parsed
+  
+    """
 
+    store = store or f'{batch_dir}/performance.db'
 
-    def convert(self, multiecho=False):
-        """ 
-        Converts the specified DICOMs into NIFTIs using dcm2niix
-      
-        Parameters: 
-        multiecho (bool): Flag to specify if functional data is multi-echo  
-            Note that multiecho DICOMS must be specified as a list of lists (see multiecho example)  
+    # Settings of the batch, saved by create_singularity_batch(), for jobs whose output does not name them
+    options = {}
+    if os.path.isfile(f'{batch_dir}/minerva_options.json'):
+        with open(f'{batch_dir}/minerva_options.json') as f:
+            options = json.load(f)
 
-        """
+    connection = _performance_store(store)
+    known = dict((row[0], (row[1], row[2])) for row in connection.execute('SELECT output_file, size, mtime_ns FROM jobs'))
+    updated = 0
+    with connection:
+        for entry in os.scandir(f'{batch_dir}/batchoutput'):
+            if not entry.name.endswith('.out'):
+                continue
+            stat = entry.stat()
+            path = os.path.abspath(entry.path)
+            if known.get(path) == (stat.st_size, stat.st_mtime_ns):
+                continue
+            connection.execute('DELETE FROM jobs WHERE output_file = ?', (path,))
+            for job in parse_lsf_reports(entry.path):
+                freesurfer = options.get('freesurfer') if job['freesurfer'] is None else job['freesurfer']
+                multiecho = options.get('multiecho') if job['multiecho'] is None else job['multiecho']
+                connection.execute('INSERT OR REPLACE INTO jobs VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)', (
+                    path, stat.st_size, stat.st_mtime_ns, os.path.abspath(batch_dir), ' '.join(job['subjects']),
+                    job['job_id'], job['status'], job['exit_code'], job['term_reason'],
+                    job['cpu_time'], job['max_mem_mb'], job['run_time'],
+                    int(bool(freesurfer)), int(bool(multiecho))))
+            updated += 1
+    connection.close()
+    logging.info(f'Harvested {updated} new or changed job outputs from {batch_dir}')
+    return updated
 
-        # Run dcm2niix for anatomical DICOM and rename
-        logging.info('Converting anatomical DICOMs to NIFTI and renaming.....')
-        self.anat_name = f'sub-{self.pdict["name"]}_T1w'
-        command = ['dcm2niix', '-z', 'n', '-f', self.anat_name, '-b', 'y', '-o', self.anat_path, self.pdict['anat']]
-        if not os.path.exists(f'{self.anat_path}/{self.anat_name}.nii'):
-            print('Running dcm2niix')
-            process = subprocess.run(command)
-        else:
-            logging.warning(f'{self.anat_name} exists! Not overwriting.')
-        logging.info('Completed!')
 
-        
-        # Run dcm2niix for every functional DICOM and rename
-        logging.info('Converting functional DICOMs to NIFTI and renaming.....')
-        
-        # For single echo data, loop over the self.pdict['func'] array
-        if not multiecho:
-            run_counter = 1
-            for func_input in self.pdict['func']:
-                func_name = f'sub-{self.pdict["name"]}_task-{self.pdict["task"]}_run-{str(run_counter)}_bold'
-                self.func_name.append(func_name)
-                command = ['dcm2niix', '-z', 'n', '-f', func_name, '-b', 'y', '-o', self.func_path, func_input]
-                if not os.path.exists(f'{self.func_path}/{func_name}.nii'):
-                    print('Running dcm2niix')
-                    process = subprocess.run(command)
-                else:
-                    logging.warning(f'{func_name} exists! Not overwriting.')
-                run_counter += 1
+def _percentile(values, q):
+    # Linear interpolation between the closest ranks
+    values = sorted(values)
+    if not values:
+        return None
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
 
-        # For multi echo data, there is a list of runs, and each run is a list of echos
-        # Loop over the array of arrays and rename appropriately
-        # All outputs are in the BIDS func directory, but the run-# and echo-# are different
-        # Note: dcm2niix outputs multiecho weirdly, so they are first named temp, and converted to the right name
-        elif multiecho:
-            run_counter = 1
-            for run in self.pdict['func']:
-                echo_counter = 1
-                for echo in run:
-                    echo_name = f'sub-{self.pdict["name"]}_task-{self.pdict["task"]}_run-{str(run_counter)}_echo-{str(echo_counter)}_bold'
-                    self.func_name.append(echo_name)
-                    command = ['dcm2niix', '-z', 'n', '-f', 'temp', '-b', 'y', '-o', self.func_path, echo]
-                    if not os.path.exists(f'{self.func_path}/{echo_name}.nii'):
-                        process = subprocess.run(command)
-                        to_rename = glob.glob(f"{self.func_path}*temp*.nii")[0]
-                        os.rename(to_rename, f'{self.func_path}/{echo_name}.nii')
-                        to_rename = glob.glob(f"{self.func_path}*temp*.json")[0]
-                        os.rename(to_rename, f'{self.func_path}/{echo_name}.json') 
-                    else:
-                        logging.warning(f'{echo_name} exists! Not overwriting.')
-                    echo_counter += 1
-                run_counter += 1
-        logging.info('Completed!')
-    
 
-    def update_json(self):
-        """ Updates the JSON sidecars generated with dcm2niix to include a field for TaskName """
+def performance_report(store, print_report=True):
+    """ 
+    Summarizes the harvested job accounting, split by the freesurfer and multiecho settings.
+  
+    Parameters: 
+    store (str): Path to a SQLite store written by harvest_batch_output()
+    print_report (bool): Flag to print the summary table
+  
+    Returns: 
+    dict: (freesurfer, multiecho) -> 'jobs', 'failure_rate', p50/p95 of 'run_time' (hours),
+        'max_mem_mb' and 'cpu_time' (hours), and the most common 'term_reasons'
+  
+    """
 
-        # Add TaskName field to BIDS functional NIFTI sidecars
-        logging.info('Updating functional NIFTI sidecars.....')
-        for func in self.func_name:
-            with open(f'{self.func_path}/{func}.json') as json_file:
-                data = json.load(json_file)
-                data['TaskName'] = self.pdict["task"]
+    connection = _performance_store(store)
+    rows = connection.execute('SELECT freesurfer, multiecho, status, run_time, max_mem_mb, cpu_time, term_reason FROM jobs').fetchall()
+    connection.close()
 
-            with open(f'{self.func_path}/{func}.json', 'w') as outfile:
-                json.dump(data,outfile)
-        logging.info('Completed!')
+    groups = {}
+    for freesurfer, multiecho, status, run_time, max_mem_mb, cpu_time, term_reason in rows:
+        groups.setdefault((bool(freesurfer), bool(multiecho)), []).append((status, run_time, max_mem_mb, cpu_time, term_reason))
+
+    report = {}
+    for key, jobs in sorted(groups.items()):
+        finished = [job for job in jobs if job[0] != 'unknown']
+        summary = {'jobs': len(jobs),
+                   'failure_rate': sum(job[0] == 'exit' for job in finished) / len(finished) if finished else None}
+        for index, field, scale in ((1, 'run_time', 3600), (2, 'max_mem_mb', 1), (3, 'cpu_time', 3600)):
+            values = [job[index] / scale for job in finished if job[index] is not None]
+            summary[f'{field}_p50'] = _percentile(values, 50)
+            summary[f'{field}_p95'] = _percentile(values, 95)
+        reasons = {}
+        for job in jobs:
+            if job[4]:
+                reasons[job[4]] = reasons.get(job[4], 0) + 1
+        summary['term_reasons'] = reasons
+        report[key] = summary
+
+    if print_report:
+        def fmt(value, spec='.1f'):
+            return '-' if value is None else format(value, spec)
+        print(f'{"freesurfer":>10} {"multiecho":>9} {"jobs":>5} {"failed":>7} '
+              f'{"run p50 h":>9} {"run p95 h":>9} {"mem p50 MB":>10} {"mem p95 MB":>10}')
+        for (freesurfer, multiecho), summary in report.items():
+            print(f'{str(freesurfer):>10} {str(multiecho):>9} {summary["jobs"]:>5} {fmt(summary["failure_rate"], ".0%"):>7} '
+                  f'{fmt(summary["run_time_p50"]):>9} {fmt(summary["run_time_p95"]):>9} '
+                  f'{fmt(summary["max_mem_mb_p50"], ".0f"):>10} {fmt(summary["max_mem_mb_p95"], ".0f"):>10}')
+    return report
 
 
-def run_fmriprep_docker(bids_root, output, fs_license, freesurfer=False):
+def _observed_usage(store, freesurfer, multiecho):
+    # Median run time (hours) and memory of successful single-subject jobs with the given settings, or None
+    # Failed jobs stop early and packed jobs cover several subjects, so neither says how long one subject takes
+    connection = _performance_store(store)
+    rows = connection.execute("SELECT subjects, run_time, max_mem_mb FROM jobs WHERE status = 'done' "
+                              "AND freesurfer = ? AND multiecho = ? AND run_time IS NOT NULL AND max_mem_mb IS NOT NULL",
+                              (int(bool(freesurfer)), int(bool(multiecho)))).fetchall()
+    connection.close()
+    rows = [row for row in rows if len(row[0].split()) == 1]
+    if not rows:
+        return None
+    return {'jobs': len(rows), 'run_hours': _percentile([row[1] / 3600 for row in rows], 50),
+            'max_mem_mb': _percentile([row[2] for row in rows], 50)}
+
+
+def performance_history(store):
     """ 
-    Runs the fmriprep-docker command on the BIDS directory generated by SetupBIDSPipeline.
-    This command can also be run on an independently generated BIDS directory. 
+    Returns the largest observed run time and memory use of every subject in a performance store,
+    in the form taken by the 'history' argument of estimate_subject_resources().
   
     Parameters: 
-    bids_root (str): Path to generated BIDS directory
-    output (str): Path to store fmriprep output
-    fs_license (str): Path to a valid Freesurfer license
-    freesurfer (bool): Flag to specify Freesurfer surface estimation
+    store (str): Path to a SQLite store written by harvest_batch_output()
+  
+    Returns: 
+    dict: Subject ID -> {'run_time': seconds, 'max_mem_mb': MB}
   
     """
 
-    # This method simply runs the fmriprep-docker command
-    logging.info('Executing fmriprep-docker command')
-    command = ['fmriprep-docker', bids_root, output, 'participant', '--fs-license-file', fs_license]
-    if not freesurfer:
-        command.append('--fs-no-reconall')
-    #logging.info(command)
-    subprocess.run(command)
+    connection = _performance_store(store)
+    rows = connection.execute('SELECT subjects, run_time, max_mem_mb FROM jobs').fetchall()
+    connection.close()
+    history = {}
+    for subjects, run_time, max_mem_mb in rows:
+        for sub in subjects.split():
+            past = history.setdefault(sub, {'run_time': 0, 'max_mem_mb': 0})
+            past['run_time'] = max(past['run_time'], run_time or 0)
+            past['max_mem_mb'] = max(past['max_mem_mb'], max_mem_mb or 0)
+    return history
 
 
 class FmriprepSingularityPipeline(object):
@@ -398,6 +3451,13 @@ class FmriprepSingularityPipeline(object):
             2. batch_dir: Path to a directory to store generated batch scripts
             3. project_dir: Root level project directory (parent to bids_root)
 
+        and may contain:
+            4. work_dir: Directory for persistent per-subject fmriprep work directories ({work_dir}/sub-<ID>),
+               e.g. on shared scratch, so a rerun resumes from the nodes nipype has already finished
+            5. cleanup: 'success' to remove a subject's work directory after fmriprep succeeded, 'never' (default) to keep it
+            6. templateflow_home: Shared, pre-populated TemplateFlow directory, so jobs never download templates
+            7. fs_subjects_dir: Existing FreeSurfer subjects directory, whose recon-all results are reused
+
         Returns: 
         obj: FmriprepSingularityPipeline instance 
       
@@ -412,11 +3472,290 @@ class FmriprepSingularityPipeline(object):
         self.batch_dir = minerva_options['batch_dir']
         self.multiecho = multiecho
 
-    def create_singularity_batch(self):
+    def _batch_header(self, job_name, output_file, resources=None):
+        # These are the BSUB cookies, followed by the singularity setup shared by all batch scripts
+        resources = resources or DEFAULT_RESOURCES
+        return [
+            f'#!/bin/bash\n\n',
+            f'#BSUB -J {job_name}\n',
+            f'#BSUB -P acc_guLab\n',
+            f'#BSUB -q private\n',
+            f'#BSUB -n {resources["nthreads"]}\n',
+            f'#BSUB -W {resources["walltime_hours"]}:00\n',
+            f'#BSUB -R rusage[mem={resources["mem_mb"]}]\n',
+            f'#BSUB -o {output_file}\n',
+            f'#BSUB -L /bin/bash\n\n',
+            # Module load singularity
+            f'ml singularity/3.2.1\n\n',
+            # Enter the directory that contains the fmriprep.20.0.1.simg
+            f'cd {self.minerva_options["project_dir"]}\n',
+        ]
+
+    def _fmriprep_command(self, label, resources=None, work_name=None):
+        # Create the singularity command for one participant label (or shell variable)
+        command = f"singularity run -B $HOME:/home --home /home \
+                    -B {self.minerva_options['image_location']}:/software {self._binds()} \
+                    --cleanenv {self.minerva_options['image_location']}/fmriprep-20.0.5.simg \
+                    {self.bids_root} {self.output} participant \
+                    --participant-label {label} --notrack --fs-license-file /software/license.txt"
+        command = " ".join(command.split())
+        # Reuse the work directory and FreeSurfer results of earlier runs
+        if self.minerva_options.get('work_dir'):
+            command = " ".join([command, f"-w {self._work_dir(work_name or f'sub-{label}')}"])
+        if self.minerva_options.get('fs_subjects_dir'):
+            command = " ".join([command, f"--fs-subjects-dir {self.minerva_options['fs_subjects_dir']}"])
+        # Ignore freesurfer if specified
+        if not self.freesurfer:
+           command = " ".join([command, '--fs-no-reconall'])
+        # Ignore slice timing for multiecho data
+        if self.multiecho:
+            command = " ".join([command, '--ignore slicetiming --skip-bids-validation'])
+        # Match fmriprep to the requested job resources, leaving 10% of the memory for the container itself
+        if resources:
+            command = " ".join([command, f"--nthreads {resources['nthreads']}",
+                                f"--omp-nthreads {resources.get('omp_nthreads', resources['nthreads'])}",
+                                f"--mem-mb {int(resources['mem_mb'] * 0.9)}"])
+        return command
+
+    def _binds(self):
+        # Directories outside the image that fmriprep needs to see
+        binds = []
+        for option in ('work_dir', 'fs_subjects_dir'):
+            if self.minerva_options.get(option):
+                binds.append(f'-B {self.minerva_options[option]}')
+        if self.minerva_options.get('templateflow_home'):
+            binds.append(f"-B {self.minerva_options['templateflow_home']}:/templateflow")
+        return ' '.join(binds)
+
+    def _work_dir(self, name):
+        return f"{self.minerva_options['work_dir']}/{name}"
+
+    def _fmriprep_script(self, label, resources=None, work_name=None):
+        # The fmriprep command with the setup and cleanup of its work directory and caches
+        work_name = work_name or f'sub-{label}'
+        subs = label.split()
+        # The settings are echoed for harvest_batch_output(), which may run after minerva_options.json changed
+        lines = [f'echo "fmriprep settings: freesurfer={int(bool(self.freesurfer))} multiecho={int(bool(self.multiecho))}"\n']
+        if self.minerva_options.get('templateflow_home'):
+            # --cleanenv drops the host environment, except for SINGULARITYENV_ variables
+            lines.append('export SINGULARITYENV_TEMPLATEFLOW_HOME=/templateflow\n')
+        if self.minerva_options.get('work_dir'):
+            lines.append(f'mkdir -p {self._work_dir(work_name)}\n')
+            # fmriprep keeps the nodes of each participant in fmriprep_wf/single_subject_<ID>_wf. In a packed
+            # call these are links to the participant's own work directory, so the nodes finished in any job
+            # are reused however the participant is packed next time
+            if len(subs) > 1:
+                for sub in subs:
+                    node_dir = f'fmriprep_wf/single_subject_{sub}_wf'
+                    lines.append(f'mkdir -p {self._work_dir(f"sub-{sub}")}/{node_dir} {self._work_dir(work_name)}/fmriprep_wf\n')
+                    lines.append(f'ln -sfn {self._work_dir(f"sub-{sub}")}/{node_dir} {self._work_dir(work_name)}/{node_dir}\n')
+        lines.append(self._fmriprep_command(label, resources, work_name) + '\n')
+        # Work directories are only removed after a successful run, so failed subjects resume on resubmission
+        if self.minerva_options.get('work_dir') and self.minerva_options.get('cleanup', 'never') == 'success':
+            work_dirs = [self._work_dir(work_name)] + ([self._work_dir(f'sub-{sub}') for sub in subs] if len(subs) > 1 else [])
+            lines.append('status=$?\n')
+            lines.append(f"if [ $status -eq 0 ]; then rm -rf {' '.join(work_dirs)}; fi\n")
+            lines.append('exit $status\n')
+        return ''.join(lines)
+
+    def _group_script(self, group, resources, mode):
+        # Runs all participants of a packed job, either in one fmriprep call or as concurrent processes
+        lines = [f'echo "fmriprep participant: sub-{sub}"\n' for sub in group]
+        if mode == 'labels':
+            lines.append(self._fmriprep_script(' '.join(group), group_resources(group, resources), group_name(group)))
+            return ''.join(lines)
+        lines.append('pids=""\n')
+        for sub in group:
+            lines.append(f'(\n{self._fmriprep_script(sub, resources[sub])}) &\n')
+            lines.append('pids="$pids $!"\n')
+        # The job fails if any of its participants failed
+        lines.append('status=0\n')
+        lines.append('for pid in $pids; do wait $pid || status=1; done\n')
+        lines.append('exit $status\n')
+        return ''.join(lines)
+
+    def _write_subject_script(self, sub, resources=None):
+        with open(f'{self.batch_dir}/sub-{sub}.sh', 'w') as f:
+            f.writelines(self._batch_header(f'fmriprep_sub-{sub}',
+                                            f'{self.batch_dir}/batchoutput/nodejob-fmriprep-sub-{sub}.out',
+                                            resources))
+            # Output command to batch script
+            f.write(self._fmriprep_script(sub, resources))
+
+    def estimate_resources(self, history=None):
+        """ 
+        Estimates per-subject resources from the converted BIDS data (see estimate_subject_resources).
+      
+        Parameters: 
+        history (dict): Optional past usage per subject ID, e.g. {'01': {'run_time': 36000, 'max_mem_mb': 12000}}
+      
+        Returns: 
+        dict: Subject ID -> resource estimate
+      
+        """
+
+        subs = [sub[4:] if sub[:4] == 'sub-' else sub for sub in self.subs]
+        return {sub: estimate_subject_resources(self.bids_root, sub, self.freesurfer, self.multiecho, history)
+                for sub in subs}
+
+    def plan(self, conversion=None, concurrency=20, store=None, pack=None, pack_mode='labels', pack_limits=None,
+             cluster_conversion=False):
+        """ 
+        Dry run of create_singularity_batch() and run_singularity_batch(): predicts the run time, core-hours, memory
+        and output size of every subject and the wall-clock time of the cohort, and lists the jobs and commands
+        that would be submitted, without writing batch scripts or calling the scheduler.
+
+        Subjects are sized from the conversion plan (see plan_dataset) or, if they are not in it, from the NIFTI
+        headers in the BIDS root. Subjects with neither are listed as 'unplanned' and left out of the totals.
+        With a performance store of earlier batches (see harvest_batch_output), the predictions are scaled so
+        the median subject matches the median observed run time and memory of jobs with the same freesurfer
+        and multiecho settings; subjects that ran before use their own usage.
+      
+        Parameters: 
+        conversion (dict): Result of plan_dataset() for subjects that are not converted yet (optional)
+        concurrency (int): Number of jobs running at the same time
+        store (str): SQLite performance store to calibrate from (optional)
+        pack, pack_mode, pack_limits: Same as for create_singularity_batch
+        cluster_conversion (bool): Plan a conversion job per subject that its fmriprep job waits for (see submit_pipeline)
+      
+        Returns: 
+        dict: 'subjects' (subject ID -> resource request, predicted 'hours', 'mem_mb_used', 'core_hours' and
+            'output_bytes'), 'unplanned' (subject IDs without a conversion plan or BOLD data), 'jobs' (one dict
+            per job with its 'name', 'subjects', 'script', 'resources', 'hours' and 'command'), 'calibration'
+            and 'totals' ('jobs', 'core_hours', 'requested_core_hours', 'peak_mem_mb', 'bids_bytes',
+            'output_bytes', 'convert_hours' and 'wall_hours')
+      
+        """
+
+        subs = [sub[4:] if sub[:4] == 'sub-' else sub for sub in self.subs]
+        planned = (conversion or {}).get('subjects', {})
+        history, observed = {}, None
+        if store and os.path.isfile(store):
+            history = performance_history(store)
+            observed = _observed_usage(store, self.freesurfer, self.multiecho)
+
+        # Runs of every subject, from the conversion plan or the converted data
+        estimates = {}
+        unplanned = []
+        for sub in subs:
+            runs = {}
+            unknown = False
+            if sub in planned:
+                for entry in planned[sub]['series'][1:]:
+                    # Without a volume count, the model only needs the voxel-volumes of the 16 bit DICOM data
+                    if entry['volumes'] is None:
+                        unknown = True
+                        files = (entry['input_bytes'] // 2, 1)
+                    else:
+                        files = (entry['voxels'], entry['volumes'])
+                    runs.setdefault(re.sub(r'_echo-[0-9]+', '', entry['name']), []).append(files)
+            else:
+                for path in glob.glob(f'{self.bids_root}/sub-{sub}/func/*_bold.nii*'):
+                    header = nifti_summary(read_nifti_header(path))
+                    runs.setdefault(re.sub(r'_echo-[0-9]+', '', os.path.basename(path)), []).append(
+                        (int(math.prod(header['dim'][:3])), header['volumes']))
+            if not runs:
+                unplanned.append(sub)
+                continue
+            estimates[sub] = _resource_model(runs, self.freesurfer, history.get(sub))
+            if unknown:
+                estimates[sub]['volumes'] = None
+            sizes = FMRIPREP_OUTPUT_SIZES
+            estimates[sub]['output_bytes'] = int(
+                (sizes['anat_mb'] + (sizes['freesurfer_mb'] if self.freesurfer else 0)) * 2**20
+                + sum(max(v * t for v, t in files) for files in runs.values()) * sizes['bytes_per_voxel_volume'])
+
+        if unplanned:
+            logging.warning(f'No conversion plan or BOLD data for {len(unplanned)} subjects, they are not planned: {unplanned}')
+        subs = [sub for sub in subs if sub not in unplanned]
+
+        # Scale the model to the jobs observed with the same settings
+        calibration = {'jobs': observed['jobs'] if observed else 0, 'time_factor': 1.0, 'mem_factor': 1.0}
+        new = [sub for sub in subs if sub not in history]
+        if observed and new:
+            calibration['time_factor'] = observed['run_hours'] / _percentile([estimates[sub]['run_hours'] for sub in new], 50)
+            calibration['mem_factor'] = observed['max_mem_mb'] / _percentile([estimates[sub]['peak_mem_mb'] for sub in new], 50)
+
+        for sub, estimate in estimates.items():
+            past = history.get(sub)
+            if past and past['run_time']:
+                estimate['hours'] = past['run_time'] / 3600
+                estimate['mem_mb_used'] = past['max_mem_mb']
+            else:
+                estimate['hours'] = estimate['run_hours'] * calibration['time_factor']
+                estimate['mem_mb_used'] = estimate['peak_mem_mb'] * calibration['mem_factor']
+            # Requests keep the safety margins of estimate_subject_resources()
+            estimate['walltime_hours'] = max(estimate['walltime_hours'], int(math.ceil(1.25 * estimate['hours'])))
+            estimate['mem_mb'] = max(estimate['mem_mb'], int(math.ceil(1.2 * estimate['mem_mb_used'] / 1000) * 1000))
+            estimate['core_hours'] = estimate['nthreads'] * estimate['hours']
+        resources = dict((sub, dict((field, estimates[sub][field]) for field in DEFAULT_RESOURCES)) for sub in subs)
+
+        # The jobs create_singularity_batch() would write, in submission order
+        jobs = []
+        groups = pack_subjects(resources, pack, pack_limits) if pack is not None else [[sub] for sub in subs]
+        for group in groups:
+            if len(group) == 1:
+                job_resources = resources[group[0]]
+                name, command = f'sub-{group[0]}', self._fmriprep_command(group[0], job_resources)
+            else:
+                job_resources = group_resources(group, resources)
+                name = group_name(group)
+                if pack_mode == 'labels':
+                    command = self._fmriprep_command(' '.join(group), job_resources, name)
+                else:
+                    command = ' & '.join(self._fmriprep_command(sub, resources[sub]) for sub in group)
+            jobs.append({'name': name, 'subjects': group, 'script': f'{self.batch_dir}/{name}.sh',
+                         'resources': job_resources, 'hours': max(estimates[sub]['hours'] for sub in group),
+                         'command': command})
+
+        # Conversion either runs before submission (plan_dataset wall-clock) or as a job ahead of each fmriprep job
+        convert_hours = dict((sub, planned[sub]['seconds'] / 3600 if sub in planned else 0.0) for sub in subs)
+        if cluster_conversion:
+            for job in jobs:
+                job['after'] = [f'convert-sub-{sub}' for sub in job['subjects']]
+            durations = [job['hours'] + max(convert_hours[sub] for sub in job['subjects']) for job in jobs]
+            wall_hours = _makespan(durations, concurrency)
+        else:
+            wall_hours = (conversion or {}).get('totals', {}).get('wall_seconds', 0) / 3600 + \
+                _makespan([job['hours'] for job in jobs], concurrency)
+
+        totals = {
+            'jobs': len(jobs),
+            'core_hours': sum(job['resources']['nthreads'] * job['hours'] for job in jobs),
+            'requested_core_hours': sum(job['resources']['nthreads'] * job['resources']['walltime_hours'] for job in jobs),
+            'peak_mem_mb': max((job['resources']['mem_mb'] for job in jobs), default=0),
+            'bids_bytes': (conversion or {}).get('totals', {}).get('output_bytes', 0),
+            'output_bytes': sum(estimate['output_bytes'] for estimate in estimates.values()),
+            'convert_hours': sum(convert_hours.values()),
+            'wall_hours': wall_hours,
+        }
+        if cluster_conversion:
+            totals['core_hours'] += sum(CONVERSION_RESOURCES['nthreads'] * hours for hours in convert_hours.values())
+        logging.info(f"Planned {totals['jobs']} fmriprep jobs: {totals['core_hours']:.0f} core-hours, "
+                     f"{totals['output_bytes'] / 2**30:.1f} GB output, {totals['wall_hours']:.1f} h with {concurrency} concurrent jobs")
+        return {'subjects': estimates, 'unplanned': unplanned, 'jobs': jobs, 'calibration': calibration, 'totals': totals}
+
+    def create_singularity_batch(self, array=False, throttle=None, resources=None, history=None,
+        pack=None, pack_mode='labels', pack_limits=None):
         """ 
         Creates the subject batch scripts for running fmriprep with Singularity.
         To run in parallel, subjects are run individually and submitted as separate jobs on the cluster.   
+
+        In array mode, a single job array script is created instead. Each array element reads its subject
+        from a subject list file (one subject per line) using $LSB_JOBINDEX.
       
+        Parameters: 
+        array (bool): Flag to create one LSF job array script instead of one script per subject
+        throttle (int): Maximum number of array elements running at the same time (array mode only)
+        resources (str or dict): None for the default 4 cores, 20 hours and 16000 MB per subject,
+            'auto' to size each subject from its BOLD data, or a dict of subject ID -> resource estimate
+        history (dict): Past usage per subject ID used to correct 'auto' estimates (optional)
+        pack (int or str): Run several participants per job: a fixed number, or 'auto' to pack short
+            participants by their estimated resources (see pack_subjects). Not available in array mode
+        pack_mode (str): 'labels' runs a packed job as one fmriprep call with all participant labels,
+            'concurrent' runs one fmriprep process per participant at the same time
+        pack_limits (dict): Overrides of PACK_LIMITS for pack='auto'
+
         """
 
         logging.info('Setting up fmriprep command through Singularity for Minerva')
@@ -425,6 +3764,8 @@ class FmriprepSingularityPipeline(object):
         if not os.path.isfile(f'{self.minerva_options["image_location"]}/fmriprep-20.0.5.simg'):
             logging.error('fmriprep image does not exist in the given directory!')
         #     raise OSError('fmriprep image does not exist in the given directory!')
+        if self.minerva_options.get('cleanup', 'never') not in ('never', 'success'):
+            raise ValueError(f"Unknown cleanup policy '{self.minerva_options['cleanup']}'! Use 'never' or 'success'.")
 
         # Create the specified batch directory folder if it doesn't exist
         logging.info('Creating batch directory for subject scripts')
@@ -435,80 +3776,532 @@ class FmriprepSingularityPipeline(object):
         if not os.path.isdir(f'{self.batch_dir}/batchoutput'):
             os.makedirs(f'{self.batch_dir}/batchoutput')
 
-        # Loop over all subjects
-        for sub in self.subs:
+        # Strip the 'sub-' prefix from the subject name strings, if it's there
+        subs = [sub[4:] if sub[:4] == 'sub-' else sub for sub in self.subs]
 
-            # Strip the 'sub-' prefix from the subject name string, if it's there
-            if sub[:4] == 'sub-':
-                sub = sub[4:]
+        # Size the jobs from the converted data if requested
+        if pack is not None and array:
+            raise ValueError('Packing participants is not available in array mode!')
+        if pack_mode not in ('labels', 'concurrent'):
+            raise ValueError(f"Unknown pack_mode '{pack_mode}'! Use 'labels' or 'concurrent'.")
+        if resources == 'auto' or (pack == 'auto' and not resources):
+            resources = self.estimate_resources(history=history)
+        resources = resources or {}
+        groups = None
+
+        if array:
+            # The default subject list holds all subjects; run_singularity_batch() may point to another one
+            subject_list = f'{self.batch_dir}/subjects.txt'
+            with open(subject_list, 'w') as f:
+                f.writelines(f'{sub}\n' for sub in subs)
+
+            # All array elements share one request, so it must fit the largest subject
+            array_resources = None
+            if resources:
+                array_resources = {field: max(resources[sub][field] for sub in subs)
+                                   for field in DEFAULT_RESOURCES}
+
+            limit = f'%{throttle}' if throttle else ''
+            with open(f'{self.batch_dir}/fmriprep_array.sh', 'w') as f:
+                f.writelines(self._batch_header(f'"fmriprep[1-{len(subs)}]{limit}"',
+                                                f'{self.batch_dir}/batchoutput/nodejob-fmriprep-array-%I.out',
+                                                array_resources))
+                # Map the array index to a subject
+                f.write(f'sub=$(sed -n "${{LSB_JOBINDEX}}p" ${{FMRIPREP_SUBJECT_LIST:-{subject_list}}})\n')
+                f.write('echo "fmriprep participant: sub-${sub}"\n')
+                f.write(self._fmriprep_script('${sub}', array_resources))
 
-            # Create the subject specific batch script
-            sub_batch_script = f'{self.batch_dir}/sub-{sub}.sh'
-            with open(sub_batch_script, 'w') as f:
-                lines = [
-                    # These are the BSUB cookies
-                    f'#!/bin/bash\n\n',
-                    f'#BSUB -J fmriprep_sub-{sub}\n',
-                    f'#BSUB -P acc_guLab\n',
-                    f'#BSUB -q private\n',
-                    f'#BSUB -n 4\n',
-                    f'#BSUB -W 20:00\n',
-                    f'#BSUB -R rusage[mem=16000]\n',
-                    f'#BSUB -o {self.batch_dir}/batchoutput/nodejob-fmriprep-sub-{sub}.out\n',
-                    f'#BSUB -L /bin/bash\n\n',
-                    # Module load singularity
-                    f'ml singularity/3.2.1\n\n',
-                    # Enter the directory that contains the fmriprep.20.0.1.simg
-                    f'cd {self.minerva_options["project_dir"]}\n',
-                ]
-                f.writelines(lines)
-
-                # Create the command
-                command = f"singularity run -B $HOME:/home --home /home \
-                            -B {self.minerva_options['image_location']}:/software \
-                            --cleanenv {self.minerva_options['image_location']}/fmriprep-20.0.5.simg \
-                            {self.bids_root} {self.output} participant \
-                            --participant-label {sub} --notrack --fs-license-file /software/license.txt"
-                command = " ".join(command.split())
-                # Ignore freesurfer if specified
-                if not self.freesurfer:
-                   command = " ".join([command, '--fs-no-reconall'])
-                # Ignore slice timing for multiecho data
-                if self.multiecho:
-                    command = " ".join([command, '--ignore slicetiming --skip-bids-validation'])
-                # Output command to batch script
-                f.write(command)
+        elif pack is not None:
+            # Participants without an estimate are sized with the defaults
+            resources = dict((sub, resources.get(sub, DEFAULT_RESOURCES)) for sub in subs)
+            groups = pack_subjects(resources, pack, pack_limits)
+            logging.info(f'Packing {len(subs)} subjects into {len(groups)} jobs')
+            for group in groups:
+                if len(group) == 1:
+                    self._write_subject_script(group[0], resources[group[0]])
+                    continue
+                # Packed jobs are named after all their participants
+                name = group_name(group)
+                with open(f'{self.batch_dir}/{name}.sh', 'w') as f:
+                    f.writelines(self._batch_header(f'fmriprep_{name}',
+                                                    f'{self.batch_dir}/batchoutput/nodejob-fmriprep-{name}.out',
+                                                    group_resources(group, resources)))
+                    f.write(self._group_script(group, resources, pack_mode))
+
+        else:
+            # Loop over all subjects
+            for sub in subs:
+
+                # Create the subject specific batch script
+                self._write_subject_script(sub, resources.get(sub))
 
         # Include all variables in the 'minerva_option' dictionary
         self.minerva_options['subs'] = self.subs
         self.minerva_options['bids_root'] = self.bids_root
         self.minerva_options['output'] = self.output
         self.minerva_options['freesurfer'] = self.freesurfer
+        self.minerva_options['multiecho'] = self.multiecho
+        self.minerva_options['array'] = array
+        self.minerva_options['throttle'] = throttle
+        self.minerva_options['resources'] = resources
+        self.minerva_options['groups'] = groups
+        self.minerva_options['pack_mode'] = pack_mode if groups else None
 
         # Save all parameters within the batch directory as well
         with open(f'{self.batch_dir}/minerva_options.json', 'w') as f:
             json.dump(self.minerva_options, f) 
 
 
-    def run_singularity_batch(self, subs):
+    def create_conversion_batch(self, dicom_dir, anat, func, task, resources=None, python=None, **options):
+        """ 
+        Creates one batch script per subject that converts the subject's DICOMs into the BIDS root on a compute node.
+        Submit them with submit_pipeline(), which makes each fmriprep job wait for its conversion job.
+      
+        Parameters: 
+        dicom_dir (str): Root path of all DICOMs
+        anat (str): Regex expression of path to anatomical DICOMs within each subject DICOM directory
+        func (list): List of regex expressions of paths to functional DICOMs (list of lists for multiecho)
+        task (str): Name of functional MRI task
+        resources (dict): Resources of every conversion job (defaults to CONVERSION_RESOURCES)
+        python (str): Python interpreter on the compute nodes (defaults to the current one)
+        options: Additional keyword arguments for build_dataset (e.g. jobs, progress_dir, cache_dir, compression).
+            They are saved as JSON, so they must be plain values
+      
+        """
+
+        logging.info('Creating BIDS conversion batch scripts')
+        os.makedirs(f'{self.batch_dir}/batchoutput', exist_ok=True)
+        if not os.path.isdir(self.bids_root):
+            create_bids_root(self.bids_root)
+
+        # The conversion settings are read back by 'python bids_pythonic.py convert' on the compute node
+        config = f'{self.batch_dir}/conversion.json'
+        with open(config, 'w') as f:
+            json.dump({'dicom_dir': dicom_dir, 'anat': anat, 'func': func, 'task': task, 'bids_root': self.bids_root,
+                       'multiecho': self.multiecho, 'options': options}, f)
+
+        python = python or sys.executable
+        resources = resources or CONVERSION_RESOURCES
+        for name in self.subs:
+            # Scripts are named after the BIDS ID, but the job gets the DICOM folder name (which may start with 'sub-')
+            sub = name[4:] if name[:4] == 'sub-' else name
+            # The output is not named *.out, so it is not mistaken for an fmriprep job by harvest_batch_output()
+            with open(f'{self.batch_dir}/convert-sub-{sub}.sh', 'w') as f:
+                f.writelines(self._batch_header(f'convert_sub-{sub}',
+                                                f'{self.batch_dir}/batchoutput/nodejob-convert-sub-{sub}.log', resources))
+                f.write(f'{python} {os.path.abspath(__file__)} convert {config} {name}\n')
+
+
+    def run_singularity_batch(self, subs, delay=60, retries=3, after=None):
         """ 
         Submits generated subject batch scripts to the HPC. 
+
+        In array mode, all subjects are submitted with a single bsub call of the job array script.
       
         Parameters: 
         subs (list): A list of subject ID strings. May be a subset of subjects in the BIDS directory.
+        delay (int): Seconds to wait between job submissions when submitting one script per subject
+        retries (int): Number of resubmissions when bsub fails (e.g. while the LSF master is busy)
+        after (dict): Optional subject ID -> LSF job ID that must finish successfully before the subject's job starts
+      
+        Returns: 
+        dict: Subject ID (or 'array') -> LSF job ID. Packed participants share the job ID of their group
       
         """
 
+        if self.minerva_options.get('array'):
+            logging.info(f'Submitting job array of {len(subs)} subjects to the private queue')
+            # Each submission gets its own subject list, so running arrays keep their index mapping
+            fd, subject_list = tempfile.mkstemp(dir=self.batch_dir, prefix='subjects_', suffix='.txt')
+            with os.fdopen(fd, 'w') as f:
+                f.writelines(f'{sub[4:] if sub.startswith("sub-") else sub}\n' for sub in subs)
+            throttle = self.minerva_options.get('throttle')
+            limit = f'%{throttle}' if throttle else ''
+            # bsub passes the submission environment on to the job
+            env = dict(os.environ, FMRIPREP_SUBJECT_LIST=subject_list)
+            # Every array element waits for all dependencies
+            return {'array': self._submit(['bsub', '-J', f'fmriprep[1-{len(subs)}]{limit}'] + self._depend(subs, after),
+                                          f'{self.batch_dir}/fmriprep_array.sh', retries, env)}
+
         logging.info('Submitting singularity batch scripts to the private queue')
+        # Packed participants are submitted together with the other participants of their job
+        groups = dict((sub, group) for group in self.minerva_options.get('groups') or [] for sub in group)
+        job_ids = {}
         counter = 1
         for sub in subs:
             # Submit job to scheduler
             if sub.startswith('sub-'):
                 sub = sub[4:]
+            if sub in job_ids:
+                continue
 
             logging.info(f'Submitting Job {counter} of {len(subs)}')
-            subprocess.run(f'bsub < {self.batch_dir}/sub-{sub}.sh', shell=True)
+            group = groups.get(sub, [sub])
+            if len(group) > 1:
+                logging.info(f'sub-{sub} is packed with {group}')
+                script = f'{self.batch_dir}/{group_name(group)}.sh'
+            else:
+                script = f'{self.batch_dir}/sub-{sub}.sh'
+            job_id = self._submit(['bsub'] + self._depend(group, after), script, retries)
+            job_ids.update((member, job_id) for member in group)
             counter += 1
             # Sleep for 1 min between job submissions (recommended)
-            time.sleep(60)
+            if counter <= len(subs):
+                time.sleep(delay)
+        return job_ids
+
+
+    def submit_pipeline(self, subs, delay=0, retries=3):
+        """ 
+        Submits the conversion job of every subject (see create_conversion_batch) and its fmriprep job,
+        which only starts once the conversion finished successfully (bsub -w "done(<job ID>)").
+      
+        Parameters: 
+        subs (list): A list of subject ID strings
+        delay (int): Seconds to wait between fmriprep job submissions
+        retries (int): Number of resubmissions when bsub fails
+      
+        Returns: 
+        dict: 'conversion' and 'fmriprep', each a dict of subject ID -> LSF job ID
+      
+        """
+
+        logging.info(f'Submitting conversion and fmriprep jobs of {len(subs)} subjects')
+        conversion = {}
+        for sub in subs:
+            sub = sub[4:] if sub.startswith('sub-') else sub
+            conversion[sub] = self._submit(['bsub'], f'{self.batch_dir}/convert-sub-{sub}.sh', retries)
+        fmriprep = self.run_singularity_batch(subs, delay=delay, retries=retries, after=conversion)
+        return {'conversion': conversion, 'fmriprep': fmriprep}
+
+
+    def supervise_batch(self, subs=None, target=20, poll=300, **options):
+        """ 
+        Submits subjects with a JobSubmitter instead of a fixed cadence: keeps target jobs pending or running
+        and resubmits jobs killed for memory or wall time with more resources. Blocks until all subjects finished.
+      
+        Parameters: 
+        subs (list): Subject ID strings (defaults to all subjects)
+        target (int): Number of jobs to keep pending or running
+        poll (float): Seconds between scheduler polls
+        options: Additional keyword arguments for JobSubmitter (max_attempts, escalation, limits, state_file)
+      
+        Returns: 
+        dict: Subject ID -> final state ('status', 'job_id', 'attempts', 'resources', 'reason')
+      
+        """
+
+        return JobSubmitter(self, subs, target, **options).run(poll)
+
+
+    def _depend(self, subs, after):
+        # bsub options making a job wait for the jobs of the given subjects
+        # With -ti, LSF terminates the job as soon as a dependency failed, instead of leaving it pending forever
+        job_ids = sorted(set(after[sub] for sub in subs if sub in (after or {})))
+        if not job_ids:
+            return []
+        return ['-w', ' && '.join(f'done({job_id})' for job_id in job_ids), '-ti']
+
+
+    def _submit(self, command, script, retries, env=None):
+        # Submits a batch script on stdin and returns the job ID printed by bsub
+        process = run_process(command, log=f'{self.batch_dir}/batchoutput/submissions.log', label=os.path.basename(script),
+                              timeout=300, retries=retries, stdin=script, env=env, capture=True)
+        match = re.search(r'Job <(\d+)>', process['stdout'])
+        if process['returncode'] != 0 or match is None:
+            logging.error(f"bsub failed for {script} with code {process['returncode']}")
+            raise OSError(f"bsub failed for {script} with code {process['returncode']}")
+        return match.group(1)
+
+
+# Largest request the JobSubmitter escalates failed jobs to
+RESOURCE_LIMITS = {'nthreads': 16, 'walltime_hours': 144, 'mem_mb': 192000}
+
+# LSF states of jobs that are still queued or running
+_ACTIVE_STATES = {'PEND', 'PROV', 'WAIT', 'RUN', 'PSUSP', 'USUSP', 'SSUSP'}
+
+
+class JobSubmitter(object):
+    """ 
+    Long-running submitter that keeps a target number of fmriprep jobs pending or running.
+
+    Job states are polled with bjobs, and failed jobs are diagnosed from their LSF output files.
+    Jobs killed for memory or wall time are resubmitted with escalated resources (up to RESOURCE_LIMITS),
+    other failures are resubmitted unchanged, until a subject has used up its attempts.
+    The state is saved after every step, so a restarted submitter continues where the last one stopped.
+  
+    """
+
+    def __init__(self, pipeline, subs=None, target=20, max_attempts=3, escalation=1.5, limits=None, state_file=None):
+        """ 
+        Constructs the necessary attributes for the JobSubmitter instance. 
+      
+        Parameters: 
+        pipeline (obj): FmriprepSingularityPipeline whose subjects are submitted
+        subs (list): Subject ID strings to submit (defaults to all subjects of the pipeline)
+        target (int): Number of jobs to keep pending or running
+        max_attempts (int): Maximum number of submissions per subject
+        escalation (float): Factor applied to the memory or wall time of a job killed for exceeding it
+        limits (dict): Overrides of RESOURCE_LIMITS
+        state_file (str): JSON file the state is saved to (defaults to {batch_dir}/submitter.json)
+      
+        Returns: 
+        obj: JobSubmitter instance 
+      
+        """
+
+        self.pipeline = pipeline
+        self.target = target
+        self.max_attempts = max_attempts
+        self.escalation = escalation
+        self.limits = dict(RESOURCE_LIMITS, **(limits or {}))
+        self.state_file = state_file or f'{pipeline.batch_dir}/submitter.json'
+        os.makedirs(f'{pipeline.batch_dir}/batchoutput', exist_ok=True)
+
+        # Subject -> {'status': waiting/submitted/done/failed, 'job_id', 'attempts', 'resources', 'reason', 'checks', 'output'}
+        self.subjects = {}
+        if os.path.isfile(self.state_file):
+            with open(self.state_file) as f:
+                self.subjects = json.load(f)['subjects']
+        initial = pipeline.minerva_options.get('resources') or {}
+        for sub in subs if subs is not None else pipeline.subs:
+            sub = sub[4:] if sub.startswith('sub-') else sub
+            self.subjects.setdefault(sub, {'status': 'waiting', 'job_id': None, 'attempts': 0, 'checks': 0,
+                                           'resources': dict(initial.get(sub) or DEFAULT_RESOURCES), 'reason': None})
+        # Packed participants of create_singularity_batch(pack=...) are first submitted together with their group
+        self.groups = dict((sub, group) for group in pipeline.minerva_options.get('groups') or []
+                           for sub in group if len(group) > 1)
+
+    def _job_states(self, job_ids):
+        # bjobs -a also lists recently finished jobs; unknown jobs are only reported on stderr
+        states = {}
+        for i in range(0, len(job_ids), 500):
+            process = run_process(['bjobs', '-w', '-a'] + job_ids[i:i + 500], timeout=120)
+            for line in process['stdout'].splitlines():
+                fields = line.split()
+                if len(fields) >= 3 and fields[0].isdigit():
+                    states[fields[0]] = fields[2]
+        return states
+
+    def _report(self, sub, entry):
+        # LSF appends every run to the same output file, so only a report of the current job counts
+        path = entry.get('output') or f'{self.pipeline.batch_dir}/batchoutput/nodejob-fmriprep-sub-{sub}.out'
+        if not os.path.isfile(path):
+            return None
+        report = parse_lsf_output(path)
+        return report if str(report['job_id']) == entry['job_id'] else None
+
+    def _failed(self, sub, entry, report):
+        # Escalate the resource that killed the job, or give up once it reached its limit
+        reason = {'TERM_MEMLIMIT': 'memory', 'TERM_RUNLIMIT': 'walltime'}.get((report or {}).get('term_reason'), 'exit')
+        entry['reason'] = reason
+        resources = entry['resources']
+        if reason == 'memory' and resources['mem_mb'] < self.limits['mem_mb']:
+            resources['mem_mb'] = min(int(math.ceil(resources['mem_mb'] * self.escalation / 1000) * 1000),
+                                      self.limits['mem_mb'])
+        elif reason == 'walltime' and resources['walltime_hours'] < self.limits['walltime_hours']:
+            resources['walltime_hours'] = min(int(math.ceil(resources['walltime_hours'] * self.escalation)),
+                                              self.limits['walltime_hours'])
+        elif reason != 'exit':
+            entry['attempts'] = self.max_attempts
+        if entry['attempts'] >= self.max_attempts:
+            logging.error(f"sub-{sub} failed ({reason}) after {entry['attempts']} attempts, giving up")
+            entry['status'] = 'failed'
+        else:
+            logging.warning(f"sub-{sub} failed ({reason}), resubmitting with {resources}")
+            entry['status'] = 'waiting'
+
+    def step(self):
+        """ 
+        Polls the scheduler once, handles finished jobs and submits waiting subjects up to the target.
+      
+        Returns: 
+        dict: Number of subjects per status
+      
+        """
+
+        submitted = [sub for sub, entry in self.subjects.items() if entry['status'] == 'submitted']
+        job_ids = sorted(set(self.subjects[sub]['job_id'] for sub in submitted))
+        states = self._job_states(job_ids) if job_ids else {}
+        for sub in submitted:
+            entry = self.subjects[sub]
+            state = states.get(entry['job_id'])
+            if state in _ACTIVE_STATES:
+                continue
+            report = self._report(sub, entry)
+            if state == 'DONE' or (report is not None and report['status'] == 'done'):
+                logging.info(f'sub-{sub} finished')
+                entry['status'] = 'done'
+                continue
+            # The output file may be written a little after the job left the queue
+            if report is None and entry['checks'] < 3:
+                entry['checks'] += 1
+                continue
+            self._failed(sub, entry, report)
+
+        # Packed participants share one job, so jobs (not subjects) count against the target
+        in_flight = len(set(entry['job_id'] for entry in self.subjects.values() if entry['status'] == 'submitted'))
+        for sub, entry in self.subjects.items():
+            if in_flight >= self.target:
+                break
+            if entry['status'] != 'waiting':
+                continue
+            batch_dir = self.pipeline.batch_dir
+            group = self.groups.get(sub, [sub])
+            members = [self.subjects.get(member) for member in group]
+            if len(group) > 1 and os.path.isfile(f'{batch_dir}/{group_name(group)}.sh') and \
+                    all(member is not None and member['status'] == 'waiting' and not member['attempts'] for member in members):
+                # First submission of a packed job, with the script written by create_singularity_batch()
+                job_id = self.pipeline._submit(['bsub'], f'{batch_dir}/{group_name(group)}.sh', 3)
+                output = f'{batch_dir}/batchoutput/nodejob-fmriprep-{group_name(group)}.out'
+            else:
+                # Array elements and resubmissions of packed participants run as jobs of their own,
+                # with a subject script written for the current resources
+                members = [entry]
+                self.pipeline._write_subject_script(sub, entry['resources'])
+                job_id = self.pipeline._submit(['bsub'], f'{batch_dir}/sub-{sub}.sh', 3)
+                output = f'{batch_dir}/batchoutput/nodejob-fmriprep-sub-{sub}.out'
+            for member in members:
+                member.update(job_id=job_id, output=output, checks=0, status='submitted')
+                member['attempts'] += 1
+            in_flight += 1
+
+        write_json_atomic(self.state_file, {'subjects': self.subjects})
+        return self.summary()
+
+    def summary(self):
+        """ Returns the number of subjects per status """
+
+        counts = {'waiting': 0, 'submitted': 0, 'done': 0, 'failed': 0}
+        for entry in self.subjects.values():
+            counts[entry['status']] += 1
+        return counts
+
+    def run(self, poll=300):
+        """ 
+        Repeats step() every poll seconds until every subject is done or has failed for good.
+      
+        Parameters: 
+        poll (float): Seconds between scheduler polls
+      
+        Returns: 
+        dict: Subject ID -> final state
+      
+        """
+
+        while True:
+            counts = self.step()
+            logging.info(f'Submitter: {counts}')
+            if not counts['waiting'] and not counts['submitted']:
+                return self.subjects
+            time.sleep(poll)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='fmriprepPipeline utilities')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    # Job accounting report for one or more batch directories
+    report_parser = commands.add_parser('report', help='Harvest LSF job outputs and print a performance report')
+    report_parser.add_argument('batch_dirs', nargs='+', help='Batch directories used by FmriprepSingularityPipeline')
+    report_parser.add_argument('--store', help='SQLite store (defaults to performance.db in the first batch directory)')
+
+    # Progress recorded by SetupBIDSPipeline in a progress directory
+    progress_parser = commands.add_parser('progress', help='Print the recorded progress of a dataset')
+    progress_parser.add_argument('progress_dir', help='Progress directory given to SetupBIDSPipeline/build_dataset')
+
+    # BIDS conversion of one subject, run on a compute node by the scripts of create_conversion_batch()
+    convert_parser = commands.add_parser('convert', help='Convert one subject with the settings of a conversion.json')
+    convert_parser.add_argument('config', help='conversion.json written by create_conversion_batch()')
+    convert_parser.add_argument('subject', help='Subject folder name in the DICOM directory')
+
+    # Long-running submitter for the subjects of a batch directory
+    supervise_parser = commands.add_parser('supervise', help='Keep jobs of a batch directory queued and resubmit failures')
+    supervise_parser.add_argument('batch_dir', help='Batch directory written by create_singularity_batch()')
+    supervise_parser.add_argument('--target', type=int, default=20, help='Jobs to keep pending or running')
+    supervise_parser.add_argument('--poll', type=float, default=300, help='Seconds between scheduler polls')
+    supervise_parser.add_argument('--max-attempts', type=int, default=3, help='Maximum submissions per subject')
+
+    # Smoothing of the preprocessed BOLD images in an fmriprep output directory
+    smooth_parser = commands.add_parser('smooth', help='Smooth preprocessed BOLD images within their brain masks')
+    smooth_parser.add_argument('output', help='fmriprep output directory')
+    smooth_parser.add_argument('--fwhm', type=float, default=6.0, help='Kernel FWHM in mm')
+    smooth_parser.add_argument('--jobs', type=int, default=4, help='Images smoothed at the same time')
+
+    # Motion outliers of every run in an fmriprep output directory
+    motion_parser = commands.add_parser('motion-qc', help='Flag motion and global signal outliers of every run')
+    motion_parser.add_argument('output', help='fmriprep output directory')
+    motion_parser.add_argument('--fd-threshold', type=float, default=0.9, help='Framewise displacement threshold in mm')
+    motion_parser.add_argument('--z-threshold', type=float, default=5.0, help='Global signal z-score threshold')
+    motion_parser.add_argument('--jobs', type=int, default=8, help='Confounds files read at the same time')
+
+    # Manifest of the files in a BIDS root
+    manifest_parser = commands.add_parser('manifest', help='Write a manifest of a BIDS root and compare it with an earlier one')
+    manifest_parser.add_argument('root', help='BIDS root')
+    manifest_parser.add_argument('manifest_file', help='Manifest JSON file (checksums of unchanged files are reused)')
+    manifest_parser.add_argument('--compare', help='Earlier manifest file to compare against')
+    manifest_parser.add_argument('--rehash', action='store_true', help='Checksum every file again')
+    manifest_parser.add_argument('--jobs', type=int, default=8, help='Files checksummed at the same time')
+
+    # Columnar store of the confounds of every run in an fmriprep output directory
+    confounds_parser = commands.add_parser('confounds', help='Add new or changed confounds tables to a columnar store')
+    confounds_parser.add_argument('output', help='fmriprep output directory')
+    confounds_parser.add_argument('--store', help='Store directory (defaults to {output}/confounds_store)')
+    confounds_parser.add_argument('--jobs', type=int, default=8, help='Confounds files read at the same time')
 
+    args = parser.parse_args()
+    if args.command == 'report':
+        store = args.store or f'{args.batch_dirs[0]}/performance.db'
+        for batch_dir in args.batch_dirs:
+            harvest_batch_output(batch_dir, store)
+        performance_report(store)
+    elif args.command == 'progress':
+        progress = PipelineState(args.progress_dir).progress()
+        for subject, entry in sorted(progress.items()):
+            updated = datetime.datetime.fromtimestamp(entry['updated']).strftime('%m-%d %H:%M')
+            print(f"sub-{subject:<12} {updated}  {entry['series']:>3} series  {' '.join(entry['stages'])}")
+        print(f"{sum('complete' in entry['stages'] for entry in progress.values())} of {len(progress)} subjects complete")
+    elif args.command == 'smooth':
+        logging.basicConfig(level=logging.INFO)
+        report = smooth_outputs(args.output, fwhm=args.fwhm, jobs=args.jobs)
+        print(f"{len(report['smoothed'])} smoothed, {len(report['skipped'])} up to date, {len(report['failed'])} failed")
+    elif args.command == 'motion-qc':
+        logging.basicConfig(level=logging.INFO)
+        summary = motion_qc(args.output, fd_threshold=args.fd_threshold, z_threshold=args.z_threshold, jobs=args.jobs)
+        flagged = [row for row in summary if row['outliers']]
+        print(f"{len(summary)} runs, {len(flagged)} with outliers, {sum(row['outliers'] for row in summary)} outlier volumes")
+    elif args.command == 'manifest':
+        logging.basicConfig(level=logging.INFO)
+        manifest = build_manifest(args.root, args.manifest_file, jobs=args.jobs, rehash=args.rehash)
+        print(f'{len(manifest)} files in {args.manifest_file}')
+        if args.compare:
+            changes = compare_manifests(args.compare, args.manifest_file)
+            for kind, paths in changes.items():
+                for path in paths:
+                    print(f'{kind:<8} {path}')
+            if any(changes.values()):
+                sys.exit(1)
+    elif args.command == 'confounds':
+        logging.basicConfig(level=logging.INFO)
+        store = ConfoundsStore(args.store or f'{args.output}/confounds_store')
+        store.update(args.output, jobs=args.jobs)
+        print(f'{len(store.runs)} runs, {store.rows} rows, {len(store.columns)} columns in {store.store_dir}')
+    elif args.command == 'supervise':
+        logging.basicConfig(level=logging.INFO)
+        with open(f'{args.batch_dir}/minerva_options.json') as f:
+            options = json.load(f)
+        pipeline = FmriprepSingularityPipeline(options['subs'], options['bids_root'], options['output'], options,
+                                               options.get('freesurfer', False), options.get('multiecho', False))
+        final = pipeline.supervise_batch(target=args.target, poll=args.poll, max_attempts=args.max_attempts)
+        if any(entry['status'] == 'failed' for entry in final.values()):
+            sys.exit(1)
+    elif args.command == 'convert':
+        logging.basicConfig(level=logging.INFO)
+        with open(args.config) as f:
+            config = json.load(f)
+        summary = build_dataset(config['dicom_dir'], [args.subject], config['anat'], config['func'], config['task'],
+                                config['bids_root'], multiecho=config['multiecho'], **config['options'])
+        # A failed conversion must fail the job, so the dependent fmriprep job never starts
+        if summary['failed']:
+            sys.exit(1)
@@ -61,12 +61,9 @@ if __name__ == "__main__":
     # This method creates the bids root directory
     bp.create_bids_root(bids_root)
 
-    for name in subs:
-        setup = bp.SetupBIDSPipeline(dicom_dir, name, anat, func, task, bids_root, ignore=True, multiecho=multiecho_flag)
-        setup.validate(multiecho=multiecho_flag)
-        setup.create_bids_hierarchy()
-        setup.convert(multiecho=multiecho_flag)
-        setup.update_json()
+    # Set up, convert and update all subjects in parallel (see sample_singleecho_pipeline.py)
+    summary = bp.build_dataset(dicom_dir, subs, anat, func, task, bids_root, multiecho=multiecho_flag, jobs=4, ignore=True)
+    print(summary['failed'])
 
     fp_singularity = bp.FmriprepSingularityPipeline(subs, bids_root, output_dir, minerva_options, multiecho=multiecho_flag)
     fp_singularity.create_singularity_batch()
@@ -48,13 +48,11 @@ if __name__ == "__main__":
     # This method creates the bids root directory
     bp.create_bids_root(bids_root)
 
-    # Loop over all subjects
-    for name in subs:
-        setup = bp.SetupBIDSPipeline(dicom_dir, name, anat, func, task, bids_root, ignore=True)
-        setup.validate()
-        setup.create_bids_hierarchy()
-        setup.convert()
-        setup.update_json()
+    # Set up, convert and update all subjects in parallel
+    # 'jobs' caps the number of subjects/dcm2niix processes running at the same time
+    # Subjects that fail are listed in the returned summary instead of stopping the loop
+    summary = bp.build_dataset(dicom_dir, subs, anat, func, task, bids_root, jobs=4, ignore=True)
+    print(summary['failed'])
 
     # Run the fmriprep-docker command on the created BIDS directory
     bp.run_fmriprep_docker(bids_root, output_dir, fs_license)
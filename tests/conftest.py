@@ -0,0 +1,110 @@
+"""
+
+Fixtures for the tests of the cluster and docker orchestration.
+
+Fake bsub, bjobs and fmriprep-docker executables are put on the PATH. They record every
+invocation (argv, the script read from stdin and the subject list variable) as JSON lines,
+so the tests can check exactly what would have been sent to LSF or docker.
+
+"""
+
+import json
+import os
+import stat
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# Fake bsub: records the call and prints an LSF style job ID (numbered from 100)
+# FAKE_BSUB_EXIT makes it fail with the given exit code instead
+FAKE_BSUB = r'''#!{python}
+import json, os, sys
+script = sys.stdin.read()
+calls = os.path.join(os.environ['FAKE_LSF_DIR'], 'bsub.jsonl')
+number = sum(1 for line in open(calls)) if os.path.exists(calls) else 0
+with open(calls, 'a') as f:
+    f.write(json.dumps({{'argv': sys.argv, 'script': script,
+                        'subject_list': os.environ.get('FMRIPREP_SUBJECT_LIST')}}) + '\n')
+if os.environ.get('FAKE_BSUB_EXIT'):
+    sys.stderr.write('LSF is down\n')
+    sys.exit(int(os.environ['FAKE_BSUB_EXIT']))
+print('Job <{{}}> is submitted to queue <private>.'.format(100 + number))
+'''
+
+# Fake bjobs: prints the states saved in states.json like bjobs -w -a (RUN for unknown jobs)
+FAKE_BJOBS = r'''#!{python}
+import json, os, sys
+path = os.path.join(os.environ['FAKE_LSF_DIR'], 'states.json')
+states = json.load(open(path)) if os.path.exists(path) else {{}}
+with open(os.path.join(os.environ['FAKE_LSF_DIR'], 'bjobs.jsonl'), 'a') as f:
+    f.write(json.dumps({{'argv': sys.argv}}) + '\n')
+print('JOBID   USER    STAT  QUEUE      FROM_HOST   EXEC_HOST   JOB_NAME   SUBMIT_TIME')
+for job_id in sys.argv[1:]:
+    if not job_id.startswith('-'):
+        print('{{}} user {{}} private login node fmriprep Jan  1 00:00'.format(job_id, states.get(job_id, 'RUN')))
+'''
+
+# Fake fmriprep-docker: records the call with its start and end time, runs for FAKE_DOCKER_SECONDS
+# and exits with the code given for its participant in FAKE_DOCKER_EXIT (e.g. "02:3")
+FAKE_FMRIPREP_DOCKER = r'''#!{python}
+import json, os, sys, time
+start = time.time()
+time.sleep(float(os.environ.get('FAKE_DOCKER_SECONDS', '0')))
+label = sys.argv[sys.argv.index('--participant-label') + 1] if '--participant-label' in sys.argv else None
+print('fmriprep participant', label)
+with open(os.path.join(os.environ['FAKE_LSF_DIR'], 'fmriprep-docker.jsonl'), 'a') as f:
+    f.write(json.dumps({{'argv': sys.argv, 'start': start, 'end': time.time()}}) + '\n')
+codes = dict(item.split(':') for item in os.environ.get('FAKE_DOCKER_EXIT', '').split(',') if item)
+sys.exit(int(codes.get(label, 0)))
+'''
+
+
+class FakeTools(object):
+    """ Reads back what the fake executables recorded """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def calls(self, tool):
+        path = os.path.join(self.directory, f'{tool}.jsonl')
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+
+    def set_states(self, states):
+        with open(os.path.join(self.directory, 'states.json'), 'w') as f:
+            json.dump(states, f)
+
+
+@pytest.fixture
+def fake_tools(tmp_path, monkeypatch):
+    """ Puts fake bsub, bjobs and fmriprep-docker on the PATH and returns a FakeTools reader """
+
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    for name, source in (('bsub', FAKE_BSUB), ('bjobs', FAKE_BJOBS), ('fmriprep-docker', FAKE_FMRIPREP_DOCKER)):
+        path = bin_dir / name
+        path.write_text(source.format(python=sys.executable))
+        path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setenv('FAKE_LSF_DIR', str(tmp_path))
+    return FakeTools(str(tmp_path))
+
+
+@pytest.fixture
+def pipeline(tmp_path):
+    """ FmriprepSingularityPipeline of five subjects with its batch directory in tmp_path """
+
+    import bids_pythonic as bp
+
+    minerva_options = {
+        'image_location': str(tmp_path),
+        'batch_dir': str(tmp_path / 'batch'),
+        'project_dir': str(tmp_path),
+    }
+    return bp.FmriprepSingularityPipeline(['01', '02', '03', '04', '05'], str(tmp_path / 'bids'),
+                                          str(tmp_path / 'output'), minerva_options)
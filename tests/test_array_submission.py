@@ -0,0 +1,38 @@
+import pytest
+
+
+def test_array_is_one_throttled_bsub(fake_tools, pipeline):
+    pipeline.create_singularity_batch(array=True, throttle=2)
+    job_ids = pipeline.run_singularity_batch(['01', '02', '03', '04', '05'])
+
+    calls = fake_tools.calls('bsub')
+    assert len(calls) == 1
+    assert calls[0]['argv'][1:] == ['-J', 'fmriprep[1-5]%2']
+    assert job_ids == {'array': '100'}
+    # The array script is sent on stdin and maps the index to a line of the subject list
+    assert '#BSUB -J "fmriprep[1-5]%2"' in calls[0]['script']
+    assert 'LSB_JOBINDEX' in calls[0]['script']
+    with open(calls[0]['subject_list']) as f:
+        assert f.read().split() == ['01', '02', '03', '04', '05']
+
+
+def test_every_array_submission_has_its_own_subject_list(fake_tools, pipeline):
+    pipeline.create_singularity_batch(array=True)
+    pipeline.run_singularity_batch(['01', 'sub-02'])
+    pipeline.run_singularity_batch(['03'])
+
+    first, second = fake_tools.calls('bsub')
+    assert first['argv'][1:] == ['-J', 'fmriprep[1-2]']
+    assert second['argv'][1:] == ['-J', 'fmriprep[1-1]']
+    assert first['subject_list'] != second['subject_list']
+    with open(first['subject_list']) as f:
+        assert f.read().split() == ['01', '02']
+
+
+def test_failed_bsub_raises(fake_tools, pipeline, monkeypatch):
+    pipeline.create_singularity_batch(array=True)
+    monkeypatch.setenv('FAKE_BSUB_EXIT', '255')
+
+    with pytest.raises(OSError, match='bsub failed'):
+        pipeline.run_singularity_batch(['01'], retries=0)
+    assert len(fake_tools.calls('bsub')) == 1
@@ -0,0 +1,40 @@
+import bids_pythonic as bp
+
+
+def test_fmriprep_jobs_wait_for_their_conversions(fake_tools, pipeline, tmp_path):
+    pipeline.subs = ['sub-01', '02', '03']
+    pipeline.create_conversion_batch(str(tmp_path / 'dicoms'), 'anat', ['func'], 'rest', python='python3')
+    pipeline.create_singularity_batch(pack=2)
+    submitted = pipeline.submit_pipeline(['sub-01', '02', '03'])
+
+    calls = fake_tools.calls('bsub')
+    conversions, fmriprep = calls[:3], calls[3:]
+    # One conversion job per subject, submitted first and without dependencies
+    assert [call['argv'][1:] for call in conversions] == [[]] * 3
+    assert 'convert' in conversions[0]['script'] and conversions[0]['script'].rstrip().endswith(' sub-01')
+    assert submitted['conversion'] == {'01': '100', '02': '101', '03': '102'}
+
+    # The packed job waits for the conversions of both its participants, the single job for its own
+    group = bp.group_name(['01', '02'])
+    assert fmriprep[0]['argv'][1:] == ['-w', 'done(100) && done(101)', '-ti']
+    assert f'#BSUB -J fmriprep_{group}' in fmriprep[0]['script']
+    assert fmriprep[1]['argv'][1:] == ['-w', 'done(102)', '-ti']
+    assert '#BSUB -J fmriprep_sub-03' in fmriprep[1]['script']
+    assert submitted['fmriprep'] == {'01': '103', '02': '103', '03': '104'}
+
+
+def test_array_waits_for_all_conversions(fake_tools, pipeline, tmp_path):
+    pipeline.subs = ['01', '02']
+    pipeline.create_conversion_batch(str(tmp_path / 'dicoms'), 'anat', ['func'], 'rest')
+    pipeline.create_singularity_batch(array=True)
+    pipeline.submit_pipeline(['01', '02'])
+
+    array = fake_tools.calls('bsub')[-1]
+    assert array['argv'][1:] == ['-J', 'fmriprep[1-2]', '-w', 'done(100) && done(101)', '-ti']
+
+
+def test_no_dependency_without_conversion_jobs(fake_tools, pipeline):
+    pipeline.create_singularity_batch()
+    pipeline.run_singularity_batch(['01', '02'], delay=0, after={'02': '7'})
+
+    assert [call['argv'][1:] for call in fake_tools.calls('bsub')] == [[], ['-w', 'done(7)', '-ti']]
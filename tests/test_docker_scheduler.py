@@ -0,0 +1,58 @@
+import os
+
+import bids_pythonic as bp
+
+
+def test_containers_are_packed_into_the_budget(fake_tools, tmp_path, monkeypatch):
+    monkeypatch.setenv('FAKE_DOCKER_SECONDS', '0.3')
+    results = bp.run_fmriprep_docker_parallel(str(tmp_path / 'bids'), str(tmp_path / 'output'), 'license.txt',
+                                              ['01', '02', '03', '04'], nthreads=4, mem_mb=8000,
+                                              total_cpus=8, total_mem_mb=64000)
+
+    calls = fake_tools.calls('fmriprep-docker')
+    assert len(calls) == 4
+    # No more than two 4-thread containers run at the same time within 8 CPUs
+    for call in calls:
+        running = sum(other['start'] < call['end'] and call['start'] < other['end'] for other in calls)
+        assert running <= 2
+    # The third participant only starts once one of the first two finished
+    assert max(call['start'] for call in calls) >= min(call['end'] for call in calls)
+
+    argv = next(call['argv'] for call in calls if '02' in call['argv'])
+    assert argv[1:4] == [str(tmp_path / 'bids'), str(tmp_path / 'output'), 'participant']
+    for option, value in (('--participant-label', '02'), ('--nthreads', '4'), ('--omp-nthreads', '4'),
+                          ('--mem-mb', '8000'), ('--env', bp._CONTAINER_TAG)):
+        assert argv[argv.index(option) + 1] == value
+    assert '--fs-no-reconall' in argv
+
+    assert set(results) == {'01', '02', '03', '04'}
+    for sub, result in results.items():
+        assert result['returncode'] == 0
+        assert result['wall_time'] >= 0.3
+        with open(result['log']) as f:
+            assert f'fmriprep participant {sub}' in f.read()
+
+
+def test_per_subject_resources_are_capped_by_the_budget(fake_tools, tmp_path):
+    results = bp.run_fmriprep_docker_parallel(str(tmp_path / 'bids'), str(tmp_path / 'output'), 'license.txt',
+                                              ['01', '02'], nthreads=2, mem_mb=4000, total_cpus=8, total_mem_mb=16000,
+                                              resources={'02': {'nthreads': 16, 'mem_mb': 32000}})
+
+    assert (results['01']['nthreads'], results['01']['mem_mb']) == (2, 4000)
+    assert (results['02']['nthreads'], results['02']['mem_mb']) == (8, 16000)
+    argv = next(call['argv'] for call in fake_tools.calls('fmriprep-docker') if '02' in call['argv'])
+    assert argv[argv.index('--nthreads') + 1] == '8'
+    assert argv[argv.index('--omp-nthreads') + 1] == '8'
+
+
+def test_failed_participant_is_retried_and_reported(fake_tools, tmp_path, monkeypatch):
+    monkeypatch.setenv('FAKE_DOCKER_EXIT', '02:3')
+    results = bp.run_fmriprep_docker_parallel(str(tmp_path / 'bids'), str(tmp_path / 'output'), 'license.txt',
+                                              ['01', '02'], total_cpus=16, total_mem_mb=64000, retries=1,
+                                              log_dir=str(tmp_path / 'logs'))
+
+    assert results['01']['returncode'] == 0
+    assert results['02']['returncode'] == 3
+    assert results['02']['attempts'] == 2
+    assert sum('02' in call['argv'] for call in fake_tools.calls('fmriprep-docker')) == 2
+    assert os.path.isfile(tmp_path / 'logs' / 'sub-02.log')
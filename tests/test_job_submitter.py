@@ -0,0 +1,88 @@
+import json
+
+import bids_pythonic as bp
+
+
+def lsf_report(path, job_id, reason=None, code=1):
+    """ Appends the report LSF writes when a job exited, like an output file of a failed attempt """
+
+    with open(path, 'a') as f:
+        f.write(f'Sender: LSF System <lsfadmin@node>\nSubject: Job {job_id}: <fmriprep> in cluster <minerva> Exited\n\n')
+        if reason:
+            f.write(f'{reason}: job killed after reaching LSF limit.\n')
+        f.write(f'Exited with exit code {code}.\n')
+
+
+def test_keeps_target_jobs_in_flight(fake_tools, pipeline):
+    pipeline.create_singularity_batch()
+    submitter = bp.JobSubmitter(pipeline, target=2)
+
+    assert submitter.step() == {'waiting': 3, 'submitted': 2, 'done': 0, 'failed': 0}
+    assert [call['argv'][1:] for call in fake_tools.calls('bsub')] == [[], []]
+    # Running jobs keep their place, a finished one makes room for the next subject
+    fake_tools.set_states({'100': 'DONE'})
+    assert submitter.step() == {'waiting': 2, 'submitted': 2, 'done': 1, 'failed': 0}
+    assert fake_tools.calls('bjobs')[-1]['argv'][1:] == ['-w', '-a', '100', '101']
+    assert '#BSUB -J fmriprep_sub-03' in fake_tools.calls('bsub')[-1]['script']
+
+
+def test_memory_is_escalated_on_resubmission(fake_tools, pipeline, tmp_path):
+    pipeline.create_singularity_batch()
+    submitter = bp.JobSubmitter(pipeline, ['01'], target=1)
+    submitter.step()
+    assert '#BSUB -R rusage[mem=16000]' in fake_tools.calls('bsub')[0]['script']
+
+    fake_tools.set_states({'100': 'EXIT'})
+    lsf_report(tmp_path / 'batch' / 'batchoutput' / 'nodejob-fmriprep-sub-01.out', 100, 'TERM_MEMLIMIT', 130)
+    submitter.step()
+    assert '#BSUB -R rusage[mem=24000]' in fake_tools.calls('bsub')[1]['script']
+    entry = submitter.subjects['01']
+    assert (entry['status'], entry['job_id'], entry['attempts'], entry['reason']) == ('submitted', '101', 2, 'memory')
+
+    # The report of the first attempt stays in the output file, but no longer counts for the new job
+    fake_tools.set_states({'101': 'DONE'})
+    assert submitter.step()['done'] == 1
+
+
+def test_gives_up_after_max_attempts(fake_tools, pipeline, tmp_path):
+    pipeline.create_singularity_batch()
+    submitter = bp.JobSubmitter(pipeline, ['01'], max_attempts=2)
+    output = tmp_path / 'batch' / 'batchoutput' / 'nodejob-fmriprep-sub-01.out'
+    for job_id in (100, 101):
+        submitter.step()
+        fake_tools.set_states({str(job_id): 'EXIT'})
+        lsf_report(output, job_id)
+
+    assert submitter.step() == {'waiting': 0, 'submitted': 0, 'done': 0, 'failed': 1}
+    assert len(fake_tools.calls('bsub')) == 2
+    # Failures other than memory or wall time are resubmitted with the same resources
+    assert submitter.subjects['01']['resources'] == bp.DEFAULT_RESOURCES
+    assert submitter.subjects['01']['reason'] == 'exit'
+
+
+def test_restarted_submitter_continues(fake_tools, pipeline, tmp_path):
+    pipeline.create_singularity_batch()
+    bp.JobSubmitter(pipeline, ['01', '02'], target=1).step()
+    with open(tmp_path / 'batch' / 'submitter.json') as f:
+        assert json.load(f)['subjects']['01']['job_id'] == '100'
+
+    # A new submitter polls the job of the last one instead of submitting the subject again
+    submitter = bp.JobSubmitter(pipeline, ['01', '02'], target=1)
+    fake_tools.set_states({'100': 'DONE'})
+    submitter.step()
+    assert fake_tools.calls('bjobs')[-1]['argv'][1:] == ['-w', '-a', '100']
+    assert (submitter.subjects['01']['status'], submitter.subjects['02']['job_id']) == ('done', '101')
+    assert len(fake_tools.calls('bsub')) == 2
+
+
+def test_packed_participants_are_submitted_together(fake_tools, pipeline):
+    pipeline.create_singularity_batch(pack=2)
+    submitter = bp.JobSubmitter(pipeline, ['01', '02', '03'], target=5)
+
+    assert submitter.step()['submitted'] == 3
+    group = bp.group_name(['01', '02'])
+    calls = fake_tools.calls('bsub')
+    assert len(calls) == 2
+    assert f'#BSUB -J fmriprep_{group}' in calls[0]['script']
+    assert submitter.subjects['01']['job_id'] == submitter.subjects['02']['job_id'] == '100'
+    assert submitter.subjects['01']['output'].endswith(f'nodejob-fmriprep-{group}.out')